@@ -53,6 +53,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'simsalabim.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'backenddjango.urls'
@@ -135,6 +136,69 @@ CORS_ALLOW_METHODS = ['GET']
 CORS_ALLOW_METHODS = ["GET", "POST", "PUT", "DELETE"]
 CORS_ALLOW_HEADERS = ["*"]
 
+# Jumlah komponen PCA untuk pencarian cover (index dibangun ulang jika berubah)
+COVER_PCA_COMPONENTS = 2
+
+# Cache hasil pencarian cover: jumlah entri maksimum dan umur entri (detik)
+COVER_RESULT_CACHE_SIZE = 256
+COVER_RESULT_CACHE_TTL = 600
+
+# Batas ukuran upload ZIP (per file, total hasil ekstraksi, dan rasio kompresi)
+ZIP_MAX_MEMBER_BYTES = 50 * 1024 * 1024
+ZIP_MAX_TOTAL_BYTES = 1024 * 1024 * 1024
+ZIP_MAX_COMPRESSION_RATIO = 200
+
+# Jumlah proses untuk featurisasi file hasil ekstraksi ZIP
+INGEST_WORKERS = 2
+
+# Alamat proses shard pencarian audio ("host:port" atau path Unix socket, lihat
+# `manage.py runshard`). Kosong berarti pencarian dilakukan di proses Django sendiri.
+AUDIO_SEARCH_SHARDS = []
+# Rahasia bersama koordinator <-> shard, dari environment (SIMSALABIM_SHARD_AUTHKEY).
+# Koneksi shard meng-unpickle setiap pesan, jadi tanpa rahasia ini `runshard` dan
+# pencarian lewat shard menolak berjalan.
+AUDIO_SHARD_AUTHKEY = os.environ.get('SIMSALABIM_SHARD_AUTHKEY', '').encode() or None
+# Batas waktu (detik) menunggu jawaban semua shard
+AUDIO_SEARCH_DEADLINE = 2.0
+
+# Batas waktu (detik) pencarian audio; lagu dinilai berurutan dari skor ringkas
+# tertinggi dan hasil terbaik sementara dikembalikan (partial) bila waktu habis.
+# None berarti semua lagu selalu dinilai. Bisa juga dikirim per request ("budget").
+AUDIO_SEARCH_BUDGET = None
+
+# Bobot fitur timing (histogram DTB/OTB dari delta dan onset time) dalam skor audio, 0..1.
+# 0 berarti hanya fitur nada; hanya berlaku untuk index yang dibangun dengan
+# `manage.py buildindex audio --timing`. Pencarian lewat shard belum memakai fitur timing.
+AUDIO_TIMING_WEIGHT = 0.0
+
+# Presisi penyimpanan histogram index audio: 'float64', 'float32', 'float16' atau 'uint8'
+# (jumlah nada per bin, tepat). Dipakai `manage.py buildindex audio`; akurasinya
+# dibandingkan dengan float64 lewat `manage.py precisionreport`.
+AUDIO_INDEX_PRECISION = 'float64'
+
+# Deduplikasi index audio: lagu dengan isi fitur yang sama disimpan sekali (sisanya
+# menjadi alias) dan segmen yang sama dalam satu channel berbagi satu baris histogram.
+# Hasil pencarian tetap per file. Bisa dimatikan dengan `buildindex audio --no-dedup`.
+AUDIO_INDEX_DEDUP = True
+
+# Jumlah file maksimum per request pada endpoint pencarian batch
+BATCH_SEARCH_MAX_FILES = 500
+DATA_UPLOAD_MAX_NUMBER_FILES = BATCH_SEARCH_MAX_FILES
+
+# Profiling per request (header X-Simsalabim-Profile atau ?profile=1), hanya untuk user staff
+# atau dengan token ini (header X-Simsalabim-Profile-Token). None berarti hanya user staff.
+PROFILING_TOKEN = os.environ.get('SIMSALABIM_PROFILING_TOKEN') or None
+# Folder penyimpanan profil (<request id>.prof dan .json) dan jumlah profil yang disimpan
+PROFILE_DIR = os.path.join(BASE_DIR, 'datasets', 'profiles')
+PROFILE_KEEP = 200
+CORS_EXPOSE_HEADERS = ['Server-Timing', 'X-Simsalabim-Profile-Id']
+
+# Batas memori lunak (byte). Build index menulis histogram per blok bila melebihi
+# INDEX_MEMORY_BUDGET; pencarian batch membagi query agar tidak melebihi
+# QUERY_MEMORY_BUDGET. None berarti tanpa batas (lihat `manage.py memoryreport`).
+INDEX_MEMORY_BUDGET = None
+QUERY_MEMORY_BUDGET = None
+
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',  # Frontend origin
 ]
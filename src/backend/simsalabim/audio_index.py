@@ -0,0 +1,1303 @@
+import os
+import io
+import json
+import time
+import hashlib
+import numpy as np
+import mido
+from concurrent.futures import ProcessPoolExecutor
+
+from .index_files import index_dir as live_index_dir, pointer_path, staging_dir, swap_index, file_token, update_lock
+from .metrics import stage_timer, record_channel_score
+from .memory_stats import track_memory
+
+# Path to the folder containing MIDI files
+AUDIO_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '../datasets/audio'))
+
+INPUT_FILE = 'input.mid'
+CHANNELS = [0, 1, 2, 10]
+
+# Same windowing as tesmidi.process_midi_file
+SEGMENT_LENGTH = 20
+SLIDING_WINDOW = 6
+
+FEATURES = ('atb', 'rtb', 'ftb')
+FEATURE_BINS = {'atb': 128, 'rtb': 255, 'ftb': 255}
+WEIGHTS = {'atb': 0.15, 'rtb': 0.60, 'ftb': 0.25}
+
+# Timing features of the same windows: histograms of the normalized delta
+# times (DTB) and onset times (OTB) of the notes of a segment
+TIMING_FEATURES = ('dtb', 'otb')
+TIMING_BINS = {'dtb': 128, 'otb': 128}
+TIMING_WEIGHTS = {'dtb': 0.5, 'otb': 0.5}
+
+META_FILE = 'meta.json'
+
+# Representative song of every indexed song (itself unless its content duplicates an earlier song)
+ALIASES_FILE = 'alias_of.npy'
+
+# Storage precisions of the histogram matrices (see write_audio_index)
+PRECISIONS = ('float64', 'float32', 'float16', 'uint8')
+HISTOGRAM_DTYPES = {'float64': np.float64, 'float32': np.float32, 'float16': np.float16, 'uint8': np.uint8}
+
+# Rows of a float16 or uint8 histogram matrix converted to float32 at a time while scoring
+SCORE_BLOCK_ROWS = 16384
+
+# Upper bound on the similarity-matrix cells score_queries computes at once (float64, ~256 MB)
+MAX_BATCH_CELLS = 32 * 1024 * 1024
+
+# Memory per similarity cell while scoring: the float64 product and one temporary
+BYTES_PER_CELL = 16
+
+# Similarities computed per step of anytime_search; bounds how far a step can overrun the budget
+ANYTIME_STEP_CELLS = 2 * 1024 * 1024
+
+# Memory held per segment while a channel is histogrammed: the three float64
+# histogram rows plus the bincount and song_means temporaries of the widest one
+HISTOGRAM_BYTES_PER_SEGMENT = 8 * (sum(FEATURE_BINS.values()) + 3 * max(FEATURE_BINS.values()))
+
+# Loaded indexes kept in memory, keyed by index directory
+_loaded_indexes = {}
+
+
+def extract_notes_by_channel(mid, channels=CHANNELS):
+    """
+    Collects the melody notes of several channels in a single pass over the tracks.
+
+    Equivalent to calling tesmidi.extract_melody_track_by_channel once per channel.
+
+    Args:
+        mid: Parsed mido.MidiFile
+        channels: Channels to collect
+
+    Returns:
+        Dictionary of channel -> list of note numbers
+    """
+    notes = {channel: [] for channel in channels}
+    for track in mid.tracks:
+        for msg in track:
+            if msg.type == 'note_on' and msg.velocity > 0 and msg.channel in notes:
+                notes[msg.channel].append(msg.note)
+    return notes
+
+
+def extract_timed_notes_by_channel(mid, channels=CHANNELS):
+    """
+    Collects the melody notes of several channels together with their ticks, in a single pass.
+
+    The tick is the running sum of message times over all tracks one after
+    another, as in tesmidi.extract_notes_and_timing_by_channel.
+
+    Returns:
+        Dictionary of channel -> (list of note numbers, int64 array of ticks)
+    """
+    notes = {channel: ([], []) for channel in channels}
+    cumulative_time = 0
+    for track in mid.tracks:
+        for msg in track:
+            cumulative_time += msg.time
+            if msg.type == 'note_on' and msg.velocity > 0 and msg.channel in notes:
+                notes[msg.channel][0].append(msg.note)
+                notes[msg.channel][1].append(cumulative_time)
+    return {channel: (pitches, np.array(ticks, dtype=np.int64)) for channel, (pitches, ticks) in notes.items()}
+
+
+def sliding_windows(values, segment_length=SEGMENT_LENGTH, sliding_window=SLIDING_WINDOW):
+    """
+    Cuts any per-note sequence (pitches, ticks) into the overlapping windows of segment_notes.
+
+    Returns:
+        Array of shape (n_segments, segment_length) with the dtype of values
+    """
+    step = segment_length - sliding_window
+    if len(values) < segment_length:
+        return np.empty((0, segment_length), dtype=values.dtype)
+    starts = np.arange(0, len(values) - segment_length + 1, step)
+    return values[starts[:, None] + np.arange(segment_length)]
+
+
+def segment_notes(notes, segment_length=SEGMENT_LENGTH, sliding_window=SLIDING_WINDOW):
+    """
+    Cuts a note sequence into overlapping windows.
+
+    Returns:
+        Array of shape (n_segments, segment_length)
+    """
+    return sliding_windows(np.asarray(notes, dtype=np.int16), segment_length, sliding_window)
+
+
+def normalize_segments(segments):
+    """
+    Vectorized tesmidi.normalize_segment over all rows of a segment matrix.
+
+    Each row is z-scored and rescaled to 0-127; rows with zero variance are
+    left unchanged.
+
+    Returns:
+        uint8 array with the same shape as segments
+    """
+    segments = np.asarray(segments, dtype=float)
+    if segments.size == 0:
+        return segments.astype(np.uint8)
+
+    clipped, flat = _scale_rows(segments)
+    clipped[flat] = segments[flat]
+    return clipped.astype(np.uint8)
+
+
+def normalize_timing_segments(segments, flat_value=None):
+    """
+    Vectorized tesmidi.normalize_segment2 for the time values of all rows of a segment matrix.
+
+    Rows with zero variance (evenly spaced notes) keep their tick values, as
+    in normalize_segment2, or are set to flat_value. Ticks do not fit the
+    0-127 histogram bins, so the index stores such rows as 0.
+
+    Returns:
+        int64 array with the same shape as segments
+    """
+    segments = np.asarray(segments, dtype=float)
+    if segments.size == 0:
+        return segments.astype(np.int64)
+
+    clipped, flat = _scale_rows(segments)
+    clipped[flat] = segments[flat] if flat_value is None else flat_value
+    return clipped.astype(np.int64)
+
+
+def _scale_rows(segments):
+    """Z-scores every row and rescales it to rounded 0-127 values; also returns the mask of zero-variance rows."""
+    mean = np.mean(segments, axis=1, keepdims=True)
+    std = np.std(segments, axis=1, keepdims=True)
+    flat = (std == 0).ravel()
+    std[std == 0] = 1
+
+    normalized = (segments - mean) / std
+    min_val = np.min(normalized, axis=1, keepdims=True)
+    max_val = np.max(normalized, axis=1, keepdims=True)
+    span = max_val - min_val
+    span[span == 0] = 1
+    scaled = ((normalized - min_val) * (127 - 0) / span + 0)
+    return np.clip(np.round(scaled), 0, 127), flat
+
+
+def delta_ticks(ticks):
+    """
+    Time since the previous note of the channel, the first note counting from tick 0.
+    """
+    return np.diff(np.asarray(ticks, dtype=np.int64), prepend=0)
+
+
+def timing_segments(ticks, segment_length=SEGMENT_LENGTH, sliding_window=SLIDING_WINDOW):
+    """
+    Cuts the delta and onset times of one channel into the windows of segment_notes and normalizes them.
+
+    Returns:
+        Dictionary with 'delta' and 'onset' uint8 arrays of shape (n_segments, segment_length)
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    return {
+        'delta': normalize_timing_segments(sliding_windows(delta_ticks(ticks), segment_length, sliding_window), 0).astype(np.uint8),
+        'onset': normalize_timing_segments(sliding_windows(ticks, segment_length, sliding_window), 0).astype(np.uint8),
+    }
+
+
+def _row_histograms(values, n_bins, counts=False):
+    """Counts values (already shifted to 0..n_bins-1) per row and normalizes each row (unless counts)."""
+    n_rows, n_values = values.shape
+    offsets = (np.arange(n_rows) * n_bins)[:, None]
+    row_counts = np.bincount((values + offsets).ravel(), minlength=n_rows * n_bins).reshape(n_rows, n_bins)
+    return row_counts if counts else row_counts / max(n_values, 1)
+
+
+def create_histograms(segments, counts=False):
+    """
+    Builds the ATB, RTB and FTB histograms of every segment at once.
+
+    Matches tesmidi.create_atb_histogram / create_rtb_histogram / create_ftb_histogram.
+
+    Args:
+        segments: uint8 array of normalized segments
+        counts: Return the integer counts instead of histograms normalized to sum 1
+
+    Returns:
+        Dictionary of feature -> float64 array of shape (n_segments, bins)
+    """
+    segments = np.asarray(segments, dtype=np.int16)
+    if len(segments) == 0:
+        return {feature: np.zeros((0, FEATURE_BINS[feature])) for feature in FEATURES}
+
+    return {
+        'atb': _row_histograms(segments, 128, counts),
+        'rtb': _row_histograms(np.diff(segments, axis=1) + 127, 255, counts),
+        'ftb': _row_histograms(segments[:, 1:] - segments[:, :1] + 127, 255, counts),
+    }
+
+
+def create_timing_histograms(timing, counts=False):
+    """
+    Builds the DTB and OTB histograms of every segment at once.
+
+    Args:
+        timing: Dictionary with the 'delta' and 'onset' uint8 arrays of timing_segments
+        counts: Return the integer counts instead of normalized histograms
+
+    Returns:
+        Dictionary of feature -> float64 array of shape (n_segments, bins)
+    """
+    return {
+        'dtb': _row_histograms(np.asarray(timing['delta'], dtype=np.int64), TIMING_BINS['dtb'], counts),
+        'otb': _row_histograms(np.asarray(timing['onset'], dtype=np.int64), TIMING_BINS['otb'], counts),
+    }
+
+
+def query_histograms(segments, timing=None):
+    """
+    Histograms of the query segments of one channel, with the timing histograms when timing is given.
+    """
+    histograms = create_histograms(segments)
+    if timing is not None:
+        histograms.update(create_timing_histograms(timing))
+    return histograms
+
+
+def parse_midi_bytes(data):
+    """
+    Parses a MIDI file held in memory, without writing it to disk.
+    """
+    with stage_timer('midi_parse'):
+        return mido.MidiFile(file=io.BytesIO(data))
+
+
+def featurize_midi(mid, channels=CHANNELS):
+    """
+    Parses the notes of a MIDI file once and segments every channel.
+
+    Args:
+        mid: Parsed mido.MidiFile
+        channels: Channels to featurize
+
+    Returns:
+        Dictionary of channel -> uint8 array of normalized segments
+        (channels without a full segment are left out)
+    """
+    features = {}
+    with stage_timer('segmentation'):
+        for channel, notes in extract_notes_by_channel(mid, channels).items():
+            segments = normalize_segments(segment_notes(notes))
+            if len(segments):
+                features[channel] = segments
+    return features
+
+
+def featurize_midi_timed(mid, channels=CHANNELS):
+    """
+    Featurizes a MIDI file like featurize_midi and also cuts the timing of the same windows.
+
+    Delta and onset times come from the same pass over the messages as the
+    notes, so every timing row belongs to the segment with the same row.
+
+    Returns:
+        Tuple of (channel -> segments, channel -> timing_segments dictionary)
+    """
+    features, timing = {}, {}
+    with stage_timer('segmentation'):
+        for channel, (notes, ticks) in extract_timed_notes_by_channel(mid, channels).items():
+            segments = normalize_segments(segment_notes(notes))
+            if len(segments):
+                features[channel] = segments
+                timing[channel] = timing_segments(ticks)
+    return features, timing
+
+
+def timing_from_file(file_path):
+    """
+    Returns the channel -> timing_segments dictionary of a MIDI file, or None if it cannot be parsed.
+    """
+    try:
+        with stage_timer('midi_parse'):
+            mid = mido.MidiFile(file_path)
+        return featurize_midi_timed(mid)[1]
+    except Exception as e:
+        print(f"DEBUG: Cannot read the timing of {file_path}: {e}")
+        return None
+
+
+def featurize_midi_file(file_path):
+    """
+    Featurizes one MIDI file, for use in a worker process.
+
+    Returns:
+        Tuple of (file_name, features or None, error message or None)
+    """
+    file_name = os.path.basename(file_path)
+    try:
+        with stage_timer('midi_parse'):
+            mid = mido.MidiFile(file_path)
+        return file_name, featurize_midi(mid), None
+    except Exception as e:
+        return file_name, None, str(e)
+
+
+def list_midi_files(audio_folder):
+    """
+    Lists the dataset songs in a folder, leaving out the uploaded query.
+    """
+    return sorted(
+        f for f in os.listdir(audio_folder)
+        if f.endswith('.mid') and f != INPUT_FILE
+    )
+
+
+def inverse_norms(histograms):
+    """
+    Inverse L2 norm of every row (0 for empty rows), so cosine similarity is a single matrix product.
+    """
+    norms = np.linalg.norm(histograms, axis=1)
+    return np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+
+
+def song_means(histograms, inv_norm, offsets):
+    """
+    Mean of the L2-normalized histograms of every song.
+
+    The dot product of two such means is the average cosine similarity over
+    all segment pairs, which makes a cheap summary score for a song.
+
+    Returns:
+        Array of shape (n_songs, n_bins)
+    """
+    normalized = np.asarray(histograms) * np.asarray(inv_norm)[:, None]
+    sums = np.vstack([np.zeros((1, normalized.shape[1])), np.cumsum(normalized, axis=0)])
+    lengths = np.diff(offsets)
+    return (sums[offsets[1:]] - sums[offsets[:-1]]) / np.maximum(lengths, 1)[:, None]
+
+
+def estimate_write_bytes(song_features, channels=CHANNELS):
+    """
+    Estimates the peak memory of write_audio_index when every channel is histogrammed in one piece.
+    """
+    largest = max(
+        (sum(len(features[channel]) for features in song_features if channel in features) for channel in channels),
+        default=0
+    )
+    return largest * HISTOGRAM_BYTES_PER_SEGMENT
+
+
+def _song_blocks(lengths, block_rows):
+    """Groups consecutive songs into blocks of at most block_rows segments (at least one song each)."""
+    blocks, first, rows = [], 0, 0
+    for end, length in enumerate(lengths):
+        if end > first and rows + length > block_rows:
+            blocks.append((first, end))
+            first, rows = end, 0
+        rows += length
+    if first < len(lengths):
+        blocks.append((first, len(lengths)))
+    return blocks
+
+
+def song_content_hash(features, timing=None):
+    """
+    Hashes the featurized content of a song: the segments (and timing segments) of every channel.
+
+    Files that only differ in what featurization drops (track names, tempo,
+    channels outside CHANNELS, ...) get the same hash.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for channel in sorted(features):
+        segments = np.ascontiguousarray(features[channel], dtype=np.uint8)
+        digest.update(np.array([channel, len(segments)], dtype=np.int64).tobytes())
+        digest.update(segments.tobytes())
+        if timing is not None:
+            for kind in ('delta', 'onset'):
+                digest.update(np.ascontiguousarray(timing[channel][kind], dtype=np.uint8).tobytes())
+    return digest.hexdigest()
+
+
+def duplicate_songs(song_features, song_timing=None):
+    """
+    Finds songs whose featurized content is identical.
+
+    Returns:
+        int32 array mapping every song to the first song with the same
+        content (itself when it is the first)
+    """
+    first = {}
+    alias_of = np.empty(len(song_features), dtype=np.int32)
+    for song_id, features in enumerate(song_features):
+        key = song_content_hash(features, song_timing[song_id] if song_timing is not None else None)
+        alias_of[song_id] = first.setdefault(key, song_id)
+    return alias_of
+
+
+def unique_rows(segments, timing=None):
+    """
+    Numbers the distinct segments of a channel in order of first occurrence.
+
+    With timing, a segment is only a duplicate if its delta and onset rows
+    match as well.
+
+    Returns:
+        Tuple of (int32 reference of every segment to its distinct row,
+        boolean mask of the first occurrence of every distinct row)
+    """
+    keys = segments if timing is None else np.concatenate([segments, timing['delta'], timing['onset']], axis=1)
+    if len(keys) == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=bool)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int32)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(first), dtype=np.int32)
+    is_first = np.zeros(len(keys), dtype=bool)
+    is_first[first] = True
+    return rank[inverse.reshape(-1)], is_first
+
+
+def write_audio_index(out_dir, songs, song_features, channels=CHANNELS, block_rows=None, song_timing=None,
+                      precision='float64', dedup=True):
+    """
+    Writes featurized songs as one set of .npy matrices per channel.
+
+    Args:
+        out_dir: Directory to write the index into
+        songs: Song names, in index order
+        song_features: List of channel -> segments dictionaries, aligned with songs
+        block_rows: Segments histogrammed at a time, or None to histogram every
+            channel in one piece. Blocks hold whole songs and are written
+            straight into the memory-mapped output files, so memory stays
+            around block_rows * HISTOGRAM_BYTES_PER_SEGMENT however large the
+            catalog is.
+        song_timing: Optional list of channel -> timing_segments dictionaries,
+            aligned with songs; the DTB and OTB histograms are stored as well
+        precision: How the histogram matrices are stored (one of PRECISIONS).
+            float32 and float16 round the histograms; uint8 stores the exact
+            note counts of every bin, whose row norms are folded into the
+            per-row inverse norms. Inverse norms and song means are float32
+            for every precision except float64.
+        dedup: Store songs with identical content once: later copies become
+            aliases of the first (alias_of.npy) and get no rows of their own.
+            Identical segments of a channel share one histogram row; ch{c}_rows.npy
+            maps every segment to its row.
+    """
+    alias_of = duplicate_songs(song_features, song_timing) if dedup else np.arange(len(songs), dtype=np.int32)
+    representative = alias_of == np.arange(len(songs))
+    np.save(os.path.join(out_dir, ALIASES_FILE), alias_of)
+    stored_rows = {}
+    features = FEATURES + (TIMING_FEATURES if song_timing is not None else ())
+    bins = {**FEATURE_BINS, **TIMING_BINS}
+    dtypes = {'': HISTOGRAM_DTYPES[precision]}
+    dtypes['_inv_norm'] = dtypes['_mean'] = np.float64 if precision == 'float64' else np.float32
+    for channel in channels:
+        song_ids = [i for i, features in enumerate(song_features) if channel in features and representative[i]]
+        lengths = [len(song_features[i][channel]) for i in song_ids]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+        segments = (
+            np.concatenate([song_features[i][channel] for i in song_ids])
+            if song_ids else np.empty((0, SEGMENT_LENGTH), dtype=np.uint8)
+        )
+        np.save(os.path.join(out_dir, f'ch{channel}_songs.npy'), np.array(song_ids, dtype=np.int32))
+        np.save(os.path.join(out_dir, f'ch{channel}_offsets.npy'), offsets)
+        np.save(os.path.join(out_dir, f'ch{channel}_segments.npy'), segments)
+        if song_timing is not None:
+            timing = {
+                kind: np.concatenate([song_timing[i][channel][kind] for i in song_ids])
+                if song_ids else np.empty((0, SEGMENT_LENGTH), dtype=np.uint8)
+                for kind in ('delta', 'onset')
+            }
+            for kind, values in timing.items():
+                np.save(os.path.join(out_dir, f'ch{channel}_{kind}.npy'), values)
+
+        if dedup:
+            refs, is_first = unique_rows(segments, timing if song_timing is not None else None)
+            np.save(os.path.join(out_dir, f'ch{channel}_rows.npy'), refs)
+            n_rows = int(is_first.sum())
+        else:
+            n_rows = len(segments)
+        stored_rows[channel] = (len(segments), n_rows)
+
+        outputs = {}
+        for feature in features:
+            shapes = {
+                '': (n_rows, bins[feature]),
+                '_inv_norm': (n_rows,),
+                '_mean': (len(song_ids), bins[feature]),
+            }
+            for suffix, shape in shapes.items():
+                outputs[feature + suffix] = np.lib.format.open_memmap(
+                    os.path.join(out_dir, f'ch{channel}_{feature}{suffix}.npy'), mode='w+', dtype=dtypes[suffix],
+                    shape=shape
+                )
+
+        for first, end in _song_blocks(lengths, block_rows or max(len(segments), 1)):
+            rows = slice(offsets[first], offsets[end])
+            block = create_histograms(segments[rows], counts=True)
+            if song_timing is not None:
+                block.update(create_timing_histograms({kind: values[rows] for kind, values in timing.items()}, True))
+            for feature, counts in block.items():
+                histograms = counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+                inv_norm = inverse_norms(histograms)
+                outputs[f'{feature}_mean'][first:end] = song_means(
+                    histograms, inv_norm, offsets[first:end + 1] - offsets[first]
+                )
+                target = rows
+                if dedup:
+                    # Only the first occurrence of a row is written; the others refer to it
+                    keep = is_first[rows]
+                    target = refs[rows][keep]
+                    counts, histograms, inv_norm = counts[keep], histograms[keep], inv_norm[keep]
+                if precision == 'float64':
+                    outputs[feature][target] = histograms
+                    outputs[f'{feature}_inv_norm'][target] = inv_norm
+                else:
+                    # Norms of the values as stored, so stored rows still have cosine 1 with themselves
+                    stored = counts if precision == 'uint8' else histograms.astype(dtypes[''])
+                    outputs[feature][target] = stored
+                    outputs[f'{feature}_inv_norm'][target] = inverse_norms(stored.astype(np.float64))
+        for output in outputs.values():
+            output.flush()
+        del outputs
+
+    with open(os.path.join(out_dir, META_FILE), 'w') as f:
+        json.dump({
+            "version": f"{time.time_ns():x}",
+            "songs": songs,
+            "channels": channels,
+            "segment_length": SEGMENT_LENGTH,
+            "sliding_window": SLIDING_WINDOW,
+            "timing": song_timing is not None,
+            "precision": precision,
+            "dedup": dedup,
+        }, f, indent=4)
+    if dedup:
+        n_segments = sum(total for total, _ in stored_rows.values())
+        n_unique = sum(unique for _, unique in stored_rows.values())
+        print(f"DEBUG: {len(songs) - int(representative.sum())} duplicate songs stored as aliases; "
+              f"{n_unique} distinct rows for {n_segments} segments")
+
+
+def blocks_for_budget(song_features, budget):
+    """
+    Returns the block_rows write_audio_index should use to stay within budget bytes,
+    or None if the whole catalog fits.
+    """
+    if budget is None or estimate_write_bytes(song_features) <= budget:
+        return None
+    return max(int(budget // HISTOGRAM_BYTES_PER_SEGMENT), 1)
+
+
+def build_audio_index(audio_folder, out_dir, workers=1, progress=None, timings=None, memory=None, budget=None,
+                      precision='float64', dedup=True):
+    """
+    Featurizes every song of the catalog and writes the audio feature index.
+
+    Args:
+        audio_folder: Folder containing the .mid files
+        out_dir: Directory to write the index into
+        workers: Number of processes used to parse the MIDI files
+        progress: Optional callback(done, total) called while parsing
+        timings: Optional dictionary that receives the seconds spent per stage
+        memory: Optional list that receives the memory used per stage (see memory_stats.track_memory)
+        budget: Soft memory budget in bytes; histograms are written in blocks
+            when writing them in one piece would need more
+        precision: Storage precision of the histograms (see write_audio_index)
+        dedup: Store duplicate songs and segments once (see write_audio_index)
+
+    Returns:
+        Tuple of (indexed song names, list of (file_name, error) for skipped files)
+    """
+    timings = {} if timings is None else timings
+    paths = [os.path.join(audio_folder, f) for f in list_midi_files(audio_folder)]
+
+    start = time.perf_counter()
+    with track_memory('parse+segment', memory, files=len(paths)):
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(featurize_midi_file, paths, chunksize=8)
+                parsed = _collect(results, len(paths), progress)
+        else:
+            parsed = _collect(map(featurize_midi_file, paths), len(paths), progress)
+    timings['parse+segment'] = time.perf_counter() - start
+
+    songs, song_features, skipped = [], [], []
+    for file_name, features, error in parsed:
+        if error is not None:
+            print(f"Skipping corrupted file: {file_name}. Error: {error}")
+            skipped.append((file_name, error))
+        elif features:
+            songs.append(file_name)
+            song_features.append(features)
+
+    block_rows = blocks_for_budget(song_features, budget)
+    if block_rows:
+        print(f"DEBUG: Histograms need ~{estimate_write_bytes(song_features) / 2**20:.0f} MiB, more than the "
+              f"{budget / 2**20:.0f} MiB budget; writing in blocks of {block_rows} segments")
+
+    start = time.perf_counter()
+    with track_memory('histogram+write', memory, mode='blocked' if block_rows else 'in-memory', block_rows=block_rows):
+        write_audio_index(out_dir, songs, song_features, block_rows=block_rows, precision=precision, dedup=dedup)
+    timings['histogram+write'] = time.perf_counter() - start
+
+    return songs, skipped
+
+
+def _collect(results, total, progress):
+    parsed = []
+    for result in results:
+        parsed.append(result)
+        if progress:
+            progress(len(parsed), total)
+    return parsed
+
+
+def open_audio_index(index_dir):
+    """
+    Opens an audio feature index directory.
+
+    Every matrix is memory-mapped read-only. Generations are never modified
+    after they are published, so all worker processes share one copy of the
+    matrices through the page cache instead of each holding its own.
+
+    Returns:
+        Dictionary with version, songs, timing (whether the timing features
+        are stored), precision, dedup, alias_of and aliases (representative
+        song id -> ids of its duplicates) and one entry per channel holding
+        the song ids, offsets, segments and feature matrices, or None if missing
+    """
+    meta_path = os.path.join(index_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+
+    timed = meta.get("timing", False)
+    features = FEATURES + (TIMING_FEATURES if timed else ())
+    index = {
+        "version": meta["version"], "songs": meta["songs"], "timing": timed,
+        "precision": meta.get("precision", 'float64'), "dedup": meta.get("dedup", False), "channels": {}
+    }
+    aliases_path = os.path.join(index_dir, ALIASES_FILE)
+    index["alias_of"] = (
+        np.load(aliases_path, mmap_mode='r') if os.path.exists(aliases_path) else np.arange(len(meta["songs"]), dtype=np.int32)
+    )
+    index["aliases"] = {}
+    for song_id in np.flatnonzero(index["alias_of"] != np.arange(len(meta["songs"]))):
+        index["aliases"].setdefault(int(index["alias_of"][song_id]), []).append(int(song_id))
+    for channel in meta["channels"]:
+        data = {
+            name: np.load(os.path.join(index_dir, f'ch{channel}_{name}.npy'), mmap_mode='r')
+            for name in ('songs', 'offsets', 'segments') + (('delta', 'onset') if timed else ()) + features
+        }
+        if index["dedup"]:
+            data['rows'] = np.load(os.path.join(index_dir, f'ch{channel}_rows.npy'), mmap_mode='r')
+        for feature in features:
+            norms_path = os.path.join(index_dir, f'ch{channel}_{feature}_inv_norm.npy')
+            if os.path.exists(norms_path):
+                data[f'{feature}_inv_norm'] = np.load(norms_path, mmap_mode='r')
+            else:
+                # Generations written before the norms were stored
+                data[f'{feature}_inv_norm'] = inverse_norms(np.asarray(data[feature], dtype=np.float64))
+            means_path = os.path.join(index_dir, f'ch{channel}_{feature}_mean.npy')
+            if os.path.exists(means_path):
+                data[f'{feature}_mean'] = np.load(means_path, mmap_mode='r')
+            else:
+                data[f'{feature}_mean'] = song_means(data[feature], data[f'{feature}_inv_norm'], data['offsets'])
+        index["channels"][channel] = data
+    return index
+
+
+def load_audio_index(audio_folder=AUDIO_FOLDER):
+    """
+    Returns the live audio feature index of a folder.
+
+    Only the CURRENT pointer is checked on every call; a newly published
+    generation is opened on the first call after the pointer flipped.
+    """
+    token = file_token(pointer_path(audio_folder))
+    cached = _loaded_indexes.get(audio_folder)
+    if cached is not None and cached[0] == token:
+        return cached[1]
+
+    directory = live_index_dir(audio_folder)
+    index = open_audio_index(directory) if directory else None
+    _loaded_indexes[audio_folder] = (token, index)
+    return index
+
+
+def song_features_from_index(index, song_id):
+    """
+    Returns the channel -> segments dictionary stored for one indexed song.
+
+    Aliases return the segments of the song they duplicate.
+    """
+    song_id = index["alias_of"][song_id]
+    features = {}
+    for channel, data in index["channels"].items():
+        position = np.searchsorted(data['songs'], song_id)
+        if position < len(data['songs']) and data['songs'][position] == song_id:
+            features[channel] = data['segments'][data['offsets'][position]:data['offsets'][position + 1]]
+    return features
+
+
+def song_timing_from_index(index, song_id):
+    """
+    Returns the channel -> timing_segments dictionary stored for one song of a timed index.
+    """
+    song_id = index["alias_of"][song_id]
+    timing = {}
+    for channel, data in index["channels"].items():
+        position = np.searchsorted(data['songs'], song_id)
+        if position < len(data['songs']) and data['songs'][position] == song_id:
+            rows = slice(data['offsets'][position], data['offsets'][position + 1])
+            timing[channel] = {'delta': data['delta'][rows], 'onset': data['onset'][rows]}
+    return timing
+
+
+def add_songs_to_index(audio_folder, new_songs, budget=None):
+    """
+    Adds featurized songs to the live audio index and publishes the result as a new generation.
+
+    Songs with the same name as an indexed one replace it. When the index
+    stores timing features, the timing of the new songs is read from their
+    files in audio_folder; a song whose timing cannot be read is left out
+    (and an indexed song it replaces removed) instead of dropping the
+    timing of every song. The precision and deduplication of the live
+    index are kept; duplicates are found again over all songs. A song
+    neighbour table of the live index is carried forward (see
+    song_neighbours.carry_song_neighbours).
+
+    Args:
+        audio_folder: Folder containing the .mid files
+        new_songs: List of (file_name, channel -> segments dictionary)
+        budget: Soft memory budget in bytes for writing the histograms (see build_audio_index)
+
+    Returns:
+        Number of songs in the new index, or None if there is no live index yet
+    """
+    with update_lock(audio_folder):
+        index = load_audio_index(audio_folder)
+        if index is None:
+            return None
+
+        replaced = {name for name, _ in new_songs}
+        songs, song_features, song_timing = [], [], [] if index["timing"] else None
+        for song_id, name in enumerate(index["songs"]):
+            if name not in replaced:
+                songs.append(name)
+                song_features.append(song_features_from_index(index, song_id))
+                if song_timing is not None:
+                    song_timing.append(song_timing_from_index(index, song_id))
+        for name, features in new_songs:
+            if song_timing is not None:
+                timing = timing_from_file(os.path.join(audio_folder, name))
+                if timing is None or any(
+                    channel not in timing or len(timing[channel]['delta']) != len(segments)
+                    for channel, segments in features.items()
+                ):
+                    # The index stores timing for every song, so this one waits for the next full build
+                    print(f"ERROR: No timing features for {name}; it is left out of the audio index")
+                    continue
+                song_timing.append(timing)
+            songs.append(name)
+            song_features.append(features)
+
+        out_dir = staging_dir(audio_folder)
+        write_audio_index(out_dir, songs, song_features, block_rows=blocks_for_budget(song_features, budget),
+                          song_timing=song_timing, precision=index["precision"], dedup=index["dedup"])
+        # Imported here because song_neighbours builds on this module
+        from .song_neighbours import carry_song_neighbours
+        carry_song_neighbours(live_index_dir(audio_folder), out_dir, replaced)
+        swap_index(audio_folder, out_dir)
+        return len(songs)
+
+
+def _channel_arrays(data):
+    """Names of the per-segment, per-row and per-song arrays stored for one channel."""
+    features = FEATURES + (TIMING_FEATURES if 'dtb' in data else ())
+    segments = ('segments',) + (('delta', 'onset') if 'delta' in data else ())
+    rows = features + tuple(f'{feature}_inv_norm' for feature in features)
+    return segments, rows, tuple(f'{feature}_mean' for feature in features)
+
+
+def _take_rows(part, data, segments):
+    """Copies the per-segment and per-row arrays of the segments selected by segments (a slice or index array)."""
+    segment_arrays, row_arrays, _ = _channel_arrays(data)
+    for name in segment_arrays:
+        part[name] = data[name][segments]
+    if 'rows' not in data:
+        for name in row_arrays:
+            part[name] = data[name][segments]
+        return
+    # Deduplicated: keep the distinct rows the segments refer to and renumber the references
+    used, refs = np.unique(data['rows'][segments], return_inverse=True)
+    part['rows'] = refs.reshape(-1).astype(np.int32)
+    for name in row_arrays:
+        part[name] = data[name][used]
+
+
+def slice_audio_index(index, first_song, end_song):
+    """
+    Restricts an audio index to the songs with ids in [first_song, end_song).
+
+    Each channel stores its songs contiguously, so the matrices are sliced
+    without copying; a shard only touches the pages of its own songs. The
+    distinct rows of a deduplicated index are gathered into new arrays.
+
+    Returns:
+        Index with the same layout as open_audio_index
+    """
+    sliced = {key: value for key, value in index.items() if key != "channels"}
+    sliced["channels"] = {}
+    for channel, data in index["channels"].items():
+        low, high = np.searchsorted(data['songs'], [first_song, end_song])
+        start, end = data['offsets'][low], data['offsets'][high]
+        part = {'songs': data['songs'][low:high], 'offsets': data['offsets'][low:high + 1] - start}
+        _take_rows(part, data, slice(start, end))
+        for name in _channel_arrays(data)[2]:
+            part[name] = data[name][low:high]
+        sliced["channels"][channel] = part
+    return sliced
+
+
+def select_audio_index(index, song_ids):
+    """
+    Restricts an audio index to an arbitrary set of songs.
+
+    Unlike slice_audio_index the rows are gathered into new arrays, so this
+    is meant for small sets such as one step of anytime_search.
+
+    Returns:
+        Index with the same layout as open_audio_index
+    """
+    song_ids = np.sort(np.asarray(song_ids, dtype=np.int32))
+    selected = {key: value for key, value in index.items() if key != "channels"}
+    selected["channels"] = {}
+    for channel, data in index["channels"].items():
+        positions = np.flatnonzero(np.isin(data['songs'], song_ids))
+        starts, ends = data['offsets'][positions], data['offsets'][positions + 1]
+        rows = np.concatenate([np.arange(first, end) for first, end in zip(starts, ends)] + [np.empty(0, np.int64)])
+        part = {
+            'songs': data['songs'][positions],
+            'offsets': np.concatenate([[0], np.cumsum(ends - starts)]).astype(np.int64),
+        }
+        _take_rows(part, data, rows)
+        for name in _channel_arrays(data)[2]:
+            part[name] = data[name][positions]
+        selected["channels"][channel] = part
+    return selected
+
+
+def cosine_similarities(query_histograms, data, feature):
+    """
+    Cosine similarity of every query segment with every indexed segment.
+
+    float64 matrices are scored in float64. float32 matrices are multiplied
+    as they are, float16 and uint8 ones in blocks of SCORE_BLOCK_ROWS rows
+    converted to float32, so only the compact form is read from the index.
+
+    Returns:
+        Array of shape (n_query_segments, n_indexed_segments), float32 for compact matrices
+    """
+    query = np.asarray(query_histograms, dtype=float)
+    query_norms = np.linalg.norm(query, axis=1)
+    query_inv = np.divide(1.0, query_norms, out=np.zeros_like(query_norms), where=query_norms > 0)
+    matrix = data[feature]
+    if matrix.dtype == np.float64:
+        return (query @ matrix.T) * query_inv[:, None] * data[f'{feature}_inv_norm'][None, :]
+
+    # Compact matrices are scored in float32: the unit-length query against the rows as stored
+    query = (query * query_inv[:, None]).astype(np.float32)
+    if matrix.dtype == np.float32:
+        products = query @ matrix.T
+    else:
+        products = np.empty((len(query), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), SCORE_BLOCK_ROWS):
+            block = matrix[start:start + SCORE_BLOCK_ROWS]
+            products[:, start:start + len(block)] = query @ block.astype(np.float32).T
+    products *= data[f'{feature}_inv_norm'][None, :]
+    return products
+
+
+def segment_similarities(query_histograms, data, feature):
+    """
+    cosine_similarities for every indexed segment of a channel.
+
+    A deduplicated channel scores each distinct row once; the similarities
+    are then looked up per segment through its reference table.
+    """
+    similarities = cosine_similarities(query_histograms, data, feature)
+    if 'rows' in data:
+        return similarities[:, np.asarray(data['rows'])]
+    return similarities
+
+
+def segment_max_per_song(similarities, offsets):
+    """
+    For every query segment, keeps the best match within each song.
+
+    Returns:
+        Array of shape (n_query_segments, n_songs)
+    """
+    if similarities.shape[1] == 0:
+        return np.zeros((similarities.shape[0], 0))
+    return np.maximum.reduceat(similarities, offsets[:-1], axis=1)
+
+
+def _use_timing(data, query_timing, timing_weight):
+    return bool(timing_weight) and query_timing is not None and 'dtb' in data
+
+
+def weighted_similarities(histograms, data, timing_weight=0.0):
+    """
+    Best weighted similarity of every query segment within every song of one channel.
+
+    ATB, RTB and FTB are weighted with WEIGHTS. When the query histograms
+    include DTB and OTB, their similarity (weighted with TIMING_WEIGHTS) makes
+    up timing_weight of the score.
+
+    Returns:
+        Array of shape (n_query_segments, n_songs)
+    """
+    weighted = sum(
+        WEIGHTS[feature] * segment_max_per_song(
+            segment_similarities(histograms[feature], data, feature), data['offsets']
+        )
+        for feature in FEATURES
+    )
+    if timing_weight and 'dtb' in histograms:
+        timing = sum(
+            TIMING_WEIGHTS[feature] * segment_max_per_song(
+                segment_similarities(histograms[feature], data, feature), data['offsets']
+            )
+            for feature in TIMING_FEATURES
+        )
+        weighted = (1 - timing_weight) * weighted + timing_weight * timing
+    return weighted
+
+
+def score_query(index, query_features, query_timing=None, timing_weight=0.0):
+    """
+    Scores a featurized query against the index, channel by channel.
+
+    Mirrors tesmidi.process_channel_similarities: for each query segment the
+    best ATB, RTB and FTB similarity per song is weighted and kept.
+
+    Args:
+        index: Audio index returned by load_audio_index
+        query_features: Channel -> segments dictionary from featurize_midi
+        query_timing: Optional channel -> timing_segments dictionary from featurize_midi_timed
+        timing_weight: Share of the timing similarity in the score (used when the index stores timing)
+
+    Returns:
+        Dictionary of channel -> {song_name: [weighted similarity per query segment]};
+        aliases get the similarities of the song they duplicate
+    """
+    aliases = index.get("aliases", {})
+    results = {}
+    for channel, data in index["channels"].items():
+        segments = query_features.get(channel)
+        if segments is None or len(segments) == 0:
+            results[channel] = {}
+            continue
+
+        timing = query_timing.get(channel) if _use_timing(data, query_timing, timing_weight) else None
+        with stage_timer('histogram'):
+            histograms = query_histograms(segments, timing)
+        start = time.perf_counter()
+        weighted = weighted_similarities(histograms, data, timing_weight)
+        results[channel] = {}
+        for column, song_id in enumerate(data['songs']):
+            similarities = weighted[:, column].tolist()
+            for member in [song_id] + aliases.get(int(song_id), []):
+                results[channel][index["songs"][member]] = similarities
+        record_channel_score(channel, time.perf_counter() - start)
+    return results
+
+
+def overall_similarities(channel_results):
+    """
+    Combines per-channel results into one score per song.
+
+    Mirrors tesmidi.calculate_highest_similarity: the similarities of a song
+    are averaged over the query segments of each channel, then over the
+    channels the song appears in.
+
+    Args:
+        channel_results: Output of score_query
+
+    Returns:
+        Dictionary of song_name -> similarity in [0, 1]
+    """
+    per_song = {}
+    for weighted_results in channel_results.values():
+        for song_name, similarities in weighted_results.items():
+            average = sum(similarities) / len(similarities) if similarities else 0
+            per_song.setdefault(song_name, []).append(average)
+    return {song_name: sum(averages) / len(averages) for song_name, averages in per_song.items()}
+
+
+def summary_scores(index, query_features, query_timing=None, timing_weight=0.0):
+    """
+    Cheap per-song estimate of overall_similarities.
+
+    Uses the average cosine similarity over all segment pairs (a dot product
+    of mean normalized histograms) instead of the best match per segment.
+
+    Returns:
+        Array of shape (n_songs,), -inf for songs sharing no channel with the
+        query and for aliases (score_query scores them with their representative)
+    """
+    totals = np.zeros(len(index["songs"]))
+    counts = np.zeros(len(index["songs"]), dtype=np.int32)
+    for channel, data in index["channels"].items():
+        segments = query_features.get(channel)
+        if segments is None or len(segments) == 0 or len(data['songs']) == 0:
+            continue
+        timing = query_timing.get(channel) if _use_timing(data, query_timing, timing_weight) else None
+        all_histograms = query_histograms(segments, timing)
+        estimates = {}
+        for feature, histograms in all_histograms.items():
+            histograms = np.asarray(histograms, dtype=float)
+            query_mean = (histograms * inverse_norms(histograms)[:, None]).mean(axis=0)
+            estimates[feature] = np.asarray(data[f'{feature}_mean']) @ query_mean
+        estimate = sum(WEIGHTS[feature] * estimates[feature] for feature in FEATURES)
+        if timing is not None:
+            estimate = (1 - timing_weight) * estimate + timing_weight * sum(
+                TIMING_WEIGHTS[feature] * estimates[feature] for feature in TIMING_FEATURES
+            )
+        totals[data['songs']] += estimate
+        counts[data['songs']] += 1
+    return np.divide(totals, counts, out=np.full_like(totals, -np.inf), where=counts > 0)
+
+
+def anytime_search(index, query_features, budget, top_k=5, step_cells=ANYTIME_STEP_CELLS, query_timing=None,
+                   timing_weight=0.0):
+    """
+    Scores songs in order of their summary score until the time budget is spent.
+
+    Each step scores a group of songs exactly (as score_query does) and is
+    sized so that it holds at most step_cells similarities, so one step
+    takes about the same time whatever the length of the query. The first
+    step always runs; after that no new step starts once the budget is used.
+
+    Args:
+        index: Audio index returned by load_audio_index
+        query_features: Channel -> segments dictionary from featurize_midi
+        budget: Seconds available for scoring
+        top_k: Number of songs to return
+        step_cells: Upper bound on the similarities computed in one step
+        query_timing, timing_weight: Timing features of the query and their share (see score_query)
+
+    Returns:
+        Dictionary with results (list of (song_name, similarity), best
+        first), partial, scored, total and seconds
+    """
+    start = time.perf_counter()
+    priority = summary_scores(index, query_features, query_timing, timing_weight)
+    candidates = [song_id for song_id in np.argsort(-priority, kind='stable') if np.isfinite(priority[song_id])]
+
+    # Segments each song contributes to a step, over the channels of the query
+    query_rows = max(len(segments) for segments in query_features.values()) if query_features else 1
+    song_rows = np.zeros(len(index["songs"]), dtype=np.int64)
+    for channel, data in index["channels"].items():
+        if channel in query_features:
+            song_rows[data['songs']] += np.diff(data['offsets'])
+    max_rows = max(step_cells // max(query_rows, 1), 1)
+
+    scores, position = {}, 0
+    while position < len(candidates):
+        if scores and time.perf_counter() - start >= budget:
+            break
+        step, rows = [], 0
+        while position < len(candidates) and (not step or rows + song_rows[candidates[position]] <= max_rows):
+            step.append(candidates[position])
+            rows += song_rows[candidates[position]]
+            position += 1
+        scores.update(overall_similarities(
+            score_query(select_audio_index(index, step), query_features, query_timing, timing_weight)
+        ))
+
+    results = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return {
+        "results": results,
+        "partial": position < len(candidates),
+        "scored": position,
+        "total": len(candidates),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _query_blocks(members, max_rows):
+    """Groups (query id, segments) pairs into blocks of at most max_rows segments."""
+    block, rows = [], 0
+    for member in members:
+        if block and rows + len(member[1]) > max_rows:
+            yield block
+            block, rows = [], 0
+        block.append(member)
+        rows += len(member[1])
+    if block:
+        yield block
+
+
+def score_queries(index, queries, max_cells=MAX_BATCH_CELLS, timing=None, timing_weight=0.0):
+    """
+    Scores many featurized queries at once.
+
+    The segments of all queries are stacked per channel, so every feature
+    is one matrix-matrix product against the index instead of one product
+    per query. Queries are processed in blocks so that no more than
+    max_cells similarities are held in memory.
+
+    Args:
+        index: Audio index returned by load_audio_index
+        queries: List of channel -> segments dictionaries from featurize_midi
+        max_cells: Upper bound on the size of one similarity block
+        timing: Optional list of channel -> timing_segments dictionaries, aligned with queries
+        timing_weight: Share of the timing similarity in the score (see score_query)
+
+    Returns:
+        Array of shape (n_queries, n_songs) with the overall similarity of
+        every song (see overall_similarities), NaN where a song shares no
+        channel with the query. Aliases get the scores of the song they duplicate.
+    """
+    n_songs = len(index["songs"])
+    totals = np.zeros((len(queries), n_songs))
+    counts = np.zeros((len(queries), n_songs), dtype=np.int32)
+    for channel, data in index["channels"].items():
+        members = [
+            (query_id, features[channel]) for query_id, features in enumerate(queries)
+            if features.get(channel) is not None and len(features[channel]) > 0
+        ]
+        max_rows = max(max_cells // max(len(data['segments']), 1), 1)
+        timed = _use_timing(data, timing, timing_weight)
+        for block in _query_blocks(members, max_rows):
+            query_ids = [query_id for query_id, _ in block]
+            lengths = np.array([len(segments) for _, segments in block])
+            starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+            block_timing = {
+                kind: np.concatenate([timing[query_id][channel][kind] for query_id in query_ids])
+                for kind in ('delta', 'onset')
+            } if timed else None
+            with stage_timer('histogram'):
+                histograms = query_histograms(np.concatenate([segments for _, segments in block]), block_timing)
+            start = time.perf_counter()
+            weighted = weighted_similarities(histograms, data, timing_weight)
+            # Average over the segments of each query, as calculate_highest_similarity does
+            cells = np.ix_(query_ids, data['songs'])
+            totals[cells] += np.add.reduceat(weighted, starts, axis=0) / lengths[:, None]
+            counts[cells] += 1
+            record_channel_score(channel, time.perf_counter() - start)
+
+    scores = np.divide(totals, counts, out=np.full_like(totals, np.nan), where=counts > 0)
+    if index.get("aliases"):
+        scores = scores[:, index["alias_of"]]
+    return scores
+
+
+def cells_for_budget(budget):
+    """
+    Returns the max_cells of score_queries that keeps scoring within budget bytes (MAX_BATCH_CELLS without a budget).
+    """
+    if budget is None:
+        return MAX_BATCH_CELLS
+    return max(int(budget // BYTES_PER_CELL), 1)
+
+
+def rank_queries(index, queries, top_k=5, max_cells=MAX_BATCH_CELLS, timing=None, timing_weight=0.0):
+    """
+    Returns the top_k songs of every query, best first.
+
+    Returns:
+        List with one list of (song_name, similarity) per query
+    """
+    rankings = []
+    for scores in score_queries(index, queries, max_cells, timing, timing_weight):
+        order = np.argsort(-np.nan_to_num(scores, nan=-np.inf), kind='stable')[:top_k]
+        rankings.append([(index["songs"][i], float(scores[i])) for i in order if not np.isnan(scores[i])])
+    return rankings
+
+
+def verify_audio_index(audio_folder, index_dir, sample=10, seed=0):
+    """
+    Checks an audio index for internal consistency and against the MIDI files.
+
+    Args:
+        audio_folder: Folder containing the .mid files
+        index_dir: Index directory to check
+        sample: Number of songs to re-featurize and compare
+
+    Returns:
+        List of problems found (empty if the index is valid)
+    """
+    index = open_audio_index(index_dir)
+    if index is None:
+        return [f"No audio index in {index_dir}"]
+
+    problems = []
+    songs = index["songs"]
+    missing = [song for song in songs if not os.path.exists(os.path.join(audio_folder, song))]
+    if missing:
+        problems.append(f"{len(missing)} indexed songs are missing from {audio_folder}, e.g. {missing[0]}")
+    alias_of = index["alias_of"]
+    if len(alias_of) != len(songs) or np.any(alias_of > np.arange(len(alias_of))) or np.any(
+        alias_of[alias_of] != alias_of
+    ):
+        problems.append("Aliases do not refer to an earlier representative song")
+
+    for channel, data in index["channels"].items():
+        offsets = data['offsets']
+        if len(offsets) != len(data['songs']) + 1 or np.any(np.diff(offsets) <= 0):
+            problems.append(f"Channel {channel}: offsets are not strictly increasing per song")
+        if offsets[-1] != len(data['segments']):
+            problems.append(f"Channel {channel}: offsets do not cover {len(data['segments'])} segments")
+        if np.any(alias_of[data['songs']] != data['songs']):
+            problems.append(f"Channel {channel}: aliases have segments of their own")
+        if 'rows' in data and (
+            len(data['rows']) != len(data['segments'])
+            or len(data['rows']) and not 0 <= data['rows'].min() <= data['rows'].max() < len(data['atb'])
+        ):
+            problems.append(f"Channel {channel}: row references do not match the stored rows")
+        for feature in FEATURES + (TIMING_FEATURES if index["timing"] else ()):
+            if len(data[feature]) == 0:
+                continue
+            sums = data[feature].sum(axis=1, dtype=np.float64)
+            if index["precision"] == 'uint8':
+                # Every segment adds the same number of values to a histogram
+                normalized = np.all(sums == sums[0])
+            else:
+                normalized = np.allclose(sums, 1.0, rtol=1e-2 if index["precision"] == 'float16' else 1e-5)
+            if not normalized:
+                problems.append(f"Channel {channel}: {feature} histograms are not normalized")
+
+    rng = np.random.default_rng(seed)
+    for song_id in rng.choice(len(songs), size=min(sample, len(songs)), replace=False):
+        file_path = os.path.join(audio_folder, songs[song_id])
+        if not os.path.exists(file_path):
+            continue
+        _, features, error = featurize_midi_file(file_path)
+        if error is not None:
+            problems.append(f"{songs[song_id]}: cannot be parsed anymore ({error})")
+            continue
+        timing = timing_from_file(file_path) if index["timing"] else None
+        # An alias must match the segments stored for its representative
+        stored_id = alias_of[song_id]
+        for channel, data in index["channels"].items():
+            position = np.searchsorted(data['songs'], stored_id)
+            indexed = position < len(data['songs']) and data['songs'][position] == stored_id
+            expected = features.get(channel)
+            if not indexed:
+                if expected is not None:
+                    problems.append(f"{songs[song_id]}: channel {channel} is missing from the index")
+                continue
+            stored = data['segments'][data['offsets'][position]:data['offsets'][position + 1]]
+            if expected is None or not np.array_equal(stored, expected):
+                problems.append(f"{songs[song_id]}: channel {channel} segments differ from the MIDI file")
+            elif timing is not None and not all(
+                np.array_equal(data[kind][data['offsets'][position]:data['offsets'][position + 1]], timing[channel][kind])
+                for kind in ('delta', 'onset')
+            ):
+                problems.append(f"{songs[song_id]}: channel {channel} timing differs from the MIDI file")
+
+    return problems
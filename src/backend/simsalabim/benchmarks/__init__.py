@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+# A stage is flagged as a regression when it got this much slower than the baseline
+REGRESSION_RATIO = 1.2
+# ... and by more than this many seconds, so timer noise on tiny stages is ignored
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def time_stage(results, scale, stage, func, repeat=1, memory=False, **info):
+    """
+    Runs one benchmark stage and records its best wall-clock time.
+
+    Args:
+        results: List the measurement is appended to
+        scale: Corpus scale factor (1, 10, 100, ...)
+        stage: Stage name
+        func: Callable without arguments; its last return value is returned
+        repeat: Number of runs; the fastest one is recorded
+        memory: Whether to record the peak memory allocated by the stage.
+            It is measured in one extra run under tracemalloc, so the
+            tracing overhead does not end up in the recorded time. Python
+            and numpy allocations are traced; buffers owned by C libraries
+            (e.g. PIL image data) are not.
+        **info: Extra fields stored with the measurement (e.g. songs, segments)
+
+    Returns:
+        Return value of the last run of func
+    """
+    best, value = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    measurement = {"scale": scale, "stage": stage, "seconds": best, "repeat": repeat, **info}
+
+    line = f"DEBUG: [{scale}x] {stage_label(measurement):<32} {best:10.4f}s"
+    if memory:
+        value = None  # Release the previous result so it does not count towards the peak
+        tracemalloc.start()
+        try:
+            value = func()
+            measurement["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        line += f"  peak {measurement['peak_bytes'] / 2**20:9.1f} MiB"
+
+    results.append(measurement)
+    print(line)
+    return value
+
+
+def stage_label(entry):
+    """
+    Names a measurement, including its variant (e.g. the image format) if it has one.
+    """
+    return f"{entry['stage']} ({entry['format']})" if entry.get("format") else entry["stage"]
+
+
+def skip_stage(results, scale, stage, reason, **info):
+    """
+    Records a stage that was not run at this scale.
+    """
+    measurement = {"scale": scale, "stage": stage, "seconds": None, "skipped": reason, **info}
+    results.append(measurement)
+    print(f"DEBUG: [{scale}x] {stage_label(measurement):<32} skipped ({reason})")
+
+
+def environment_info():
+    """
+    Describes the code version and machine a benchmark ran on.
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def write_report(path, suite, results, **settings):
+    """
+    Writes the measurements of one run as JSON.
+
+    Returns:
+        The report dictionary
+    """
+    report = {"suite": suite, "environment": environment_info(), "settings": settings, "results": results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def compare_reports(report, baseline, threshold=REGRESSION_RATIO):
+    """
+    Matches the stages of two reports by scale and stage label.
+
+    Returns:
+        List of (scale, stage, baseline_seconds, seconds, ratio, regressed)
+    """
+    previous = {
+        (entry["scale"], stage_label(entry)): entry["seconds"]
+        for entry in baseline["results"] if entry.get("seconds") is not None
+    }
+    rows = []
+    for entry in report["results"]:
+        key = (entry["scale"], stage_label(entry))
+        if entry.get("seconds") is None or not previous.get(key):
+            continue
+        ratio = entry["seconds"] / previous[key]
+        regressed = ratio > threshold and entry["seconds"] - previous[key] > MIN_REGRESSION_SECONDS
+        rows.append((entry["scale"], key[1], previous[key], entry["seconds"], ratio, regressed))
+    return rows
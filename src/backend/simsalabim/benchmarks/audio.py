@@ -0,0 +1,198 @@
+import io
+import os
+import json
+import shutil
+import tempfile
+
+import mido
+
+from .. import tesmidi
+from ..audio_index import (
+    AUDIO_FOLDER, CHANNELS, FEATURES, featurize_midi, write_audio_index, open_audio_index,
+    create_histograms, segment_similarities, segment_max_per_song, score_query
+)
+from . import time_stage, skip_stage
+
+DEFAULT_SCALES = (1, 10, 100)
+
+# Songs taken from the dataset for the 1x corpus
+DEFAULT_SONGS = 5
+
+# compare_segments_to_dataset compares segments pair by pair in Python;
+# above this many songs it is skipped and the vectorized scores are used downstream
+DEFAULT_REFERENCE_LIMIT = 10
+
+QUERY_NAME = 'input.mid'
+
+
+def load_corpus(audio_folder=AUDIO_FOLDER, n_songs=DEFAULT_SONGS):
+    """
+    Reads the first n_songs readable MIDI files of a folder into memory.
+
+    Returns:
+        List of (file_name, bytes)
+    """
+    corpus = []
+    for file_name in sorted(os.listdir(audio_folder)):
+        if len(corpus) >= n_songs:
+            break
+        if not file_name.endswith('.mid') or file_name == QUERY_NAME:
+            continue
+        with open(os.path.join(audio_folder, file_name), 'rb') as f:
+            data = f.read()
+        try:
+            if featurize_midi(mido.MidiFile(file=io.BytesIO(data))):
+                corpus.append((file_name, data))
+        except Exception:
+            continue
+    return corpus
+
+
+def scale_corpus(corpus, scale):
+    """
+    Repeats a corpus scale times under distinct file names.
+    """
+    return [(f'{copy:03d}_{file_name}', data) for copy in range(scale) for file_name, data in corpus]
+
+
+def segment_notes(notes):
+    """Windowing and normalize_segment exactly as in tesmidi.process_midi_file."""
+    segments, segment_length, sliding_window, i = [], 20, 6, 0
+    while i + segment_length <= len(notes):
+        segments.append(tesmidi.normalize_segment(notes[i:i + segment_length]))
+        i += segment_length - sliding_window
+    return segments
+
+
+def _histogram_data(midi_data):
+    histograms = {feature: {} for feature in FEATURES}
+    for file_name, segments in midi_data.items():
+        histograms['atb'][file_name] = [tesmidi.create_atb_histogram(segment) for segment in segments]
+        histograms['rtb'][file_name] = [tesmidi.create_rtb_histogram(segment) for segment in segments]
+        histograms['ftb'][file_name] = [tesmidi.create_ftb_histogram(segment) for segment in segments]
+    return histograms
+
+
+def _vectorized_feature_results(index, query_features, channel):
+    # Same values as compare_segments_to_dataset, from the matrix-product scorer
+    data = index["channels"][channel]
+    segments = query_features.get(channel)
+    if segments is None or len(segments) == 0:
+        return {feature: {} for feature in FEATURES}
+    query_histograms = create_histograms(segments)
+    results = {}
+    for feature in FEATURES:
+        best = segment_max_per_song(segment_similarities(query_histograms[feature], data, feature), data['offsets'])
+        results[feature] = {index["songs"][song_id]: best[:, column].tolist() for column, song_id in enumerate(data['songs'])}
+    return results
+
+
+def run_scale(results, corpus, query, scale, work_dir, repeat=1, reference_limit=DEFAULT_REFERENCE_LIMIT):
+    """
+    Times every stage of the tesmidi pipeline, and its vectorized replacement, on one corpus size.
+    """
+    songs = scale_corpus(corpus, scale)
+    files = songs + [(QUERY_NAME, query)]
+    info = {"songs": len(songs)}
+
+    mids = time_stage(results, scale, 'parse', lambda: [mido.MidiFile(file=io.BytesIO(data)) for _, data in files],
+                      repeat, **info)
+    notes = time_stage(results, scale, 'extract_melody_track_by_channel', lambda: {
+        channel: [tesmidi.extract_melody_track_by_channel(mid, channel) for mid in mids] for channel in CHANNELS
+    }, repeat, **info)
+
+    def segment_all():
+        midi_data = {}
+        for channel in CHANNELS:
+            midi_data[channel] = {}
+            for (file_name, _), channel_notes in zip(files, notes[channel]):
+                segments = segment_notes(channel_notes) if channel_notes else []
+                if segments:
+                    midi_data[channel][file_name] = segments
+        return midi_data
+    midi_data = time_stage(results, scale, 'segment+normalize_segment', segment_all, repeat, **info)
+    info["segments"] = sum(len(segments) for data in midi_data.values() for segments in data.values())
+
+    histograms = time_stage(results, scale, 'create_atb/rtb/ftb_histogram', lambda: {
+        channel: _histogram_data(midi_data[channel]) for channel in CHANNELS
+    }, repeat, **info)
+
+    # Vectorized pipeline (audio_index)
+    query_features = featurize_midi(mido.MidiFile(file=io.BytesIO(query)))
+    song_features = time_stage(results, scale, 'vectorized featurize_midi', lambda: [
+        featurize_midi(mid) for mid in mids[:-1]
+    ], repeat, **info)
+    index_dir = os.path.join(work_dir, f'index-{scale}')
+    os.makedirs(index_dir, exist_ok=True)
+    # The scaled corpus repeats the same songs, which deduplication would collapse back to 1x
+    time_stage(results, scale, 'vectorized write_audio_index', lambda: write_audio_index(
+        index_dir, [file_name for file_name, _ in songs], song_features, dedup=False
+    ), repeat, **info)
+    index = open_audio_index(index_dir)
+    time_stage(results, scale, 'vectorized score_query', lambda: score_query(index, query_features), repeat, **info)
+
+    # Reference comparison reads the histogram JSON files like process_channel_similarities
+    for channel in CHANNELS:
+        for feature in FEATURES:
+            with open(os.path.join(work_dir, f'{feature}_histogram_channel_{channel}.json'), 'w') as f:
+                json.dump(histograms[channel][feature], f)
+
+    def compare_all():
+        return {
+            channel: {
+                feature: tesmidi.compare_segments_to_dataset(
+                    os.path.join(work_dir, f'{feature}_histogram_channel_{channel}.json')
+                )
+                for feature in FEATURES
+            }
+            for channel in CHANNELS
+        }
+    if len(songs) <= reference_limit:
+        feature_results = time_stage(results, scale, 'compare_segments_to_dataset', compare_all, repeat, **info)
+    else:
+        skip_stage(results, scale, 'compare_segments_to_dataset', f'more than {reference_limit} songs', **info)
+        feature_results = {channel: _vectorized_feature_results(index, query_features, channel) for channel in CHANNELS}
+
+    weighted = time_stage(results, scale, 'calculate_weighted_similarity', lambda: {
+        channel: tesmidi.calculate_weighted_similarity(
+            feature_results[channel]['atb'], feature_results[channel]['rtb'], feature_results[channel]['ftb']
+        )
+        for channel in CHANNELS
+    }, repeat, **info)
+
+    for channel in CHANNELS:
+        with open(os.path.join(work_dir, f'weighted_similarities_channel_{channel}.json'), 'w') as f:
+            json.dump(weighted[channel], f)
+    time_stage(results, scale, 'calculate_highest_similarity',
+               lambda: tesmidi.calculate_highest_similarity(work_dir), repeat, **info)
+
+
+def run(scales=DEFAULT_SCALES, n_songs=DEFAULT_SONGS, audio_folder=AUDIO_FOLDER, repeat=1,
+        reference_limit=DEFAULT_REFERENCE_LIMIT, corpus=None):
+    """
+    Runs the audio benchmark at every scale.
+
+    Args:
+        scales: Corpus scale factors; the 1x corpus has n_songs songs
+        n_songs: Songs in the 1x corpus
+        audio_folder: Folder the 1x corpus is read from
+        repeat: Runs per stage; the fastest is recorded
+        reference_limit: Largest corpus on which compare_segments_to_dataset runs
+        corpus: Optional list of (file_name, bytes) used instead of audio_folder
+
+    Returns:
+        List of measurements (see time_stage)
+    """
+    corpus = corpus or load_corpus(audio_folder, n_songs)
+    if not corpus:
+        raise ValueError(f"No readable MIDI files in {audio_folder}")
+    query = corpus[0][1]
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='simsalabim-bench-')
+    try:
+        for scale in scales:
+            run_scale(results, corpus, query, scale, work_dir, repeat, reference_limit)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
@@ -0,0 +1,138 @@
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from ..cover_index import (
+    PIXELS_PER_IMAGE, PCA_FILE, HASHES_FILE, NAMES_FILE, PIXELS_FILE, N_COMPONENTS,
+    list_cover_images, resize_cover, grayscale_pixels, image_to_pixels, hash_pixels, compute_pca, project_matrix,
+    projection_bounds, open_cover_index, find_similar_covers, find_similar_covers_batch
+)
+from ..synthetic_corpus import COVER_QUERIES, generate_catalog, derive_cover, item_rng
+from . import time_stage
+
+DEFAULT_SCALES = (1, 10, 100)
+
+# Covers in the 1x catalog; the catalog is generated with synthetic_corpus
+DEFAULT_COVERS = 20
+
+DEFAULT_FORMATS = ('png', 'jpg')
+
+# Queries searched per catalog size
+DEFAULT_QUERIES = 20
+
+SEED = 0
+
+
+def make_queries(catalog_dir, names, n_queries, seed=SEED):
+    """
+    Derives cropped, re-lit copies of catalog covers, decoded to pixel rows.
+
+    Returns:
+        uint8 matrix with one pixel row per query
+    """
+    rows = []
+    for item in range(n_queries):
+        rng = item_rng(seed, COVER_QUERIES, item)
+        target = names[int(rng.integers(0, len(names)))]
+        image, _ = derive_cover(Image.open(os.path.join(catalog_dir, target)), rng)
+        rows.append(image_to_pixels(image))
+    return np.stack(rows)
+
+
+def run_scale(results, catalog_dir, image_format, scale, work_dir, n_queries=DEFAULT_QUERIES,
+              n_components=N_COMPONENTS, repeat=1, memory=True):
+    """
+    Times every stage of the cover index build and search on one catalog.
+    """
+    names = list_cover_images(catalog_dir)
+    paths = [os.path.join(catalog_dir, name) for name in names]
+    info = {"format": image_format, "covers": len(names)}
+
+    images = time_stage(results, scale, 'decode+resize', lambda: [resize_cover(path) for path in paths],
+                        repeat, memory, **info)
+    pixels = time_stage(results, scale, 'grayscale', lambda: [grayscale_pixels(image) for image in images],
+                        repeat, memory, **info)
+    del images
+
+    index_dir = os.path.join(work_dir, f'index-{image_format}-{scale}')
+    os.makedirs(index_dir, exist_ok=True)
+
+    def assemble():
+        # Same layout as build_cover_matrix: one memory-mapped uint8 row per cover
+        matrix = np.lib.format.open_memmap(
+            os.path.join(index_dir, PIXELS_FILE), mode='w+', dtype=np.uint8, shape=(len(pixels), PIXELS_PER_IMAGE)
+        )
+        for row, cover in enumerate(pixels):
+            matrix[row] = cover
+        matrix.flush()
+        del matrix
+        return np.load(os.path.join(index_dir, PIXELS_FILE), mmap_mode='r')
+    matrix = time_stage(results, scale, 'matrix assembly', assemble, repeat, memory, **info)
+    del pixels
+
+    pixel_means, Uk = time_stage(results, scale, 'pca fit', lambda: compute_pca(matrix, n_components),
+                                 repeat, memory, **info)
+    projections = time_stage(results, scale, 'projection', lambda: project_matrix(matrix, pixel_means, Uk),
+                             repeat, memory, **info)
+    bounds = time_stage(results, scale, 'bounding box', lambda: projection_bounds(projections), repeat, memory, **info)
+    hashes = time_stage(results, scale, 'hashing', lambda: np.fromiter(
+        (hash_pixels(row) for row in matrix), dtype=np.uint64, count=len(names)
+    ), repeat, memory, **info)
+
+    np.savez(os.path.join(index_dir, PCA_FILE), pixel_means=pixel_means, Uk=Uk, projections=projections,
+             bounds=bounds, n_components=n_components)
+    np.save(os.path.join(index_dir, HASHES_FILE), hashes)
+    with open(os.path.join(index_dir, NAMES_FILE), 'w') as f:
+        json.dump({"version": "benchmark", "names": names}, f)
+    del matrix
+
+    index = time_stage(results, scale, 'open_cover_index', lambda: open_cover_index(index_dir),
+                       repeat, memory, **info)
+
+    queries = make_queries(catalog_dir, names, n_queries)
+    info["queries"] = n_queries
+    time_stage(results, scale, 'top-k search', lambda: [find_similar_covers(index, row) for row in queries],
+               repeat, memory, **info)
+    time_stage(results, scale, 'top-k search (batch)', lambda: find_similar_covers_batch(index, queries),
+               repeat, memory, **info)
+
+
+def run(scales=DEFAULT_SCALES, n_covers=DEFAULT_COVERS, formats=DEFAULT_FORMATS, n_queries=DEFAULT_QUERIES,
+        n_components=N_COMPONENTS, repeat=1, memory=True, workers=1):
+    """
+    Runs the cover benchmark at every scale and image format.
+
+    Catalogs are generated with synthetic_corpus before a scale is timed,
+    so every run measures the same images.
+
+    Args:
+        scales: Catalog scale factors; the 1x catalog has n_covers covers
+        n_covers: Covers in the 1x catalog
+        formats: Image formats the catalog is stored in ('png', 'jpg')
+        n_queries: Queries searched per catalog
+        n_components: Principal components of the PCA
+        repeat: Runs per stage; the fastest is recorded
+        memory: Whether to record the peak memory of every stage
+        workers: Processes used to generate the catalogs (not timed)
+
+    Returns:
+        List of measurements (see time_stage)
+    """
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='simsalabim-bench-')
+    try:
+        for scale in scales:
+            for image_format in formats:
+                catalog_dir = os.path.join(work_dir, f'catalog-{image_format}-{scale}')
+                generate_catalog('cover', catalog_dir, n_covers * scale, SEED, image_format=image_format,
+                                 workers=workers)
+                run_scale(results, catalog_dir, image_format, scale, work_dir, n_queries, n_components,
+                          repeat, memory)
+                shutil.rmtree(catalog_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
@@ -0,0 +1,104 @@
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+from ..audio_index import (
+    PRECISIONS, write_audio_index, open_audio_index, song_features_from_index, song_timing_from_index, score_queries
+)
+
+DEFAULT_QUERIES = 50
+DEFAULT_TOP_K = 5
+SEED = 0
+
+# Per-song arrays that are stored the same way in every precision
+_SHARED_ARRAYS = ('songs', 'offsets', 'segments', 'delta', 'onset', 'rows')
+
+
+def feature_bytes(index):
+    """
+    Bytes of the histogram matrices, inverse norms and song means of an audio index.
+    """
+    return sum(
+        values.nbytes
+        for data in index["channels"].values()
+        for name, values in data.items() if name not in _SHARED_ARRAYS
+    )
+
+
+def _top_k(scores, k):
+    order = np.argsort(-np.nan_to_num(scores, nan=-np.inf), axis=1, kind='stable')
+    return order[:, :k]
+
+
+def compare_precisions(index, n_queries=DEFAULT_QUERIES, precisions=PRECISIONS, top_k=DEFAULT_TOP_K, repeat=1):
+    """
+    Rewrites an audio index in every precision and compares its scores with float64 scoring.
+
+    Catalog songs are scored as queries against the whole catalog; a song's
+    own score is left out of the rankings. Each precision is written from
+    the segments stored in the index, so no MIDI file is parsed.
+
+    Args:
+        index: Audio index returned by load_audio_index
+        n_queries: Catalog songs used as queries
+        precisions: Precisions to compare (float64 is always the reference)
+        top_k: Length of the rankings compared
+        repeat: Scoring runs per precision; the fastest is recorded
+
+    Returns:
+        List with one dictionary per precision: precision, bytes (histograms,
+        norms and means), ratio (float64 bytes / bytes), seconds, max_error
+        and mean_error (absolute score differences), top1 (share of queries
+        with the same best song) and overlap (mean share of the float64
+        top_k that is found)
+    """
+    n_songs = len(index["songs"])
+    song_features = [song_features_from_index(index, song_id) for song_id in range(n_songs)]
+    song_timing = [song_timing_from_index(index, song_id) for song_id in range(n_songs)] if index["timing"] else None
+    rng = np.random.default_rng(SEED)
+    query_ids = np.sort(rng.choice(n_songs, size=min(n_queries, n_songs), replace=False))
+    queries = [song_features[song_id] for song_id in query_ids]
+
+    work_dir = tempfile.mkdtemp(prefix='simsalabim-precision-')
+    results, reference = [], None
+    try:
+        for precision in ('float64',) + tuple(p for p in precisions if p != 'float64'):
+            out_dir = tempfile.mkdtemp(dir=work_dir)
+            write_audio_index(out_dir, index["songs"], song_features, song_timing=song_timing, precision=precision,
+                              dedup=index["dedup"])
+            compact = open_audio_index(out_dir)
+
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                scores = score_queries(compact, queries)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            scores[np.arange(len(query_ids)), query_ids] = np.nan
+
+            if reference is None:
+                reference = {"scores": scores, "bytes": feature_bytes(compact), "top": _top_k(scores, top_k)}
+            errors = np.abs(scores - reference["scores"])
+            top = _top_k(scores, top_k)
+            result = {
+                "precision": precision,
+                "bytes": feature_bytes(compact),
+                "ratio": reference["bytes"] / max(feature_bytes(compact), 1),
+                "seconds": best,
+                "max_error": float(np.nanmax(errors)) if len(queries) else 0.0,
+                "mean_error": float(np.nanmean(errors)) if len(queries) else 0.0,
+                "top1": float(np.mean(top[:, 0] == reference["top"][:, 0])) if len(queries) else 1.0,
+                "overlap": float(np.mean([
+                    len(set(row) & set(expected)) / len(expected) for row, expected in zip(top, reference["top"])
+                ])) if len(queries) else 1.0,
+            }
+            del compact
+            if precision in precisions:
+                results.append(result)
+            print(f"DEBUG: {precision:<8} {result['bytes'] / 2**20:8.1f} MiB  {best:8.3f}s  "
+                  f"max error {result['max_error']:.2e}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
@@ -0,0 +1,647 @@
+import os
+import json
+import time
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+
+from .perceptual_hash import dhash, BKTree, NEAR_DUPLICATE_BITS
+from .index_files import index_dir as live_index_dir, pointer_path, staging_dir, swap_index, file_token, update_lock
+from .metrics import stage_timer
+from .memory_stats import track_memory
+
+# Path to the folder containing the cover images
+COVER_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '../datasets/cover'))
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+INPUT_IMAGE_NAME = 'input_image'
+
+# Every cover is resized to 128x128 and stored as one uint8 row of 16384 pixels
+IMAGE_SIZE = (128, 128)
+PIXELS_PER_IMAGE = IMAGE_SIZE[0] * IMAGE_SIZE[1]
+
+# Rows converted to float32 at a time while fitting or projecting the PCA
+BLOCK_ROWS = 1024
+
+# Memory held per block row: the float32 row and the centered/product temporaries
+BYTES_PER_BLOCK_ROW = 2 * 4 * IMAGE_SIZE[0] * IMAGE_SIZE[1]
+
+# Index files written into datasets/cover/index
+PIXELS_FILE = 'cover_pixels.npy'
+NAMES_FILE = 'cover_names.json'
+PCA_FILE = 'cover_pca.npz'
+HASHES_FILE = 'cover_hashes.npy'
+
+# Default number of principal components kept for the cover search
+N_COMPONENTS = 2
+
+# Loaded indexes kept in memory, keyed by index directory
+_loaded_indexes = {}
+
+
+def resize_cover(image):
+    """
+    Opens a cover and resizes it to IMAGE_SIZE, keeping it RGB or grayscale.
+
+    Args:
+        image: Path to an image file or an opened PIL image
+
+    Returns:
+        PIL image in mode 'RGB' or 'L'
+    """
+    img = Image.open(image) if isinstance(image, (str, os.PathLike)) else image
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    return img.resize(IMAGE_SIZE)
+
+
+def grayscale_pixels(img):
+    """
+    Converts a resized cover to a grayscale uint8 pixel row.
+
+    Returns:
+        Array of shape (16384,) with dtype uint8
+    """
+    img_array = np.asarray(img, dtype=np.float32)
+
+    if img_array.ndim == 3:  # RGB
+        R, G, B = img_array[:, :, 0], img_array[:, :, 1], img_array[:, :, 2]
+        grayscale = 0.2989 * R + 0.5870 * G + 0.1140 * B  # Convert to grayscale
+    else:
+        grayscale = img_array  # Already grayscale
+
+    return np.clip(np.rint(grayscale), 0, 255).astype(np.uint8).ravel()
+
+
+def image_to_pixels(image):
+    """
+    Resizes a cover and converts it to a grayscale uint8 pixel row.
+
+    Args:
+        image: Path to an image file or an opened PIL image
+
+    Returns:
+        Array of shape (16384,) with dtype uint8
+    """
+    with stage_timer('image_decode'):
+        return grayscale_pixels(resize_cover(image))
+
+
+def hash_pixels(pixels):
+    """
+    Computes the 64-bit dHash of a uint8 pixel row.
+    """
+    return dhash(np.asarray(pixels, dtype=np.uint8).reshape(IMAGE_SIZE[1], IMAGE_SIZE[0]))
+
+
+def list_cover_images(base_folder):
+    """
+    Lists the dataset covers in a folder, leaving out the uploaded query image.
+
+    Args:
+        base_folder: Folder containing the cover images
+
+    Returns:
+        Sorted list of image file names
+    """
+    return sorted(
+        f for f in os.listdir(base_folder)
+        if f.lower().endswith(IMAGE_EXTENSIONS) and not f.lower().startswith(INPUT_IMAGE_NAME)
+    )
+
+
+def _decode_cover(image_path):
+    """Decodes one cover for use in a worker process; returns None if unreadable."""
+    try:
+        return image_to_pixels(image_path)
+    except (OSError, ValueError) as e:
+        print(f"Skipping unreadable cover: {os.path.basename(image_path)}. Error: {e}")
+        return None
+
+
+def featurize_cover_file(image_path):
+    """
+    Decodes one cover into its pixel row and dHash, for use in a worker process.
+
+    Returns:
+        Tuple of (pixels, hash), or None if the image is unreadable
+    """
+    pixels = _decode_cover(image_path)
+    if pixels is None:
+        return None
+    return pixels, hash_pixels(pixels)
+
+
+def build_cover_matrix(base_folder, image_names, out_dir, workers=1, progress=None):
+    """
+    Writes all covers into a single memory-mapped uint8 N x 16384 matrix.
+
+    Args:
+        base_folder: Folder containing the cover images
+        image_names: Cover file names, in row order
+        out_dir: Directory to write the matrix and name index into
+        workers: Number of processes used to decode the images
+        progress: Optional callback(done, total) called while decoding
+
+    Returns:
+        Tuple of (read-only memmap of the pixel matrix, list of names that were stored)
+    """
+    matrix_path = os.path.join(out_dir, PIXELS_FILE)
+    matrix = np.lib.format.open_memmap(
+        matrix_path, mode='w+', dtype=np.uint8, shape=(len(image_names), PIXELS_PER_IMAGE)
+    )
+
+    paths = [os.path.join(base_folder, image_name) for image_name in image_names]
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        decoded = executor.map(_decode_cover, paths, chunksize=16) if executor else map(_decode_cover, paths)
+        stored_names = []
+        for done, (image_name, pixels) in enumerate(zip(image_names, decoded), start=1):
+            if pixels is not None:
+                matrix[len(stored_names)] = pixels
+                stored_names.append(image_name)
+            if progress:
+                progress(done, len(image_names))
+    finally:
+        if executor:
+            executor.shutdown()
+    matrix.flush()
+    del matrix
+
+    if len(stored_names) < len(image_names):
+        # Drop the rows left empty by unreadable covers, copying block by block
+        matrix = np.load(matrix_path, mmap_mode='r')
+        compact_path = matrix_path + '.tmp.npy'
+        compact = np.lib.format.open_memmap(
+            compact_path, mode='w+', dtype=np.uint8, shape=(len(stored_names), PIXELS_PER_IMAGE)
+        )
+        for start in range(0, len(stored_names), BLOCK_ROWS):
+            compact[start:start + BLOCK_ROWS] = matrix[start:start + BLOCK_ROWS]
+        compact.flush()
+        del matrix, compact
+        os.replace(compact_path, matrix_path)
+
+    with open(os.path.join(out_dir, NAMES_FILE), 'w') as f:
+        json.dump({"version": f"{time.time_ns():x}", "names": stored_names}, f, indent=4)
+
+    return np.load(matrix_path, mmap_mode='r'), stored_names
+
+
+def load_cover_matrix(index_dir):
+    """
+    Opens the memory-mapped pixel matrix and its name index.
+
+    Args:
+        index_dir: Directory containing the cover index files
+
+    Returns:
+        Tuple of (memmap, names, version), or (None, None, None) if there is no index
+    """
+    matrix_path = os.path.join(index_dir, PIXELS_FILE)
+    names_path = os.path.join(index_dir, NAMES_FILE)
+    if not os.path.exists(matrix_path) or not os.path.exists(names_path):
+        return None, None, None
+
+    with open(names_path, 'r') as f:
+        sidecar = json.load(f)
+    matrix = np.load(matrix_path, mmap_mode='r')
+    if matrix.shape != (len(sidecar["names"]), PIXELS_PER_IMAGE):
+        return None, None, None
+    return matrix, sidecar["names"], sidecar["version"]
+
+
+def iter_float_blocks(matrix, block_rows=BLOCK_ROWS):
+    """
+    Yields consecutive row blocks of a uint8 matrix converted to float32.
+    """
+    for start in range(0, matrix.shape[0], block_rows):
+        yield start, np.asarray(matrix[start:start + block_rows], dtype=np.float32)
+
+
+def _centered_dot(matrix, pixel_means, right, block_rows):
+    """Computes (matrix - pixel_means) @ right one block at a time."""
+    out = np.empty((matrix.shape[0], right.shape[1]), dtype=np.float32)
+    for start, block in iter_float_blocks(matrix, block_rows):
+        block -= pixel_means
+        out[start:start + block.shape[0]] = block @ right
+    return out
+
+
+def _centered_tdot(matrix, pixel_means, left, block_rows):
+    """Computes (matrix - pixel_means).T @ left one block at a time."""
+    out = np.zeros((matrix.shape[1], left.shape[1]), dtype=np.float32)
+    for start, block in iter_float_blocks(matrix, block_rows):
+        block -= pixel_means
+        out += block.T @ left[start:start + block.shape[0]]
+    return out
+
+
+def compute_pca(matrix, n_components=N_COMPONENTS, block_rows=BLOCK_ROWS, oversample=10, n_iter=4, seed=0):
+    """
+    Fits a PCA on the pixel matrix without materializing it as floats.
+
+    Uses a randomized range finder with power iterations, so only one
+    float32 block of rows plus a few N x (k + oversample) matrices are
+    held in memory at a time.
+
+    Args:
+        matrix: uint8 pixel matrix (may be a memmap)
+        n_components: Number of principal components to keep
+
+    Returns:
+        Tuple of (pixel_means, Uk) where Uk has shape (16384, n_components)
+    """
+    with stage_timer('pca_fit'):
+        return _compute_pca(matrix, n_components, block_rows, oversample, n_iter, seed)
+
+
+def _compute_pca(matrix, n_components, block_rows, oversample, n_iter, seed):
+    n_rows, n_pixels = matrix.shape
+
+    pixel_sums = np.zeros(n_pixels, dtype=np.float64)
+    for _, block in iter_float_blocks(matrix, block_rows):
+        pixel_sums += block.sum(axis=0, dtype=np.float64)
+    pixel_means = (pixel_sums / max(n_rows, 1)).astype(np.float32)
+
+    rank = max(1, min(n_components + oversample, n_rows, n_pixels))
+    rng = np.random.default_rng(seed)
+    omega = rng.standard_normal((n_pixels, rank)).astype(np.float32)
+
+    Y = _centered_dot(matrix, pixel_means, omega, block_rows)
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(Y)
+        Z, _ = np.linalg.qr(_centered_tdot(matrix, pixel_means, Q, block_rows))
+        Y = _centered_dot(matrix, pixel_means, Z, block_rows)
+    Q, _ = np.linalg.qr(Y)
+
+    B = _centered_tdot(matrix, pixel_means, Q, block_rows).T
+    _, _, Vt = np.linalg.svd(B, full_matrices=False)
+    Uk = np.ascontiguousarray(Vt[:n_components].T, dtype=np.float32)
+
+    return pixel_means, Uk
+
+
+def project_matrix(matrix, pixel_means, Uk, block_rows=BLOCK_ROWS):
+    """
+    Projects every row of the pixel matrix into the PCA space.
+    """
+    with stage_timer('projection'):
+        return _centered_dot(matrix, pixel_means, Uk, block_rows)
+
+
+def projection_bounds(projections):
+    """
+    Returns the bounding box of the projected covers as a 2 x k array of (minimum, maximum) per component.
+
+    No cover is farther from a query than the farthest corner of the box,
+    so the box bounds the distance used for similarity percentages. It
+    costs one pass over the projections in any number of components, and
+    the bounds of appended covers are merged with an elementwise min/max.
+    """
+    if not len(projections):
+        return np.zeros((2, projections.shape[1]))
+    return np.stack([projections.min(axis=0), projections.max(axis=0)])
+
+
+def max_distance_bounds(bounds, points):
+    """
+    Returns the distance from every point to the farthest corner of a bounding box (see projection_bounds).
+    """
+    return np.linalg.norm(np.maximum(np.abs(points - bounds[0]), np.abs(points - bounds[1])), axis=1)
+
+
+def block_rows_for_budget(budget):
+    """
+    Returns the PCA block size that keeps a block within budget bytes (BLOCK_ROWS without a budget).
+    """
+    if budget is None:
+        return BLOCK_ROWS
+    return int(min(max(budget // BYTES_PER_BLOCK_ROW, 1), BLOCK_ROWS))
+
+
+def build_cover_index(base_folder, out_dir, n_components=N_COMPONENTS, workers=1, progress=None, timings=None,
+                      memory=None, budget=None):
+    """
+    Builds the pixel matrix, name index, PCA model and perceptual hashes of
+    a cover folder into out_dir.
+
+    Args:
+        base_folder: Folder containing the cover images
+        out_dir: Directory to write the index into
+        n_components: Number of principal components to keep
+        workers: Number of processes used to decode the images
+        progress: Optional callback(done, total) called while decoding
+        timings: Optional dictionary that receives the seconds spent per stage
+        memory: Optional list that receives the memory used per stage (see memory_stats.track_memory)
+        budget: Soft memory budget in bytes; the PCA works on smaller row
+            blocks when a default block would need more
+
+    Returns:
+        List of indexed cover names
+    """
+    timings = {} if timings is None else timings
+    block_rows = block_rows_for_budget(budget)
+    if block_rows < BLOCK_ROWS:
+        print(f"DEBUG: PCA blocks of {BLOCK_ROWS} rows exceed the {budget / 2**20:.0f} MiB budget; "
+              f"using blocks of {block_rows} rows")
+
+    start = time.perf_counter()
+    with track_memory('decode+resize', memory):
+        matrix, names = build_cover_matrix(base_folder, list_cover_images(base_folder), out_dir, workers, progress)
+    timings['decode+resize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with track_memory('pca fit', memory, block_rows=block_rows):
+        pixel_means, Uk = compute_pca(matrix, n_components, block_rows)
+    timings['pca fit'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with track_memory('projection', memory, block_rows=block_rows):
+        projections = project_matrix(matrix, pixel_means, Uk, block_rows)
+        np.savez(
+            os.path.join(out_dir, PCA_FILE), pixel_means=pixel_means, Uk=Uk, projections=projections,
+            bounds=projection_bounds(projections), n_components=n_components
+        )
+    timings['projection'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with track_memory('hashing', memory):
+        hashes = np.fromiter((hash_pixels(row) for row in matrix), dtype=np.uint64, count=len(names))
+        np.save(os.path.join(out_dir, HASHES_FILE), hashes)
+    timings['hashing'] = time.perf_counter() - start
+
+    print(f"DEBUG: Built cover index for {len(names)} images with {n_components} components in {out_dir}")
+    return names
+
+
+def open_cover_index(index_dir):
+    """
+    Opens a cover index directory and builds its in-memory search trees.
+
+    Returns:
+        Dictionary with names, version, pixels, pixel_means, Uk, projections,
+        bounds, n_components, hashes, tree and hash_tree, or None if incomplete
+    """
+    matrix, names, version = load_cover_matrix(index_dir)
+    pca_path = os.path.join(index_dir, PCA_FILE)
+    hashes_path = os.path.join(index_dir, HASHES_FILE)
+    if matrix is None or not os.path.exists(pca_path) or not os.path.exists(hashes_path):
+        return None
+
+    with np.load(pca_path) as pca:
+        index = {
+            "names": names,
+            "version": version,
+            "pixels": matrix,
+            "pixel_means": pca["pixel_means"],
+            "Uk": pca["Uk"],
+            "projections": pca["projections"],
+            "n_components": int(pca["n_components"]),
+        }
+        # Generations written before the bounds were stored
+        index["bounds"] = pca["bounds"] if "bounds" in pca.files else projection_bounds(index["projections"])
+    index["hashes"] = np.load(hashes_path)
+    if len(index["projections"]) != len(names) or len(index["hashes"]) != len(names):
+        return None
+
+    # Exact k-NN over the projected covers in O(log N) per query
+    index["tree"] = cKDTree(index["projections"])
+    # Hamming-distance lookups for near-duplicate covers
+    index["hash_tree"] = BKTree(index["hashes"])
+    return index
+
+
+def load_cover_index(base_folder=COVER_FOLDER, n_components=N_COMPONENTS, rebuild=False):
+    """
+    Returns the live cover index of a folder, switching to a newly published generation on the next call.
+
+    Args:
+        base_folder: Folder containing the cover images
+        n_components: Number of principal components the index should have
+        rebuild: Whether a missing or stale index may be rebuilt in place.
+            Request handlers leave this off; rebuilds belong to the
+            buildindex management command.
+
+    Returns:
+        The cover index (see open_cover_index), or None if there is none
+    """
+    # Only the CURRENT pointer is checked per call; a new generation is opened once it is published
+    token = file_token(pointer_path(base_folder))
+    cached = _loaded_indexes.get(base_folder)
+    if cached is not None and cached[0] == token:
+        index = cached[1]
+    else:
+        directory = live_index_dir(base_folder)
+        index = open_cover_index(directory) if directory else None
+        _loaded_indexes[base_folder] = (token, index)
+
+    if rebuild:
+        stale = (
+            index is None or index["n_components"] != n_components
+            or index["names"] != list_cover_images(base_folder)
+        )
+        if stale:
+            out_dir = staging_dir(base_folder)
+            build_cover_index(base_folder, out_dir, n_components)
+            swap_index(base_folder, out_dir)
+            return load_cover_index(base_folder, n_components)
+
+    return index
+
+
+def add_covers_to_index(base_folder, new_covers):
+    """
+    Appends decoded covers to the live cover index and publishes the result as a new generation.
+
+    New rows are projected with the existing PCA model; the model itself is
+    only refitted by a full rebuild. Covers with the same name as an indexed
+    one replace it.
+
+    Args:
+        base_folder: Folder containing the cover images
+        new_covers: List of (file_name, pixels, hash)
+
+    Returns:
+        Number of covers in the new index, or None if there is no live index yet
+    """
+    with update_lock(base_folder):
+        directory = live_index_dir(base_folder)
+        index = open_cover_index(directory) if directory else None
+        if index is None:
+            return None
+
+        replaced = {name for name, _, _ in new_covers}
+        keep = np.array([row for row, name in enumerate(index["names"]) if name not in replaced], dtype=np.int64)
+        names = [index["names"][row] for row in keep] + [name for name, _, _ in new_covers]
+        new_pixels = np.array([pixels for _, pixels, _ in new_covers], dtype=np.uint8).reshape(-1, PIXELS_PER_IMAGE)
+
+        out_dir = staging_dir(base_folder)
+        matrix = np.lib.format.open_memmap(
+            os.path.join(out_dir, PIXELS_FILE), mode='w+', dtype=np.uint8, shape=(len(names), PIXELS_PER_IMAGE)
+        )
+        for start in range(0, len(keep), BLOCK_ROWS):
+            rows = keep[start:start + BLOCK_ROWS]
+            matrix[start:start + len(rows)] = index["pixels"][rows]
+        matrix[len(keep):] = new_pixels
+        matrix.flush()
+        del matrix
+
+        new_projections = project_matrix(new_pixels, index["pixel_means"], index["Uk"])
+        projections = np.concatenate([index["projections"][keep], new_projections])
+        # Merged with the live box; replaced covers only leave it a little loose until the next rebuild
+        new_bounds = projection_bounds(new_projections)
+        bounds = np.stack([np.minimum(index["bounds"][0], new_bounds[0]), np.maximum(index["bounds"][1], new_bounds[1])])
+        np.savez(
+            os.path.join(out_dir, PCA_FILE),
+            pixel_means=index["pixel_means"], Uk=index["Uk"], projections=projections,
+            bounds=bounds, n_components=index["n_components"]
+        )
+        hashes = np.concatenate([index["hashes"][keep], np.array([h for _, _, h in new_covers], dtype=np.uint64)])
+        np.save(os.path.join(out_dir, HASHES_FILE), hashes)
+        with open(os.path.join(out_dir, NAMES_FILE), 'w') as f:
+            json.dump({"version": f"{time.time_ns():x}", "names": names}, f, indent=4)
+
+        swap_index(base_folder, out_dir)
+        return len(names)
+
+
+def verify_cover_index(base_folder, index_dir, sample=10, seed=0):
+    """
+    Checks a cover index for internal consistency and against the images.
+
+    Args:
+        base_folder: Folder containing the cover images
+        index_dir: Index directory to check
+        sample: Number of covers to decode again and compare
+
+    Returns:
+        List of problems found (empty if the index is valid)
+    """
+    index = open_cover_index(index_dir)
+    if index is None:
+        return [f"No complete cover index in {index_dir}"]
+
+    problems = []
+    names = index["names"]
+    missing = [name for name in names if not os.path.exists(os.path.join(base_folder, name))]
+    if missing:
+        problems.append(f"{len(missing)} indexed covers are missing from {base_folder}, e.g. {missing[0]}")
+    if index["Uk"].shape != (PIXELS_PER_IMAGE, index["n_components"]):
+        problems.append(f"PCA components have shape {index['Uk'].shape}")
+
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(names), size=min(sample, len(names)), replace=False)
+    projections = project_matrix(index["pixels"][np.sort(rows)], index["pixel_means"], index["Uk"])
+    for row, projection in zip(np.sort(rows), projections):
+        if not np.allclose(projection, index["projections"][row], rtol=1e-3, atol=1e-2):
+            problems.append(f"{names[row]}: stored projection does not match its pixels")
+        if hash_pixels(index["pixels"][row]) != int(index["hashes"][row]):
+            problems.append(f"{names[row]}: stored hash does not match its pixels")
+        image_path = os.path.join(base_folder, names[row])
+        if os.path.exists(image_path) and not np.array_equal(image_to_pixels(image_path), index["pixels"][row]):
+            problems.append(f"{names[row]}: stored pixels differ from the image file")
+
+    return problems
+
+
+def calculate_similarity_percentage(distance, max_distance):
+    """
+    Converts Euclidean distances into similarity percentages.
+    """
+    return np.maximum(0, (1 - (np.asarray(distance) / max_distance)) * 100)
+
+
+def find_near_duplicates(index, query_pixels, max_bits=NEAR_DUPLICATE_BITS):
+    """
+    Looks up indexed covers whose perceptual hash is close to the query's.
+
+    Args:
+        index: Cover index returned by load_cover_index
+        query_pixels: uint8 pixel row of the query image
+        max_bits: Maximum Hamming distance between the two dHashes
+
+    Returns:
+        List of (hamming_distance, row), closest first
+    """
+    return index["hash_tree"].search(hash_pixels(query_pixels), max_bits)
+
+
+def find_similar_covers(index, query_pixels, top_k=5, max_hamming=NEAR_DUPLICATE_BITS):
+    """
+    Ranks the indexed covers by distance to a query in the PCA space.
+
+    Near-duplicates found through the perceptual hash come first; the
+    remaining places are filled from the KD-tree ranking (see
+    find_similar_covers_batch).
+
+    Args:
+        index: Cover index returned by load_cover_index
+        query_pixels: uint8 pixel row of the query image
+        top_k: Number of results to return
+        max_hamming: Hamming radius for near-duplicates, or None to always rank by PCA
+
+    Returns:
+        List of (image_name, distance, similarity_percentage, match_type), near-duplicates first
+    """
+    return find_similar_covers_batch(index, np.asarray(query_pixels)[None, :], top_k, max_hamming)[0]
+
+
+def find_similar_covers_batch(index, query_matrix, top_k=5, max_hamming=NEAR_DUPLICATE_BITS):
+    """
+    Ranks the indexed covers for many queries at once.
+
+    The BK-tree of perceptual hashes is searched first and the
+    near-duplicates of a query are listed first. A query with a
+    near-duplicate is not projected: the stored projection of its closest
+    near-duplicate stands in for it, as their pixels and therefore their
+    projections are nearly equal. The other queries are projected with one
+    matrix-matrix product. The remaining places of every query are filled
+    from a single KD-tree lookup, and all distances and similarities are
+    measured in the PCA space, whichever way a cover was found.
+
+    Args:
+        index: Cover index returned by load_cover_index
+        query_matrix: uint8 matrix with one pixel row per query
+        top_k: Number of results per query
+        max_hamming: Hamming radius for near-duplicates, or None to always rank by PCA
+
+    Returns:
+        List with one list of (image_name, distance, similarity_percentage, match_type)
+        per query, where match_type is 'near_duplicate' or 'pca'
+    """
+    if not index["names"]:
+        return [[] for _ in range(len(query_matrix))]
+    k = min(top_k, len(index["names"]))
+    near_duplicates = [
+        [i for _, i in find_near_duplicates(index, pixels, max_hamming)[:k]] if max_hamming is not None else []
+        for pixels in query_matrix
+    ]
+
+    points = np.zeros((len(query_matrix), index["projections"].shape[1]))
+    pending = [row for row, duplicates in enumerate(near_duplicates) if not duplicates]
+    for row, duplicates in enumerate(near_duplicates):
+        if duplicates:
+            points[row] = index["projections"][duplicates[0]]
+    if pending:
+        points[pending] = project_matrix(np.asarray(query_matrix)[pending], index["pixel_means"], index["Uk"])
+
+    with stage_timer('cover_knn'):
+        _, tree_order = index["tree"].query(points, k=k)
+    tree_order = tree_order.reshape(len(points), k)
+
+    max_distances = max_distance_bounds(index["bounds"], points)
+
+    results = []
+    for row, duplicates in enumerate(near_duplicates):
+        # At most k near-duplicates, so the k nearest covers always leave enough to fill up with
+        others = [i for i in tree_order[row] if i not in duplicates][:k - len(duplicates)]
+        order = np.array(duplicates + others, dtype=np.int64)
+        distances = np.linalg.norm(index["projections"][order] - points[row], axis=1)
+        percentages = calculate_similarity_percentage(distances, max_distances[row] or 1.0)
+        results.append([
+            (index["names"][i], float(distance), float(percentage),
+             'near_duplicate' if position < len(duplicates) else 'pca')
+            for position, (i, distance, percentage) in enumerate(zip(order, distances, percentages))
+        ])
+    return results
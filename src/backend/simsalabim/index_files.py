@@ -0,0 +1,291 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: updates are only serialized within one process
+    fcntl = None
+
+# Every dataset folder keeps its search index under index/:
+#   index/staging/<generation>/      generations being built (or built with --no-swap)
+#   index/generations/<generation>/  published generations, never modified again
+#   index/CURRENT                    name of the live generation
+INDEX_DIRNAME = 'index'
+STAGING_DIRNAME = 'staging'
+GENERATIONS_DIRNAME = 'generations'
+CURRENT_FILE = 'CURRENT'
+LOCK_FILE = '.lock'
+# Kept in a staged build until it is published: the generation that was live when the build started
+BASE_FILE = '.base'
+
+# Published generations kept on disk, so readers still holding an older one
+# can finish and a bad build can be rolled back
+KEEP_GENERATIONS = 3
+
+# Unpublished builds older than this are assumed to be abandoned
+STALE_STAGING_SECONDS = 24 * 60 * 60
+
+# Per-folder locks for the threads of this process; update_lock adds a file lock for other processes
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+class IndexChangedError(RuntimeError):
+    """Raised when another update published a generation while a staged build was made."""
+
+
+@contextmanager
+def update_lock(base_folder):
+    """
+    Serializes updates that build and publish a generation of one dataset folder.
+
+    Besides a lock for the threads of this process, an exclusive flock is
+    held on index/.lock, so updates from different worker processes take
+    turns as well. Each update then starts from the generation the previous
+    one published instead of overwriting it.
+    """
+    directory = os.path.join(base_folder, INDEX_DIRNAME)
+    os.makedirs(directory, exist_ok=True)
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(os.path.abspath(base_folder), threading.Lock())
+    with thread_lock, open(os.path.join(directory, LOCK_FILE), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def pointer_path(base_folder):
+    """
+    Returns the path of the file naming the live generation of a dataset folder.
+    """
+    return os.path.join(base_folder, INDEX_DIRNAME, CURRENT_FILE)
+
+
+def current_generation(base_folder):
+    """
+    Returns the name of the live generation, or None if nothing was published.
+    """
+    try:
+        with open(pointer_path(base_folder)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def generation_dir(base_folder, generation):
+    """
+    Returns the directory of a published generation.
+    """
+    return os.path.join(base_folder, INDEX_DIRNAME, GENERATIONS_DIRNAME, generation)
+
+
+def index_dir(base_folder):
+    """
+    Returns the directory holding the live index of a dataset folder, or None.
+    """
+    generation = current_generation(base_folder)
+    return generation_dir(base_folder, generation) if generation else None
+
+
+def list_generations(base_folder):
+    """
+    Returns the published generations of a dataset folder, oldest first.
+    """
+    path = os.path.join(base_folder, INDEX_DIRNAME, GENERATIONS_DIRNAME)
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+
+
+def staging_dir(base_folder):
+    """
+    Returns a new, empty directory to build the next generation into.
+
+    Generation names start with the creation time, so they sort in build order.
+    The live generation at this point is recorded in the directory, so
+    publish_staged can tell whether it was replaced during the build.
+    """
+    generation = f"{time.time_ns():016x}-{uuid.uuid4().hex[:8]}"
+    path = os.path.join(base_folder, INDEX_DIRNAME, STAGING_DIRNAME, generation)
+    os.makedirs(path)
+    with open(os.path.join(path, BASE_FILE), 'w') as f:
+        f.write(current_generation(base_folder) or '')
+    return path
+
+
+def staged_base(staged):
+    """
+    Returns the generation that was live when a staged build started ('' for none), or None if unknown.
+    """
+    try:
+        with open(os.path.join(staged, BASE_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def clone_generation(base_folder, source_dir):
+    """
+    Stages a new generation holding the files of an existing one.
+
+    Files are hard-linked where the filesystem allows it, so deriving a
+    generation that only adds files costs no copying. Published files are
+    never modified, so sharing them between generations is safe.
+
+    Returns:
+        Path of the staged directory
+    """
+    out_dir = staging_dir(base_folder)
+    for name in os.listdir(source_dir):
+        if name == BASE_FILE:
+            continue
+        source = os.path.join(source_dir, name)
+        try:
+            os.link(source, os.path.join(out_dir, name))
+        except OSError:
+            shutil.copy2(source, os.path.join(out_dir, name))
+    return out_dir
+
+
+def latest_staged(base_folder):
+    """
+    Returns the most recently started unpublished build, or None.
+    """
+    path = os.path.join(base_folder, INDEX_DIRNAME, STAGING_DIRNAME)
+    if not os.path.isdir(path):
+        return None
+    staged = sorted(os.listdir(path))
+    return os.path.join(path, staged[-1]) if staged else None
+
+
+def _write_pointer(base_folder, generation):
+    # Readers see either the old or the new name, never a partial file
+    directory = os.path.join(base_folder, INDEX_DIRNAME)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.CURRENT-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, pointer_path(base_folder))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def swap_index(base_folder, staged=None):
+    """
+    Publishes a staged generation as the live index.
+
+    The staged directory is renamed into generations/ and the CURRENT pointer
+    is replaced atomically. Readers that already opened the previous
+    generation keep using it; every later request sees the new one.
+
+    Args:
+        base_folder: Dataset folder (e.g. datasets/audio)
+        staged: Staged directory to publish; defaults to the latest one
+
+    Returns:
+        Path of the new live index directory
+    """
+    staged = staged or latest_staged(base_folder)
+    if not staged or not os.path.isdir(staged):
+        raise FileNotFoundError(f"No staged index in {base_folder}")
+
+    generation = os.path.basename(staged)
+    published = generation_dir(base_folder, generation)
+    os.makedirs(os.path.dirname(published), exist_ok=True)
+    if os.path.exists(os.path.join(staged, BASE_FILE)):
+        os.remove(os.path.join(staged, BASE_FILE))
+    os.rename(staged, published)
+    _write_pointer(base_folder, generation)
+    prune_generations(base_folder)
+    return published
+
+
+def publish_staged(base_folder, staged=None):
+    """
+    Publishes an offline build unless another update published a generation since the build started.
+
+    The check and the swap happen under update_lock, so an upload cannot
+    publish in between; a build that would drop what such an update added
+    is refused instead.
+
+    Args:
+        base_folder: Dataset folder (e.g. datasets/audio)
+        staged: Staged directory to publish; defaults to the latest one
+
+    Returns:
+        Path of the new live index directory
+
+    Raises:
+        IndexChangedError: if the live generation is not the one the build started from
+    """
+    staged = staged or latest_staged(base_folder)
+    with update_lock(base_folder):
+        base, live = staged_base(staged), current_generation(base_folder)
+        if base is not None and base != (live or ''):
+            raise IndexChangedError(
+                f"The live index changed from {base or 'nothing'} to {live} while this generation was built"
+            )
+        return swap_index(base_folder, staged)
+
+
+def rollback_index(base_folder):
+    """
+    Points the live index back at the generation published before the current one.
+
+    Holds update_lock, so it does not race with an upload publishing a generation.
+
+    Returns:
+        Path of the new live index directory, or None if there is no older generation
+    """
+    with update_lock(base_folder):
+        current = current_generation(base_folder)
+        older = [generation for generation in list_generations(base_folder) if generation < (current or '')]
+        if not older:
+            return None
+        _write_pointer(base_folder, older[-1])
+        return generation_dir(base_folder, older[-1])
+
+
+def prune_generations(base_folder, keep=KEEP_GENERATIONS):
+    """
+    Removes all but the newest `keep` published generations and abandoned builds.
+
+    The live generation is never removed. Memory-mapped files of a removed
+    generation stay readable for processes that still have them open.
+    """
+    current = current_generation(base_folder)
+    generations = list_generations(base_folder)
+    for generation in generations[:-keep] if keep else generations:
+        if generation != current:
+            shutil.rmtree(generation_dir(base_folder, generation), ignore_errors=True)
+
+    staging = os.path.join(base_folder, INDEX_DIRNAME, STAGING_DIRNAME)
+    if os.path.isdir(staging):
+        cutoff = time.time() - STALE_STAGING_SECONDS
+        for entry in os.scandir(staging):
+            if entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def file_token(path):
+    """
+    Identifies one version of a file on disk, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
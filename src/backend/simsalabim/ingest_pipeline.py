@@ -0,0 +1,73 @@
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+def _timed_call(featurize, path):
+    """Runs a featurizer in a worker and measures how long it took."""
+    start = time.perf_counter()
+    result = featurize(path)
+    return result, time.perf_counter() - start
+
+
+class FeaturizePipeline:
+    """
+    Bounded producer/consumer pipeline that featurizes files as they arrive.
+
+    The producer (e.g. ZIP extraction) calls submit() for every file it
+    writes; worker processes run the featurizer in parallel. At most
+    max_pending files are in flight, so a fast producer blocks instead of
+    queueing an unbounded amount of work.
+    """
+
+    def __init__(self, featurize, workers=1, max_pending=None):
+        self.featurize = featurize
+        self.max_pending = max_pending or max(2 * workers, 1)
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.pending = deque()
+        self.results = []
+
+    def submit(self, name, path):
+        """
+        Queues one file, waiting for a worker slot if the pipeline is full.
+        """
+        if self.executor is None:
+            self.results.append((name,) + _timed_call(self.featurize, path))
+            return
+
+        while len(self.pending) >= self.max_pending:
+            wait([future for _, future in self.pending], return_when=FIRST_COMPLETED)
+            self._collect_done()
+        self.pending.append((name, self.executor.submit(_timed_call, self.featurize, path)))
+
+    def _collect_done(self):
+        still_pending = deque()
+        for name, future in self.pending:
+            if future.done():
+                self.results.append((name,) + future.result())
+            else:
+                still_pending.append((name, future))
+        self.pending = still_pending
+
+    def drain(self):
+        """
+        Waits for every queued file.
+
+        Returns:
+            List of (name, featurizer result, seconds), in completion order
+        """
+        for name, future in self.pending:
+            self.results.append((name,) + future.result())
+        self.pending.clear()
+        return self.results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,72 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.benchmarks import compare_reports, write_report, REGRESSION_RATIO
+from simsalabim.benchmarks import audio, cover
+
+
+class Command(BaseCommand):
+    help = (
+        "Times every stage of the search pipelines at several corpus sizes and writes "
+        "the measurements as JSON, optionally compared against an earlier run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('suite', choices=['audio', 'cover'], help="Which pipeline to benchmark")
+        parser.add_argument('--scales', type=int, nargs='+', default=list(audio.DEFAULT_SCALES),
+                            help="Corpus scale factors")
+        parser.add_argument('--songs', type=int, default=audio.DEFAULT_SONGS,
+                            help="Songs in the 1x audio corpus")
+        parser.add_argument('--reference-limit', type=int, default=audio.DEFAULT_REFERENCE_LIMIT,
+                            help="Largest corpus on which compare_segments_to_dataset is run")
+        parser.add_argument('--covers', type=int, default=cover.DEFAULT_COVERS,
+                            help="Covers in the 1x cover catalog")
+        parser.add_argument('--formats', nargs='+', choices=['png', 'jpg'], default=list(cover.DEFAULT_FORMATS),
+                            help="Image formats the cover catalog is benchmarked in")
+        parser.add_argument('--queries', type=int, default=cover.DEFAULT_QUERIES,
+                            help="Cover queries searched per catalog")
+        parser.add_argument('--no-memory', action='store_true',
+                            help="Do not record the peak memory of the cover stages")
+        parser.add_argument('--repeat', type=int, default=1, help="Runs per stage; the fastest is kept")
+        parser.add_argument('--output', default='benchmark.json', help="File the JSON report is written to")
+        parser.add_argument('--baseline', help="Earlier JSON report to compare against")
+
+    def handle(self, *args, **options):
+        suite = options['suite']
+        settings = {"scales": options['scales'], "repeat": options['repeat']}
+        try:
+            if suite == 'audio':
+                settings.update(songs=options['songs'], reference_limit=options['reference_limit'])
+                results = audio.run(options['scales'], options['songs'], repeat=options['repeat'],
+                                    reference_limit=options['reference_limit'])
+            else:
+                settings.update(covers=options['covers'], formats=options['formats'], queries=options['queries'],
+                                memory=not options['no_memory'])
+                results = cover.run(options['scales'], options['covers'], options['formats'], options['queries'],
+                                    repeat=options['repeat'], memory=not options['no_memory'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        report = write_report(options['output'], suite, results, **settings)
+        self.stdout.write(self.style.SUCCESS(f"[{suite}] Wrote {len(results)} measurements to {options['output']}"))
+
+        if options['baseline']:
+            with open(options['baseline'], 'r') as f:
+                baseline = json.load(f)
+            self.write_comparison(report, baseline)
+
+    def write_comparison(self, report, baseline):
+        rows = compare_reports(report, baseline)
+        self.stdout.write(f"Compared with {baseline['environment'].get('commit') or 'baseline'}:")
+        regressions = 0
+        for scale, stage, before, after, ratio, regressed in rows:
+            line = f"    [{scale}x] {stage:<38} {before:9.4f}s -> {after:9.4f}s  x{ratio:5.2f}"
+            if regressed:
+                regressions += 1
+                self.stdout.write(self.style.WARNING(line + "  slower"))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            self.stdout.write(self.style.WARNING(
+                f"{regressions} stage(s) more than {REGRESSION_RATIO:.0%} of the baseline time"
+            ))
@@ -0,0 +1,157 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.audio_index import AUDIO_FOLDER, PRECISIONS, build_audio_index, verify_audio_index
+from simsalabim.cover_index import COVER_FOLDER, build_cover_index, verify_cover_index
+from simsalabim.index_files import (
+    IndexChangedError, index_dir, latest_staged, publish_staged, rollback_index, staging_dir
+)
+from simsalabim.memory_stats import memory_report_lines
+from simsalabim.note_store import build_audio_index_from_notes
+from simsalabim.song_neighbours import neighbour_table_size, write_song_neighbours
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the audio feature index and/or the cover PCA index offline as a new "
+        "generation, verifies it and publishes it as the live index. Running servers "
+        "switch to the new generation on their next request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['audio', 'cover', 'all'], help="Which index to build")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Processes used to parse MIDI files / decode images")
+        parser.add_argument('--components', type=int, default=settings.COVER_PCA_COMPONENTS,
+                            help="Number of PCA components for the cover index")
+        parser.add_argument('--sample', type=int, default=10,
+                            help="Number of entries re-featurized during verification")
+        parser.add_argument('--no-swap', action='store_true',
+                            help="Build and verify a new generation but keep the live index")
+        parser.add_argument('--verify-only', action='store_true',
+                            help="Only verify the live index")
+        parser.add_argument('--swap-only', action='store_true',
+                            help="Verify and publish the generation built last with --no-swap")
+        parser.add_argument('--folder',
+                            help="Index this folder instead of datasets/audio or datasets/cover (e.g. a generated corpus)")
+        parser.add_argument('--memory-budget', type=float,
+                            help="Soft memory budget in MiB (default: INDEX_MEMORY_BUDGET); larger builds are blocked")
+        parser.add_argument('--memory-report', action='store_true',
+                            help="Print the peak memory of every build stage")
+        parser.add_argument('--from-notes', action='store_true',
+                            help="Build the audio index from the note store, parsing only new and changed MIDI files")
+        parser.add_argument('--timing', action='store_true',
+                            help="Also store the DTB/OTB timing histograms in the audio index (implies --from-notes)")
+        parser.add_argument('--precision', choices=PRECISIONS, default=settings.AUDIO_INDEX_PRECISION,
+                            help="Storage precision of the audio histograms (default: AUDIO_INDEX_PRECISION)")
+        parser.add_argument('--no-dedup', action='store_true',
+                            help="Store duplicate songs and segments of the audio index separately "
+                                 "(default: AUDIO_INDEX_DEDUP)")
+        parser.add_argument('--rollback', action='store_true',
+                            help="Point the live index back at the previously published generation")
+
+    def handle(self, *args, **options):
+        targets = ['audio', 'cover'] if options['target'] == 'all' else [options['target']]
+        if options['folder'] and len(targets) > 1:
+            raise CommandError("--folder needs a single target (audio or cover)")
+        failed = False
+        for target in targets:
+            failed |= not self.run_target(target, options)
+        if failed:
+            raise CommandError("Index verification or publishing failed; the live index was left untouched.")
+
+    def run_target(self, target, options):
+        base_folder = options['folder'] or (AUDIO_FOLDER if target == 'audio' else COVER_FOLDER)
+        verify = verify_audio_index if target == 'audio' else verify_cover_index
+        timings = {}
+        memory = [] if options['memory_report'] else None
+        budget = settings.INDEX_MEMORY_BUDGET
+        if options['memory_budget'] is not None:
+            budget = int(options['memory_budget'] * 2**20)
+
+        if options['rollback']:
+            live = rollback_index(base_folder)
+            if live is None:
+                self.stderr.write(f"[{target}] No older generation to roll back to")
+                return False
+            self.stdout.write(f"[{target}] Rolled back to {live}")
+            return True
+
+        if options['verify_only']:
+            out_dir = index_dir(base_folder)
+        elif options['swap_only']:
+            out_dir = latest_staged(base_folder)
+        else:
+            out_dir = staging_dir(base_folder)
+            self.stdout.write(f"[{target}] Building into {out_dir} with {options['workers']} workers")
+            if target == 'audio':
+                dedup = settings.AUDIO_INDEX_DEDUP and not options['no_dedup']
+                args = (base_folder, out_dir, options['workers'], self.progress(target, 'parsed'), timings, memory, budget)
+                if options['from_notes'] or options['timing']:
+                    songs, skipped = build_audio_index_from_notes(
+                        *args, timing=options['timing'], precision=options['precision'], dedup=dedup
+                    )
+                else:
+                    songs, skipped = build_audio_index(*args, precision=options['precision'], dedup=dedup)
+                self.stdout.write(f"[{target}] Indexed {len(songs)} songs, skipped {len(skipped)} unreadable files")
+
+                # The similar-songs endpoint needs a table for the new generation when the live one has one
+                live_dir = index_dir(base_folder)
+                top_n = neighbour_table_size(live_dir) if live_dir else None
+                if top_n:
+                    start = time.perf_counter()
+                    write_song_neighbours(out_dir, top_n, progress=self.progress(target, 'scored neighbours of'))
+                    timings['neighbours'] = time.perf_counter() - start
+            else:
+                names = build_cover_index(
+                    base_folder, out_dir, options['components'], options['workers'],
+                    self.progress(target, 'decoded'), timings, memory, budget
+                )
+                self.stdout.write(f"[{target}] Indexed {len(names)} covers")
+
+        if out_dir is None:
+            self.stderr.write(f"[{target}] No index to verify in {base_folder}")
+            return False
+
+        start = time.perf_counter()
+        problems = verify(base_folder, out_dir, sample=options['sample'])
+        timings['verify'] = time.perf_counter() - start
+        for problem in problems:
+            self.stderr.write(f"[{target}] {problem}")
+
+        if not problems and not options['verify_only'] and not options['no_swap']:
+            start = time.perf_counter()
+            try:
+                live = publish_staged(base_folder, out_dir)
+            except IndexChangedError as error:
+                problems.append(f"{error}; build again so it includes that update")
+                self.stderr.write(f"[{target}] {problems[-1]}")
+            else:
+                timings['publish'] = time.perf_counter() - start
+                self.stdout.write(f"[{target}] Published new generation at {live}")
+
+        self.write_timings(target, timings)
+        if memory:
+            self.stdout.write(f"[{target}] Memory summary (MiB):")
+            self.stdout.write('\n'.join(memory_report_lines(memory)))
+        if not problems:
+            self.stdout.write(self.style.SUCCESS(f"[{target}] Index OK"))
+        return not problems
+
+    def progress(self, target, verb):
+        step = {'last': 0.0}
+
+        def report(done, total):
+            now = time.monotonic()
+            if done == total or now - step['last'] >= 1.0:
+                step['last'] = now
+                self.stdout.write(f"[{target}] {verb} {done}/{total} files")
+        return report
+
+    def write_timings(self, target, timings):
+        self.stdout.write(f"[{target}] Timing summary:")
+        for stage, seconds in timings.items():
+            self.stdout.write(f"    {stage:<18} {seconds:8.2f}s")
+        self.stdout.write(f"    {'total':<18} {sum(timings.values()):8.2f}s")
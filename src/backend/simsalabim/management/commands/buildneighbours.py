@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.audio_index import AUDIO_FOLDER
+from simsalabim.song_neighbours import BLOCK_SONGS, DEFAULT_TOP_N, build_song_neighbours
+
+
+class Command(BaseCommand):
+    help = (
+        "Computes the all-pairs song similarity of the live audio index and publishes "
+        "the top-N neighbours of every song for the similar-songs endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=DEFAULT_TOP_N, help="Neighbours kept per song")
+        parser.add_argument('--block', type=int, default=BLOCK_SONGS, help="Songs scored together")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        step = {'last': 0.0}
+
+        def progress(done, total):
+            now = time.monotonic()
+            if done == total or now - step['last'] >= 1.0:
+                step['last'] = now
+                self.stdout.write(f"[neighbours] scored {done}/{total} songs")
+
+        live = build_song_neighbours(AUDIO_FOLDER, options['top'], options['block'], progress)
+        if live is None:
+            raise CommandError('No audio index. Run "manage.py buildindex audio" first.')
+        self.stdout.write(self.style.SUCCESS(
+            f"[neighbours] Published {live} in {time.perf_counter() - start:.2f}s"
+        ))
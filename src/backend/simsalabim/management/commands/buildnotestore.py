@@ -0,0 +1,55 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.audio_index import AUDIO_FOLDER, CHANNELS, SEGMENT_LENGTH, SLIDING_WINDOW
+from simsalabim.note_store import build_note_store, featurize_store, note_store_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Extracts the note events of every MIDI file into the columnar note store, "
+        "parsing only files that changed since the last run, and reports the segments "
+        "a segmentation would produce."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', help="Folder of .mid files (default: datasets/audio)")
+        parser.add_argument('--output', help="Store file (default: <folder>/index/notes.npz)")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Processes used to parse MIDI files")
+        parser.add_argument('--segment-length', type=int, default=SEGMENT_LENGTH,
+                            help="Notes per segment for the segmentation report")
+        parser.add_argument('--sliding-window', type=int, default=SLIDING_WINDOW,
+                            help="Notes shared by consecutive segments for the segmentation report")
+
+    def handle(self, *args, **options):
+        if not 0 <= options['sliding_window'] < options['segment_length']:
+            raise CommandError("--sliding-window must be smaller than --segment-length")
+        folder = options['folder'] or AUDIO_FOLDER
+        path = options['output'] or note_store_path(folder)
+        step = {'last': 0.0}
+
+        def progress(done, total):
+            now = time.monotonic()
+            if done == total or now - step['last'] >= 1.0:
+                step['last'] = now
+                self.stdout.write(f"[notes] parsed {done}/{total} files")
+
+        start = time.perf_counter()
+        store, parsed, skipped = build_note_store(folder, path, options['workers'], progress)
+        self.stdout.write(
+            f"[notes] {len(store['songs'])} songs, {len(store['pitch'])} note events in {path} "
+            f"({parsed} files parsed, {len(skipped)} unreadable) in {time.perf_counter() - start:.2f}s"
+        )
+
+        start = time.perf_counter()
+        songs, song_features = featurize_store(store, CHANNELS, options['segment_length'], options['sliding_window'])
+        seconds = time.perf_counter() - start
+        for channel in CHANNELS:
+            segments = sum(len(features[channel]) for features in song_features if channel in features)
+            self.stdout.write(f"    channel {channel:<3} {segments:8d} segments")
+        self.stdout.write(self.style.SUCCESS(
+            f"[notes] Segmented {len(songs)} songs ({options['segment_length']}/{options['sliding_window']}) "
+            f"in {seconds:.2f}s"
+        ))
@@ -0,0 +1,82 @@
+import os
+import time
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.audio_index import featurize_midi_file, load_audio_index, rank_queries
+from simsalabim.cover_index import featurize_cover_file, find_similar_covers_batch, load_cover_index
+from simsalabim.synthetic_corpus import load_ground_truth, source_group
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a generated query set against the index of its catalog and reports "
+        "recall@1, recall@k and queries per second."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries_dir', help="Folder written by gencorpus (contains ground_truth.json)")
+        parser.add_argument('--top', type=int, default=5, help="k of recall@k")
+        parser.add_argument('--batch', type=int, default=64, help="Queries scored together")
+
+    def handle(self, *args, **options):
+        queries_dir, top_k = options['queries_dir'], options['top']
+        try:
+            truth = load_ground_truth(queries_dir)
+        except FileNotFoundError:
+            raise CommandError(f"No ground truth in {queries_dir}. Run \"manage.py gencorpus\" first.")
+        kind, catalog = truth['kind'], truth['catalog']
+
+        index = load_audio_index(catalog) if kind == 'audio' else load_cover_index(catalog)
+        if index is None:
+            raise CommandError(f'No {kind} index for {catalog}. Run "manage.py buildindex {kind} --folder {catalog}".')
+
+        hits_1 = hits_k = unreadable = 0
+        featurize_seconds = search_seconds = 0.0
+        entries = truth['queries']
+        for first in range(0, len(entries), options['batch']):
+            batch = entries[first:first + options['batch']]
+
+            start = time.perf_counter()
+            readable, features = [], []
+            for entry in batch:
+                path = os.path.join(queries_dir, entry['query'])
+                if kind == 'audio':
+                    _, feature, _ = featurize_midi_file(path)
+                else:
+                    feature = featurize_cover_file(path)
+                    feature = feature[0] if feature is not None else None
+                if feature is not None and len(feature):
+                    readable.append(entry)
+                    features.append(feature)
+                else:
+                    unreadable += 1
+            featurize_seconds += time.perf_counter() - start
+            if not features:
+                continue
+
+            start = time.perf_counter()
+            if kind == 'audio':
+                rankings = rank_queries(index, features, top_k)
+            else:
+                rankings = find_similar_covers_batch(index, np.stack(features), top_k)
+            search_seconds += time.perf_counter() - start
+
+            for entry, ranking in zip(readable, rankings):
+                # Variants derived from the same dataset file are indistinguishable matches
+                groups = [source_group(result[0]) for result in ranking]
+                expected = source_group(entry['expected'])
+                hits_1 += bool(groups) and groups[0] == expected
+                hits_k += expected in groups
+
+        total = len(entries)
+        seconds = featurize_seconds + search_seconds
+        catalog_size = len(index['songs'] if kind == 'audio' else index['names'])
+        self.stdout.write(f"[{kind}] {total} queries against {catalog_size} catalog items ({unreadable} unreadable)")
+        self.stdout.write(f"    recall@1      {hits_1 / total if total else 0.0:.3f}")
+        self.stdout.write(f"    {'recall@' + str(top_k):<14}{hits_k / total if total else 0.0:.3f}")
+        self.stdout.write(f"    featurize     {featurize_seconds:.2f}s")
+        self.stdout.write(f"    search        {search_seconds:.2f}s")
+        self.stdout.write(self.style.SUCCESS(
+            f"    queries/sec   {total / seconds if seconds > 0 else 0.0:.1f}"
+        ))
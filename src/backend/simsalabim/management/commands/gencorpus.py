@@ -0,0 +1,66 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.audio_index import AUDIO_FOLDER, list_midi_files
+from simsalabim.cover_index import COVER_FOLDER, list_cover_images
+from simsalabim.synthetic_corpus import generate_catalog, generate_queries
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a seeded synthetic MIDI or cover catalog and a query set with "
+        "ground truth for load tests. The same seed always gives the same files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['audio', 'cover'], help="Which corpus to generate")
+        parser.add_argument('out_dir', help="Folder the catalog is written to")
+        parser.add_argument('--count', type=int, default=10000, help="Catalog items")
+        parser.add_argument('--queries', type=int, default=1000, help="Queries written to <out_dir>/queries")
+        parser.add_argument('--queries-dir', help="Folder for the queries (default: <out_dir>/queries)")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed")
+        parser.add_argument('--from-dataset', action='store_true',
+                            help="Derive the catalog from variants of the dataset files instead of synthesizing it")
+        parser.add_argument('--format', choices=['png', 'jpg'], default='png', help="Image format of cover catalogs")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Worker processes")
+
+    def handle(self, *args, **options):
+        kind, out_dir = options['kind'], options['out_dir']
+        if options['count'] < 1 or options['queries'] < 0:
+            raise CommandError("--count must be positive and --queries not negative")
+        queries_dir = options['queries_dir'] or os.path.join(out_dir, 'queries')
+
+        sources = None
+        if options['from_dataset']:
+            folder = AUDIO_FOLDER if kind == 'audio' else COVER_FOLDER
+            names = list_midi_files(folder) if kind == 'audio' else list_cover_images(folder)
+            sources = [os.path.join(folder, name) for name in names]
+            if not sources:
+                raise CommandError(f"No dataset files in {folder}")
+
+        step = {'last': 0.0}
+
+        def progress(stage):
+            def report(done, total):
+                now = time.monotonic()
+                if done == total or now - step['last'] >= 1.0:
+                    step['last'] = now
+                    self.stdout.write(f"[{kind}] {stage} {done}/{total}")
+            return report
+
+        start = time.perf_counter()
+        names = generate_catalog(kind, out_dir, options['count'], options['seed'], sources,
+                                 options['format'], options['workers'], progress('catalog'))
+        self.stdout.write(self.style.SUCCESS(
+            f"[{kind}] Wrote {len(names)} catalog items to {out_dir} in {time.perf_counter() - start:.2f}s"
+        ))
+
+        if options['queries']:
+            start = time.perf_counter()
+            truth = generate_queries(kind, out_dir, queries_dir, options['queries'], options['seed'],
+                                     options['workers'], progress('queries'))
+            self.stdout.write(self.style.SUCCESS(
+                f"[{kind}] Wrote {len(truth)} queries and ground truth to {queries_dir} "
+                f"in {time.perf_counter() - start:.2f}s"
+            ))
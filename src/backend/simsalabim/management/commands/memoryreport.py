@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import tempfile
+import tracemalloc
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.audio_index import (
+    AUDIO_FOLDER, build_audio_index, open_audio_index, list_midi_files, featurize_midi_file,
+    rank_queries, cells_for_budget
+)
+from simsalabim.cover_index import (
+    COVER_FOLDER, build_cover_index, open_cover_index, list_cover_images, image_to_pixels, find_similar_covers_batch
+)
+from simsalabim.memory_stats import track_memory, memory_report_lines
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds an index into a scratch directory and runs catalog files as queries "
+        "against it, reporting the peak memory of every indexing and query stage. "
+        "The live index is not touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['audio', 'cover', 'all'], help="Which pipeline to measure")
+        parser.add_argument('--folder', help="Catalog folder (default: datasets/audio or datasets/cover)")
+        parser.add_argument('--queries', type=int, default=50, help="Catalog files searched as queries")
+        parser.add_argument('--workers', type=int, default=1, help="Processes used while building")
+        parser.add_argument('--index-budget', type=float,
+                            help="Soft memory budget of the build in MiB (default: INDEX_MEMORY_BUDGET)")
+        parser.add_argument('--query-budget', type=float,
+                            help="Soft memory budget of the query scoring in MiB (default: QUERY_MEMORY_BUDGET)")
+        parser.add_argument('--trace', action='store_true',
+                            help="Also record Python/numpy allocation peaks with tracemalloc (slower)")
+        parser.add_argument('--output', help="Write the measurements as JSON to this file")
+
+    def handle(self, *args, **options):
+        index_budget = self.budget(options['index_budget'], settings.INDEX_MEMORY_BUDGET)
+        query_budget = self.budget(options['query_budget'], settings.QUERY_MEMORY_BUDGET)
+        targets = ['audio', 'cover'] if options['target'] == 'all' else [options['target']]
+        if options['folder'] and len(targets) > 1:
+            raise CommandError("--folder needs a single target (audio or cover)")
+
+        if options['trace']:
+            tracemalloc.start()
+        reports = {}
+        try:
+            for target in targets:
+                folder = options['folder'] or (AUDIO_FOLDER if target == 'audio' else COVER_FOLDER)
+                measure = self.measure_audio if target == 'audio' else self.measure_cover
+                reports[target] = measure(folder, options, index_budget, query_budget)
+                self.stdout.write(f"[{target}] Memory per stage (MiB):")
+                self.stdout.write('\n'.join(memory_report_lines(reports[target])))
+        finally:
+            if options['trace']:
+                tracemalloc.stop()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({"index_budget": index_budget, "query_budget": query_budget, "stages": reports}, f, indent=4)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def budget(self, mib, default):
+        return int(mib * 2**20) if mib is not None else default
+
+    def measure_audio(self, folder, options, index_budget, query_budget):
+        memory = []
+        out_dir = tempfile.mkdtemp(prefix='simsalabim-memory-')
+        try:
+            build_audio_index(folder, out_dir, options['workers'], memory=memory, budget=index_budget)
+            with track_memory('open index', memory):
+                index = open_audio_index(out_dir)
+
+            paths = [os.path.join(folder, name) for name in list_midi_files(folder)[:options['queries']]]
+            with track_memory('query featurize', memory, queries=len(paths)):
+                features = [features for _, features, _ in map(featurize_midi_file, paths) if features]
+            max_cells = cells_for_budget(query_budget)
+            with track_memory('query score', memory, queries=len(features), max_cells=max_cells):
+                rank_queries(index, features, max_cells=max_cells)
+            del index
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+        return memory
+
+    def measure_cover(self, folder, options, index_budget, query_budget):
+        memory = []
+        out_dir = tempfile.mkdtemp(prefix='simsalabim-memory-')
+        try:
+            build_cover_index(folder, out_dir, settings.COVER_PCA_COMPONENTS, options['workers'],
+                              memory=memory, budget=index_budget)
+            with track_memory('open index', memory):
+                index = open_cover_index(out_dir)
+
+            paths = [os.path.join(folder, name) for name in list_cover_images(folder)[:options['queries']]]
+            with track_memory('query decode', memory, queries=len(paths)):
+                query_matrix = np.stack([image_to_pixels(path) for path in paths])
+            with track_memory('query search', memory, queries=len(paths)):
+                find_similar_covers_batch(index, query_matrix)
+            del index
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+        return memory
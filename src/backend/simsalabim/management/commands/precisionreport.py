@@ -0,0 +1,45 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.audio_index import AUDIO_FOLDER, PRECISIONS, load_audio_index
+from simsalabim.benchmarks.precision import DEFAULT_QUERIES, DEFAULT_TOP_K, compare_precisions
+
+
+class Command(BaseCommand):
+    help = (
+        "Rewrites the live audio index in every storage precision (in a scratch "
+        "directory) and reports its size, scoring time and accuracy against float64 "
+        "scoring. The live index is not touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--folder', help="Catalog folder (default: datasets/audio)")
+        parser.add_argument('--precisions', nargs='+', choices=PRECISIONS, default=list(PRECISIONS),
+                            help="Precisions to compare")
+        parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES, help="Catalog songs scored as queries")
+        parser.add_argument('--top', type=int, default=DEFAULT_TOP_K, help="Length of the rankings compared")
+        parser.add_argument('--repeat', type=int, default=1, help="Scoring runs per precision; the fastest is kept")
+        parser.add_argument('--output', help="Write the report as JSON to this file")
+
+    def handle(self, *args, **options):
+        index = load_audio_index(options['folder'] or AUDIO_FOLDER)
+        if index is None:
+            raise CommandError('No audio index. Run "manage.py buildindex audio" first.')
+
+        results = compare_precisions(index, options['queries'], options['precisions'], options['top'],
+                                     options['repeat'])
+        self.stdout.write(f"[precision] {len(index['songs'])} songs, {options['queries']} queries, top {options['top']}:")
+        self.stdout.write(f"    {'precision':<10}{'MiB':>9}{'smaller':>9}{'seconds':>9}"
+                          f"{'max err':>10}{'mean err':>10}{'top-1':>8}{'top-k':>8}")
+        for result in results:
+            self.stdout.write(
+                f"    {result['precision']:<10}{result['bytes'] / 2**20:9.1f}{result['ratio']:8.1f}x"
+                f"{result['seconds']:9.3f}{result['max_error']:10.2e}{result['mean_error']:10.2e}"
+                f"{result['top1']:8.1%}{result['overlap']:8.1%}"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({"songs": len(index["songs"]), "queries": options['queries'], "top_k": options['top'],
+                           "results": results}, f, indent=4)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.audio_index import AUDIO_FOLDER
+from simsalabim.search_shards import parse_address, serve_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves one shard of the audio index for scatter-gather search. List the "
+        "addresses of all shards, in shard order, in AUDIO_SEARCH_SHARDS. Needs the "
+        "shared secret in SIMSALABIM_SHARD_AUTHKEY."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('address', help='"host:port" or Unix socket path to listen on')
+        parser.add_argument('--shard', type=int, required=True, help="Shard number, starting at 0")
+        parser.add_argument('--shards', type=int, required=True, help="Total number of shards")
+
+    def handle(self, *args, **options):
+        if not 0 <= options['shard'] < options['shards']:
+            raise CommandError("--shard must be between 0 and --shards - 1")
+        if not settings.AUDIO_SHARD_AUTHKEY:
+            raise CommandError("Set SIMSALABIM_SHARD_AUTHKEY to the secret shared with the coordinator")
+        # The secret is set explicitly, so the shard may listen on a remote address
+        serve_shard(
+            parse_address(options['address']), options['shard'], options['shards'],
+            AUDIO_FOLDER, settings.AUDIO_SHARD_AUTHKEY, allow_remote=True
+        )
@@ -0,0 +1,44 @@
+import io
+import os
+import pstats
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from simsalabim.profiling import PROFILE_SUFFIX, load_profile_summary
+
+
+class Command(BaseCommand):
+    help = "Prints the stage durations and the hottest functions of a profiled request."
+
+    def add_arguments(self, parser):
+        parser.add_argument('request_id', nargs='?',
+                            help="Id from the X-Simsalabim-Profile-Id header (default: list stored profiles)")
+        parser.add_argument('--sort', default='cumulative', help="pstats sort key (cumulative, tottime, calls, ...)")
+        parser.add_argument('--limit', type=int, default=30, help="Functions to print")
+
+    def handle(self, *args, **options):
+        request_id = options['request_id']
+        if not request_id:
+            summaries = [
+                load_profile_summary(name[:-len(PROFILE_SUFFIX)])
+                for name in (os.listdir(settings.PROFILE_DIR) if os.path.isdir(settings.PROFILE_DIR) else [])
+                if name.endswith(PROFILE_SUFFIX)
+            ]
+            for summary in sorted(filter(None, summaries), key=lambda summary: summary["timestamp"]):
+                self.stdout.write(f"{summary['request_id']}  {summary['total_seconds'] * 1000:9.1f} ms  "
+                                  f"{summary['status']}  {summary['method']} {summary['path']}")
+            return
+
+        summary = load_profile_summary(request_id)
+        if summary is None:
+            raise CommandError(f"No profile {request_id} in {settings.PROFILE_DIR}")
+        self.stdout.write(f"{summary['method']} {summary['path']} -> {summary['status']} "
+                          f"in {summary['total_seconds'] * 1000:.1f} ms")
+        for stage in summary['stages']:
+            self.stdout.write(f"    {stage['stage']:<20} {stage['seconds'] * 1000:9.2f} ms  x{stage['count']}")
+
+        # pstats writes piecewise; collect its report so the command output keeps pstats' line breaks
+        report = io.StringIO()
+        stats = pstats.Stats(os.path.join(settings.PROFILE_DIR, request_id + PROFILE_SUFFIX), stream=report)
+        stats.sort_stats(options['sort']).print_stats(options['limit'])
+        self.stdout.write(report.getvalue(), ending='')
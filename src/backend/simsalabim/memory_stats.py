@@ -0,0 +1,206 @@
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+from .metrics import REGISTRY
+
+# Fields of /proc/<pid>/smaps_rollup reported per worker (values in kB)
+SMAPS_FIELDS = {
+    'Rss': 'rss',
+    'Pss': 'pss',
+    'Shared_Clean': 'shared_clean',
+    'Shared_Dirty': 'shared_dirty',
+    'Private_Clean': 'private_clean',
+    'Private_Dirty': 'private_dirty',
+    'Swap': 'swap',
+}
+
+
+def process_memory(pid=None):
+    """
+    Reports the memory use of one process in bytes.
+
+    On Linux the proportional set size (pss) is included: pages shared with
+    other workers, such as memory-mapped index files, are split between the
+    processes that map them, so the pss of all workers adds up to their real
+    footprint on the host.
+
+    Args:
+        pid: Process id; defaults to the current process
+
+    Returns:
+        Dictionary with pid and rss plus, where available, pss and the
+        shared/private breakdown
+    """
+    pid = pid or os.getpid()
+    usage = {"pid": pid}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in SMAPS_FIELDS:
+                    usage[SMAPS_FIELDS[key]] = int(value.split()[0]) * 1024
+        return usage
+    except OSError:
+        pass
+
+    try:
+        # Kernels without smaps_rollup still have statm (values in pages)
+        with open(f'/proc/{pid}/statm') as f:
+            _, resident, shared = (int(v) for v in f.read().split()[:3])
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        usage["rss"] = resident * page_size
+        usage["shared"] = shared * page_size
+    except OSError:
+        try:
+            import resource  # Not available on Windows
+        except ImportError:
+            return usage
+        # Peak RSS of the current process only; ru_maxrss is in kB on Linux and bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage["max_rss"] = max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+    return usage
+
+
+def index_memory(index):
+    """
+    Sums the array sizes of a loaded index by where they live.
+
+    Returns:
+        Dictionary with mapped_bytes (memory-mapped files, shared between
+        workers) and heap_bytes (private to this worker)
+    """
+    totals = {"mapped_bytes": 0, "heap_bytes": 0}
+
+    def visit(value):
+        if isinstance(value, np.memmap):
+            totals["mapped_bytes"] += value.nbytes
+        elif isinstance(value, np.ndarray):
+            totals["heap_bytes"] += value.nbytes
+        elif isinstance(value, dict):
+            for item in value.values():
+                visit(item)
+
+    if index is not None:
+        visit(index)
+    return totals
+
+
+STAGE_PEAK_RSS = REGISTRY.gauge(
+    'simsalabim_stage_peak_rss_bytes', 'Peak resident memory during the last run of a tracked stage.', ('stage',)
+)
+
+
+def _status_bytes(field):
+    # VmRSS / VmHWM of the current process from /proc/self/status (kB), or None off Linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """
+    Returns the resident set size of the current process in bytes, or None if unknown.
+    """
+    rss = _status_bytes('VmRSS')
+    if rss is None:
+        rss = process_memory().get('rss')
+    return rss
+
+
+def reset_peak_rss():
+    """
+    Resets the kernel's peak-RSS counter of this process (Linux 4.0+).
+
+    Returns:
+        Whether the peak can be read per stage afterwards
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def track_memory(stage, report, **info):
+    """
+    Records the memory used by a pipeline stage.
+
+    The peak resident set size is exact on Linux (the kernel's high-water
+    mark is reset when the stage starts); elsewhere the larger of the RSS
+    before and after the stage is used. When tracemalloc is tracing, the
+    peak of Python and numpy allocations made by the stage is recorded too.
+
+    Args:
+        stage: Stage name
+        report: List the measurement is appended to, or None to skip accounting
+        **info: Extra fields stored with the measurement (e.g. mode, rows)
+    """
+    if report is None:
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    rss_before = current_rss()
+    exact_peak = reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        rss_after = current_rss()
+        peak = _status_bytes('VmHWM') if exact_peak else None
+        if peak is None and rss_before is not None and rss_after is not None:
+            peak = max(rss_before, rss_after)
+        measurement = {
+            "stage": stage,
+            "seconds": seconds,
+            "rss_before": rss_before,
+            "rss_after": rss_after,
+            "rss_peak": peak,
+            "exact_peak": exact_peak,
+            **info,
+        }
+        if tracing:
+            measurement["traced_peak"] = tracemalloc.get_traced_memory()[1]
+        report.append(measurement)
+        if peak is not None:
+            STAGE_PEAK_RSS.set(peak, stage=stage)
+
+
+def _mib(value):
+    return f"{value / 2**20:9.1f}" if value is not None else f"{'-':>9}"
+
+
+def memory_report_lines(report):
+    """
+    Formats track_memory measurements as a table (MiB).
+    """
+    lines = [f"    {'stage':<22} {'seconds':>8} {'rss':>9} {'peak':>9} {'growth':>9} {'traced':>9}  notes"]
+    for entry in report:
+        growth = (entry["rss_peak"] - entry["rss_before"]
+                  if entry["rss_peak"] is not None and entry["rss_before"] is not None else None)
+        notes = ', '.join(
+            f"{key}={value}" for key, value in entry.items()
+            if key not in ("stage", "seconds", "rss_before", "rss_after", "rss_peak", "exact_peak", "traced_peak")
+            and value is not None
+        )
+        if not entry["exact_peak"]:
+            notes = (notes + ', ' if notes else '') + 'peak estimated'
+        lines.append(
+            f"    {entry['stage']:<22} {entry['seconds']:8.2f} {_mib(entry['rss_after'])} {_mib(entry['rss_peak'])} "
+            f"{_mib(growth)} {_mib(entry.get('traced_peak'))}  {notes}"
+        )
+    return lines
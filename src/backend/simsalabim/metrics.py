@@ -0,0 +1,228 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Latency buckets in seconds, from sub-millisecond histogram steps to multi-second uploads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels.
+
+    Recording is one dictionary update under a lock; nothing is formatted
+    until the metrics endpoint is scraped.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Sets the total directly, for counts kept elsewhere (e.g. ResultCache hits)."""
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, self.labelnames, key, value) for key, value in items]
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, optionally split by labels.
+    """
+    kind = 'gauge'
+
+    def clear(self):
+        """Drops every label combination, e.g. before a collector sets the current ones."""
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """
+    Latency histogram with cumulative buckets, optionally split by labels.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (last one is +Inf), sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    def count(self, **labels):
+        series = self._series.get(tuple(labels.get(name, '') for name in self.labelnames))
+        return sum(series[0]) if series else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        samples = []
+        bucket_labels = self.labelnames + ('le',)
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', bucket_labels, key + (_format_value(bound),), cumulative))
+            samples.append((self.name + '_sum', self.labelnames, key, total))
+            samples.append((self.name + '_count', self.labelnames, key, cumulative))
+        return samples
+
+
+class Registry:
+    """
+    Metrics of one process plus collectors that are only run when scraped.
+
+    Every worker process has its own registry; a scrape reports the worker
+    that answered it, so run Prometheus against each worker (or a single
+    worker) to see complete numbers.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def register_collector(self, collect):
+        """
+        Adds a callable run on every scrape that updates gauges before they are rendered,
+        for values that are cheaper to read on demand (corpus sizes, cache statistics).
+        """
+        with self._lock:
+            if collect not in self._collectors:
+                self._collectors.append(collect)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        for collect in list(self._collectors):
+            try:
+                collect()
+            except Exception as e:
+                print(f"ERROR: Metrics collector {getattr(collect, '__name__', collect)} failed: {e}")
+
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for sample_name, labelnames, values, value in metric.samples():
+                lines.append(f'{sample_name}{_format_labels(labelnames, values)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'simsalabim_stage_seconds', 'Time spent per pipeline stage in seconds.', ('stage',)
+)
+STAGE_ERRORS = REGISTRY.counter(
+    'simsalabim_stage_errors_total', 'Pipeline stages that raised an exception.', ('stage',)
+)
+CHANNEL_SCORE_SECONDS = REGISTRY.histogram(
+    'simsalabim_channel_score_seconds', 'Time spent scoring a query against one audio channel in seconds.', ('channel',)
+)
+
+
+# Stage durations of the request being profiled (see profiling.ProfilingMiddleware); None when not profiling
+request_stages = ContextVar('simsalabim_request_stages', default=None)
+
+
+def record_stage(stage, seconds):
+    """
+    Adds one stage duration to simsalabim_stage_seconds and to the profiled request, if any.
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    stages = request_stages.get()
+    if stages is not None:
+        stages.append((stage, seconds))
+
+
+def record_channel_score(channel, seconds):
+    """
+    Adds the time spent scoring one audio channel.
+    """
+    CHANNEL_SCORE_SECONDS.observe(seconds, channel=channel)
+    stages = request_stages.get()
+    if stages is not None:
+        stages.append((f'score_ch{channel}', seconds))
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Records the duration of the enclosed block in simsalabim_stage_seconds.
+
+    Exceptions are counted in simsalabim_stage_errors and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start)
@@ -0,0 +1,351 @@
+import os
+import time
+import tempfile
+import numpy as np
+import mido
+from concurrent.futures import ProcessPoolExecutor
+
+from .audio_index import (
+    CHANNELS, SEGMENT_LENGTH, SLIDING_WINDOW, list_midi_files, normalize_segments, normalize_timing_segments,
+    write_audio_index, blocks_for_budget, estimate_write_bytes
+)
+from .index_files import INDEX_DIRNAME, file_token
+from .metrics import stage_timer
+from .memory_stats import track_memory
+
+# Note events of a whole catalog, kept next to its index generations
+NOTE_STORE_FILE = 'notes.npz'
+
+# MIDI channels; every song has one offsets entry per channel
+N_CHANNELS = 16
+
+_EMPTY_EVENTS = {
+    'pitch': np.empty(0, dtype=np.uint8),
+    'velocity': np.empty(0, dtype=np.uint8),
+    'tick': np.empty(0, dtype=np.int64),
+    'channel': np.empty(0, dtype=np.uint8),
+}
+
+
+def note_store_path(audio_folder):
+    """
+    Returns where the note store of a dataset folder is kept.
+    """
+    return os.path.join(audio_folder, INDEX_DIRNAME, NOTE_STORE_FILE)
+
+
+def extract_note_events(mid):
+    """
+    Collects every sounding note of a MIDI file as columns, grouped by channel.
+
+    Notes are the note_on messages with a velocity above zero, as in
+    extract_notes_by_channel. Within a channel they keep the order of the
+    tracks and messages. The tick is the running sum of message times over
+    all tracks one after another, the same clock
+    tesmidi.extract_notes_and_timing_by_channel uses for its timing features.
+
+    Args:
+        mid: Parsed mido.MidiFile
+
+    Returns:
+        Dictionary of pitch, velocity, tick and channel arrays
+    """
+    pitch, velocity, tick, channel = [], [], [], []
+    cumulative_time = 0
+    for track in mid.tracks:
+        for msg in track:
+            cumulative_time += msg.time
+            if msg.type == 'note_on' and msg.velocity > 0:
+                pitch.append(msg.note)
+                velocity.append(msg.velocity)
+                tick.append(cumulative_time)
+                channel.append(msg.channel)
+
+    channel = np.array(channel, dtype=np.uint8)
+    order = np.argsort(channel, kind='stable')
+    return {
+        'pitch': np.array(pitch, dtype=np.uint8)[order],
+        'velocity': np.array(velocity, dtype=np.uint8)[order],
+        'tick': np.array(tick, dtype=np.int64)[order],
+        'channel': channel[order],
+    }
+
+
+def extract_note_events_file(file_path):
+    """
+    Parses one MIDI file into note events, for use in a worker process.
+
+    Returns:
+        Tuple of (file_name, events or None, error message or None)
+    """
+    file_name = os.path.basename(file_path)
+    try:
+        with stage_timer('midi_parse'):
+            mid = mido.MidiFile(file_path)
+        return file_name, extract_note_events(mid), None
+    except Exception as e:
+        return file_name, None, str(e)
+
+
+def song_events(store, song_id, channel=None):
+    """
+    Returns the event columns of one song, or of one channel of it, as views into the store.
+    """
+    first = song_id * N_CHANNELS
+    start = store['offsets'][first if channel is None else first + channel]
+    end = store['offsets'][first + N_CHANNELS if channel is None else first + channel + 1]
+    return {column: store[column][start:end] for column in _EMPTY_EVENTS}
+
+
+def write_note_store(path, songs, tokens, song_event_list):
+    """
+    Writes the note events of a catalog as one binary file.
+
+    The columns of all songs are concatenated into flat arrays. The events of
+    song s on channel c are rows offsets[16 * s + c] to offsets[16 * s + c + 1].
+    The file is written through a temporary file and a rename.
+
+    Args:
+        path: File to write
+        songs: Song names, in store order
+        tokens: file_token of every song when it was parsed
+        song_event_list: Event dictionaries (see extract_note_events), aligned with songs
+    """
+    counts = np.zeros((len(songs), N_CHANNELS), dtype=np.int64)
+    for song_id, events in enumerate(song_event_list):
+        counts[song_id] = np.bincount(events['channel'], minlength=N_CHANNELS)
+    offsets = np.concatenate([[0], np.cumsum(counts.ravel())]).astype(np.int64)
+
+    columns = {
+        column: np.concatenate([events[column] for events in song_event_list] + [empty])
+        for column, empty in _EMPTY_EVENTS.items()
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(
+                f, songs=np.array(songs, dtype=str), tokens=np.array(tokens, dtype=np.int64).reshape(-1, 3),
+                offsets=offsets, **columns
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_note_store(path):
+    """
+    Loads a note store into memory.
+
+    Returns:
+        Dictionary with songs, song_ids (name -> row), tokens, offsets and the
+        pitch, velocity, tick and channel columns, or None if the file is missing
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        store = {name: data[name] for name in data.files}
+    store['songs'] = store['songs'].tolist()
+    store['song_ids'] = {name: song_id for song_id, name in enumerate(store['songs'])}
+    return store
+
+
+def build_note_store(audio_folder, path=None, workers=1, progress=None):
+    """
+    Extracts the note events of every song in a folder and saves them as the note store.
+
+    Songs whose file is unchanged since the previous store was written are
+    copied from it instead of being parsed again.
+
+    Args:
+        audio_folder: Folder containing the .mid files
+        path: Store file (default: note_store_path(audio_folder))
+        workers: Number of processes used to parse the MIDI files
+        progress: Optional callback(done, total) called while parsing
+
+    Returns:
+        Tuple of (store, number of songs parsed, list of (file_name, error) for skipped files)
+    """
+    path = path or note_store_path(audio_folder)
+    previous = load_note_store(path)
+
+    songs, tokens, events, to_parse = [], [], {}, []
+    for file_name in list_midi_files(audio_folder):
+        token = file_token(os.path.join(audio_folder, file_name))
+        song_id = previous['song_ids'].get(file_name) if previous else None
+        if song_id is not None and tuple(previous['tokens'][song_id]) == token:
+            events[file_name] = song_events(previous, song_id)
+        else:
+            to_parse.append(os.path.join(audio_folder, file_name))
+        songs.append(file_name)
+        tokens.append(token)
+
+    if workers > 1 and len(to_parse) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = _collect(executor.map(extract_note_events_file, to_parse, chunksize=8), len(to_parse), progress)
+    else:
+        parsed = _collect(map(extract_note_events_file, to_parse), len(to_parse), progress)
+
+    skipped = []
+    for file_name, file_events, error in parsed:
+        if error is not None:
+            print(f"Skipping corrupted file: {file_name}. Error: {error}")
+            skipped.append((file_name, error))
+        else:
+            events[file_name] = file_events
+
+    kept = [i for i, name in enumerate(songs) if name in events]
+    write_note_store(path, [songs[i] for i in kept], [tokens[i] for i in kept], [events[songs[i]] for i in kept])
+    return load_note_store(path), len(to_parse), skipped
+
+
+def _collect(results, total, progress):
+    parsed = []
+    for result in results:
+        parsed.append(result)
+        if progress:
+            progress(len(parsed), total)
+    return parsed
+
+
+def channel_ranges(store, channel):
+    """
+    Returns the (starts, ends) event rows of one channel for every song.
+    """
+    offsets = store['offsets']
+    return offsets[channel:-1:N_CHANNELS], offsets[channel + 1::N_CHANNELS]
+
+
+def window_starts(starts, ends, segment_length=SEGMENT_LENGTH, sliding_window=SLIDING_WINDOW):
+    """
+    Computes the first event row of every window of every song in one pass.
+
+    Windows are cut as in audio_index.segment_notes: segment_length events,
+    advancing by segment_length - sliding_window, only complete windows.
+
+    Returns:
+        Tuple of (first row of every window, per-song window offsets of length n_songs + 1)
+    """
+    step = segment_length - sliding_window
+    lengths = ends - starts
+    counts = np.where(lengths >= segment_length, (lengths - segment_length) // step + 1, 0)
+    window_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    song_of = np.repeat(np.arange(len(counts)), counts)
+    within = np.arange(window_offsets[-1]) - window_offsets[song_of]
+    return starts[song_of] + within * step, window_offsets
+
+
+def segment_store(store, channel, segment_length=SEGMENT_LENGTH, sliding_window=SLIDING_WINDOW, column='pitch'):
+    """
+    Cuts one channel of every song into windows without touching the MIDI files.
+
+    Returns:
+        Tuple of (array of shape (n_windows, segment_length) with the column
+        values, per-song window offsets of length n_songs + 1)
+    """
+    first, window_offsets = window_starts(*channel_ranges(store, channel), segment_length, sliding_window)
+    return store[column][first[:, None] + np.arange(segment_length)], window_offsets
+
+
+def featurize_store(store, channels=CHANNELS, segment_length=SEGMENT_LENGTH, sliding_window=SLIDING_WINDOW):
+    """
+    Derives the normalized note segments of the whole catalog from the store.
+
+    For the default segmentation the result equals running featurize_midi on
+    every file, but all windows of a channel are cut and normalized at once.
+
+    Returns:
+        Tuple of (song names, list of channel -> segments dictionaries) for the
+        songs with at least one segment, ready for write_audio_index
+    """
+    song_features = [{} for _ in store['songs']]
+    with stage_timer('segmentation'):
+        for channel in channels:
+            segments, window_offsets = segment_store(store, channel, segment_length, sliding_window)
+            segments = normalize_segments(segments)
+            for song_id in np.flatnonzero(np.diff(window_offsets)):
+                song_features[song_id][channel] = segments[window_offsets[song_id]:window_offsets[song_id + 1]]
+
+    songs = [name for name, features in zip(store['songs'], song_features) if features]
+    return songs, [features for features in song_features if features]
+
+
+def featurize_timing_store(store, songs, channels=CHANNELS, segment_length=SEGMENT_LENGTH,
+                           sliding_window=SLIDING_WINDOW):
+    """
+    Derives the timing of the windows of featurize_store from the store.
+
+    Delta and onset times are cut from the same window rows as the notes.
+    The deltas of the whole catalog are one diff over the tick column,
+    restarted at the first note of every song and channel, and all windows
+    of a channel are normalized at once.
+
+    Args:
+        store: Note store returned by load_note_store
+        songs: Song names the timing is returned for (e.g. from featurize_store)
+
+    Returns:
+        List of channel -> timing_segments dictionaries, aligned with songs
+    """
+    ticks = store['tick']
+    delta = np.diff(ticks, prepend=0)
+    run_starts = store['offsets'][:-1]
+    run_starts = run_starts[run_starts < len(ticks)]
+    delta[run_starts] = ticks[run_starts]
+
+    song_ids = [store['song_ids'][name] for name in songs]
+    song_timing = [{} for _ in songs]
+    with stage_timer('timing_segmentation'):
+        for channel in channels:
+            first, window_offsets = window_starts(*channel_ranges(store, channel), segment_length, sliding_window)
+            rows = first[:, None] + np.arange(segment_length)
+            normalized = {
+                'delta': normalize_timing_segments(delta[rows], 0).astype(np.uint8),
+                'onset': normalize_timing_segments(ticks[rows], 0).astype(np.uint8),
+            }
+            for position, song_id in enumerate(song_ids):
+                start, end = window_offsets[song_id], window_offsets[song_id + 1]
+                if end > start:
+                    song_timing[position][channel] = {kind: values[start:end] for kind, values in normalized.items()}
+    return song_timing
+
+
+def build_audio_index_from_notes(audio_folder, out_dir, workers=1, progress=None, timings=None, memory=None,
+                                 budget=None, timing=False, precision='float64', dedup=True):
+    """
+    Writes the audio feature index from the note store instead of featurizing every file.
+
+    The store is brought up to date first, so only new and changed files are
+    parsed. Takes the same arguments and returns the same as
+    audio_index.build_audio_index; with timing the DTB and OTB histograms
+    are stored in the index too.
+    """
+    timings = {} if timings is None else timings
+
+    start = time.perf_counter()
+    with track_memory('parse', memory):
+        store, parsed, skipped = build_note_store(audio_folder, workers=workers, progress=progress)
+    timings['parse'] = time.perf_counter() - start
+    print(f"DEBUG: Note store holds {len(store['songs'])} songs, {parsed} parsed again")
+
+    start = time.perf_counter()
+    with track_memory('segment', memory, events=len(store['pitch'])):
+        songs, song_features = featurize_store(store)
+        song_timing = featurize_timing_store(store, songs) if timing else None
+    timings['segment'] = time.perf_counter() - start
+    del store
+
+    block_rows = blocks_for_budget(song_features, budget)
+    if block_rows:
+        print(f"DEBUG: Histograms need ~{estimate_write_bytes(song_features) / 2**20:.0f} MiB, more than the "
+              f"{budget / 2**20:.0f} MiB budget; writing in blocks of {block_rows} segments")
+
+    start = time.perf_counter()
+    with track_memory('histogram+write', memory, mode='blocked' if block_rows else 'in-memory', block_rows=block_rows):
+        write_audio_index(out_dir, songs, song_features, block_rows=block_rows, song_timing=song_timing,
+                          precision=precision, dedup=dedup)
+    timings['histogram+write'] = time.perf_counter() - start
+
+    return songs, skipped
@@ -0,0 +1,97 @@
+import numpy as np
+from PIL import Image
+
+# dHash compares horizontally adjacent pixels of a 9x8 thumbnail -> 64 bits
+HASH_SIZE = 8
+
+# Covers whose hashes differ in at most this many bits are near-duplicates
+NEAR_DUPLICATE_BITS = 4
+
+
+def dhash(grayscale, hash_size=HASH_SIZE):
+    """
+    Computes the difference hash (dHash) of a grayscale image.
+
+    Args:
+        grayscale: 2-D uint8 array or a grayscale PIL image
+
+    Returns:
+        Hash as a Python int with hash_size * hash_size bits
+    """
+    img = grayscale if isinstance(grayscale, Image.Image) else Image.fromarray(np.asarray(grayscale, dtype=np.uint8))
+    small = np.asarray(img.resize((hash_size + 1, hash_size), Image.Resampling.BOX), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(hash1, hash2):
+    """
+    Counts the bits that differ between two hashes.
+    """
+    return (hash1 ^ hash2).bit_count()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over integer hashes with Hamming distance.
+
+    Range queries only descend into children whose edge distance lies
+    within [d - radius, d + radius] of the query, so a lookup for near
+    duplicates touches a small part of the tree.
+    """
+
+    def __init__(self, hashes=()):
+        self.root = None
+        self.size = 0
+        for idx, value in enumerate(hashes):
+            self.add(int(value), idx)
+
+    def add(self, value, item):
+        """
+        Inserts a hash together with the item (e.g. a row index) it belongs to.
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            node_value, items, children = node
+            distance = hamming_distance(value, node_value)
+            if distance == 0:
+                items.append(item)
+                return
+            child = children.get(distance)
+            if child is None:
+                children[distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, radius=NEAR_DUPLICATE_BITS):
+        """
+        Finds every stored item whose hash is within `radius` bits of `value`.
+
+        Returns:
+            List of (hamming_distance, item), closest first
+        """
+        if self.root is None:
+            return []
+
+        matches = []
+        stack = [self.root]
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= radius:
+                matches.extend((distance, item) for item in items)
+            for edge in range(max(1, distance - radius), distance + radius + 1):
+                child = children.get(edge)
+                if child is not None:
+                    stack.append(child)
+
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import uuid
+import cProfile
+import hmac
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .metrics import request_stages
+from .workspaces import write_json_atomic
+
+# Request header or query parameter that turns profiling on for one request
+PROFILE_HEADER = 'HTTP_X_SIMSALABIM_PROFILE'
+PROFILE_PARAM = 'profile'
+
+# Header (or query parameter) carrying settings.PROFILING_TOKEN for callers without a staff session
+TOKEN_HEADER = 'HTTP_X_SIMSALABIM_PROFILE_TOKEN'
+TOKEN_PARAM = 'profile_token'
+
+PROFILE_SUFFIX = '.prof'
+SUMMARY_SUFFIX = '.json'
+
+
+def profiling_requested(request):
+    """
+    Returns whether the request asks to be profiled and is allowed to.
+
+    Profiling is reserved for staff users and for callers presenting
+    settings.PROFILING_TOKEN.
+    """
+    if not (request.META.get(PROFILE_HEADER) or request.GET.get(PROFILE_PARAM)):
+        return False
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    token = request.META.get(TOKEN_HEADER) or request.GET.get(TOKEN_PARAM)
+    return bool(settings.PROFILING_TOKEN and token and hmac.compare_digest(token, settings.PROFILING_TOKEN))
+
+
+def stage_totals(stages):
+    """
+    Sums the recorded durations per stage, in order of first appearance.
+
+    Returns:
+        OrderedDict of stage -> (seconds, count)
+    """
+    totals = OrderedDict()
+    for stage, seconds in stages:
+        total, count = totals.get(stage, (0.0, 0))
+        totals[stage] = (total + seconds, count + 1)
+    return totals
+
+
+def server_timing(totals, total_seconds):
+    """
+    Formats stage durations as a Server-Timing header value (milliseconds).
+    """
+    entries = [
+        f'{stage};dur={seconds * 1000:.3f}' + (f';desc="{count}x"' if count > 1 else '')
+        for stage, (seconds, count) in totals.items()
+    ]
+    entries.append(f'total;dur={total_seconds * 1000:.3f}')
+    return ', '.join(entries)
+
+
+def prune_profiles(profile_dir, keep):
+    """
+    Deletes all but the newest keep profiles.
+    """
+    summaries = sorted(
+        (entry for entry in os.scandir(profile_dir) if entry.name.endswith(SUMMARY_SUFFIX)),
+        key=lambda entry: entry.stat().st_mtime, reverse=True
+    )
+    for entry in summaries[keep:]:
+        request_id = entry.name[:-len(SUMMARY_SUFFIX)]
+        for suffix in (SUMMARY_SUFFIX, PROFILE_SUFFIX):
+            try:
+                os.remove(os.path.join(profile_dir, request_id + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def load_profile_summary(request_id, profile_dir=None):
+    """
+    Reads the stored summary of one profiled request, or returns None if it is unknown.
+    """
+    profile_dir = profile_dir or settings.PROFILE_DIR
+    if not request_id or os.path.basename(request_id) != request_id:
+        return None
+    try:
+        with open(os.path.join(profile_dir, request_id + SUMMARY_SUFFIX), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class ProfilingMiddleware:
+    """
+    Profiles single requests to the simsalabim views on demand.
+
+    A request sent with the X-Simsalabim-Profile header (or ?profile=1) by
+    a staff user or with the profiling token runs under cProfile. The
+    profile is stored as <request id>.prof in settings.PROFILE_DIR. The
+    stage durations recorded through metrics.stage_timer are stored next
+    to it and returned in a Server-Timing header. Other requests only pay
+    for the header lookup.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not request.path.startswith('/simsalabim/') or not profiling_requested(request):
+            return self.get_response(request)
+
+        request_id = uuid.uuid4().hex
+        stages = []
+        token = request_stages.set(stages)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        finally:
+            total_seconds = time.perf_counter() - start
+            request_stages.reset(token)
+
+        totals = stage_totals(stages)
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(settings.PROFILE_DIR, request_id + PROFILE_SUFFIX))
+        write_json_atomic(os.path.join(settings.PROFILE_DIR, request_id + SUMMARY_SUFFIX), {
+            "request_id": request_id,
+            "method": request.method,
+            "path": request.get_full_path(),
+            "status": response.status_code,
+            "timestamp": time.time(),
+            "total_seconds": total_seconds,
+            "stages": [
+                {"stage": stage, "seconds": seconds, "count": count}
+                for stage, (seconds, count) in totals.items()
+            ],
+        })
+        prune_profiles(settings.PROFILE_DIR, settings.PROFILE_KEEP)
+        print(f"DEBUG: Profiled {request.method} {request.path} as {request_id} ({total_seconds * 1000:.1f} ms)")
+
+        response['Server-Timing'] = server_timing(totals, total_seconds)
+        response['X-Simsalabim-Profile-Id'] = request_id
+        return response
@@ -0,0 +1,266 @@
+import os
+import time
+import heapq
+import socket
+import struct
+import secrets
+import tempfile
+import ipaddress
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from multiprocessing.connection import Listener, Connection, answer_challenge, deliver_challenge
+
+from .audio_index import AUDIO_FOLDER, load_audio_index, slice_audio_index, score_query, overall_similarities
+
+# Seconds the coordinator waits for all shards before answering with what it has
+DEFAULT_DEADLINE = 2.0
+
+# Slice of the live index served by this process, keyed by (index version, first, end)
+_shard_slices = {}
+# Queries are answered on several threads; the first one after a new generation builds its slice
+_shard_slices_lock = threading.Lock()
+
+
+def parse_address(address):
+    """
+    Turns "host:port" into a TCP address; anything else is a Unix socket path.
+    """
+    if isinstance(address, str) and ':' in address and not os.path.isabs(address):
+        host, port = address.rsplit(':', 1)
+        return (host, int(port))
+    return address
+
+
+def is_local_address(address):
+    """
+    True for Unix socket paths and TCP addresses on a loopback interface.
+    """
+    if not isinstance(address, tuple):
+        return True
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(address[0])).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def check_shard_config(address, authkey, allow_remote=False):
+    """
+    Refuses shard connections that anyone could talk to.
+
+    Shard connections unpickle what they receive, so a secret is always
+    required, and a shard only listens beyond this machine when the caller
+    set that secret explicitly (allow_remote).
+
+    Raises:
+        ValueError: If authkey is empty or address is remote without allow_remote
+    """
+    if not authkey:
+        raise ValueError("Shard connections need a secret: set SIMSALABIM_SHARD_AUTHKEY")
+    if not allow_remote and not is_local_address(address):
+        raise ValueError(f"Shard address {address} is not local; remote shards need an explicit secret")
+
+
+def shard_range(n_songs, shard, n_shards):
+    """
+    Returns the contiguous song id range [first, end) served by one shard.
+    """
+    return shard * n_songs // n_shards, (shard + 1) * n_songs // n_shards
+
+
+def search_shard(index, shard, n_shards, query_features, top_k):
+    """
+    Scores a query against one shard of the audio index.
+
+    Aliases of the songs in the shard are returned with them, whichever
+    shard their own id falls in.
+
+    Returns:
+        List of (song_name, similarity), best first, at most top_k long
+    """
+    first, end = shard_range(len(index["songs"]), shard, n_shards)
+    key = (index["version"], first, end)
+    with _shard_slices_lock:
+        shard_index = _shard_slices.get(key)
+        if shard_index is None:
+            # Slicing a deduplicated index gathers its rows, so it is done once per generation
+            _shard_slices.clear()
+            shard_index = _shard_slices[key] = slice_audio_index(index, first, end)
+    scores = overall_similarities(score_query(shard_index, query_features))
+    return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+
+def serve_shard(address, shard, n_shards, audio_folder=AUDIO_FOLDER, authkey=None, ready=None, allow_remote=False):
+    """
+    Serves one shard of the audio index until the process is stopped.
+
+    The live index is looked up on every request, so the shard switches to
+    a newly published generation without a restart.
+
+    Args:
+        address: Unix socket path or (host, port) to listen on
+        shard: Shard number, from 0 to n_shards - 1
+        n_shards: Total number of shards
+        audio_folder: Folder containing the .mid files and their index
+        authkey: Shared secret the coordinator must present (required)
+        ready: Optional connection that receives the bound address once listening
+        allow_remote: Listen on a non-loopback TCP address; only for an explicitly configured secret
+    """
+    check_shard_config(address, authkey, allow_remote)
+    # Listener's default backlog of 1 refuses concurrent searches connecting at the same moment
+    with Listener(address, backlog=socket.SOMAXCONN, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        print(f"DEBUG: Shard {shard}/{n_shards} listening on {listener.address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            # One thread per query; numpy releases the GIL in the matrix products
+            threading.Thread(target=_answer, args=(conn, shard, n_shards, audio_folder), daemon=True).start()
+
+
+def _answer(conn, shard, n_shards, audio_folder):
+    with conn:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        start = time.perf_counter()
+        index = load_audio_index(audio_folder)
+        if index is None:
+            conn.send({"shard": shard, "error": "Audio index has not been built yet."})
+            return
+        results = search_shard(index, shard, n_shards, request["query"], request["top_k"])
+        try:
+            conn.send({
+                "shard": shard,
+                "version": index["version"],
+                "results": results,
+                "seconds": time.perf_counter() - start,
+            })
+        except OSError:
+            # The coordinator gave up waiting (deadline) and closed the connection
+            pass
+
+
+class ShardCoordinator:
+    """
+    Fans a query out to every shard process and merges their top-k lists.
+
+    Shards that fail or miss the deadline are left out of the answer, which
+    is then flagged as partial instead of failing the whole search. One
+    coordinator is shared by all request threads, so every search fans out
+    on threads of its own instead of queueing behind other searches.
+    """
+
+    def __init__(self, addresses, authkey, deadline=DEFAULT_DEADLINE):
+        if not authkey:
+            raise ValueError("Shard connections need a secret: set SIMSALABIM_SHARD_AUTHKEY")
+        self.addresses = [parse_address(address) for address in addresses]
+        self.authkey = authkey
+        self.deadline = deadline
+
+    def _connect(self, address, deadline_at):
+        # Like multiprocessing.connection.Client, but connecting and the
+        # authentication handshake give up at the deadline as well
+        sock = socket.socket(socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(max(deadline_at - time.monotonic(), 0.001))
+            sock.connect(address)
+            # Connection reads the raw descriptor, so the deadline is set as a blocking socket timeout
+            sock.setblocking(True)
+            remaining = max(deadline_at - time.monotonic(), 0.001)
+            timeout = struct.pack('ll', int(remaining), int(remaining % 1 * 1e6))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeout)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeout)
+            conn = Connection(sock.detach())
+        finally:
+            sock.close()
+        try:
+            answer_challenge(conn, self.authkey)
+            deliver_challenge(conn, self.authkey)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _ask(self, address, request, deadline_at):
+        try:
+            with self._connect(address, deadline_at) as conn:
+                conn.send(request)
+                if not conn.poll(max(deadline_at - time.monotonic(), 0)):
+                    return {"error": "deadline exceeded"}
+                return conn.recv()
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+            return {"error": str(e) or type(e).__name__}
+
+    def search(self, query_features, top_k=5):
+        """
+        Runs one query on all shards.
+
+        Returns:
+            Dictionary with results (list of (song_name, similarity), best
+            first), shards, answered, partial and per-shard errors
+        """
+        deadline_at = time.monotonic() + self.deadline
+        request = {"query": query_features, "top_k": top_k}
+        executor = ThreadPoolExecutor(max_workers=max(len(self.addresses), 1))
+        try:
+            futures = [executor.submit(self._ask, address, request, deadline_at) for address in self.addresses]
+            replies = []
+            for future in futures:
+                try:
+                    # Small grace period: _ask itself stops at the deadline
+                    replies.append(future.result(timeout=max(deadline_at - time.monotonic(), 0) + 0.1))
+                except FutureTimeoutError:
+                    replies.append({"error": "deadline exceeded"})
+        finally:
+            # Threads still blocked on a shard end at the socket timeout, which is the deadline
+            executor.shutdown(wait=False)
+
+        merged, errors = {}, {}
+        for shard, reply in enumerate(replies):
+            if "error" in reply:
+                errors[shard] = reply["error"]
+                continue
+            for song_name, similarity in reply["results"]:
+                # Shards may briefly overlap while a new generation is published
+                merged[song_name] = max(similarity, merged.get(song_name, similarity))
+
+        answered = len(replies) - len(errors)
+        return {
+            "results": heapq.nlargest(top_k, merged.items(), key=lambda item: item[1]),
+            "shards": len(replies),
+            "answered": answered,
+            "partial": answered < len(replies),
+            "errors": errors,
+        }
+
+
+def start_local_shards(n_shards, audio_folder=AUDIO_FOLDER, authkey=None):
+    """
+    Starts n_shards shard processes on this machine.
+
+    Unix sockets are used where available, otherwise TCP on localhost. A
+    random secret is generated when authkey is not given.
+
+    Returns:
+        Tuple of (list of addresses, list of processes, authkey)
+    """
+    authkey = authkey or secrets.token_bytes(32)
+    socket_dir = tempfile.mkdtemp(prefix='simsalabim-shards-') if hasattr(os, 'fork') else None
+    addresses, processes = [], []
+    for shard in range(n_shards):
+        address = os.path.join(socket_dir, f'shard-{shard}.sock') if socket_dir else ('127.0.0.1', 0)
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=serve_shard, args=(address, shard, n_shards, audio_folder, authkey, sender), daemon=True
+        )
+        process.start()
+        sender.close()
+        addresses.append(receiver.recv())
+        processes.append(process)
+    return addresses, processes, authkey
@@ -0,0 +1,263 @@
+import os
+import json
+import numpy as np
+
+from .audio_index import (
+    AUDIO_FOLDER, META_FILE, load_audio_index, open_audio_index, select_audio_index, song_features_from_index,
+    score_queries
+)
+from .index_files import (
+    index_dir as live_index_dir, pointer_path, clone_generation, swap_index, file_token, update_lock, IndexChangedError
+)
+
+# Top-N table stored next to the audio index matrices
+NEIGHBOUR_IDS_FILE = 'neighbour_ids.npy'
+NEIGHBOUR_SCORES_FILE = 'neighbour_scores.npy'
+
+DEFAULT_TOP_N = 10
+
+# Catalog songs scored per block; one block holds BLOCK_SONGS x n_songs scores
+BLOCK_SONGS = 64
+
+# Times build_song_neighbours computes the table again when uploads keep replacing the live index
+PUBLISH_ATTEMPTS = 3
+
+# Loaded neighbour tables, keyed by audio folder
+_loaded_tables = {}
+
+
+def _best_neighbours(block, song_ids, top_n):
+    """
+    Keeps the top_n best scores of every row of a (songs x catalog) score block, leaving out the song itself.
+
+    Returns:
+        Tuple of (ids, scores) of shape (len(song_ids), top_n), best first, padded with -1 / NaN
+    """
+    block = np.nan_to_num(block, nan=-np.inf)
+    block[np.arange(len(song_ids)), list(song_ids)] = -np.inf  # A song is not its own neighbour
+    ids = np.full((len(song_ids), top_n), -1, dtype=np.int32)
+    scores = np.full((len(song_ids), top_n), np.nan, dtype=np.float32)
+
+    keep = min(top_n, block.shape[1])
+    # Stable, so equal scores (duplicate songs) are listed by song id and the table does not depend on blocking
+    best = np.argsort(-block, axis=1, kind='stable')[:, :keep]
+    best_scores = np.take_along_axis(block, best, axis=1)
+
+    valid = np.isfinite(best_scores)
+    ids[:, :keep] = np.where(valid, best, -1)
+    scores[:, :keep] = np.where(valid, best_scores, np.nan)
+    return ids, scores
+
+
+def compute_neighbours(index, top_n=DEFAULT_TOP_N, block_songs=BLOCK_SONGS, progress=None):
+    """
+    Scores every catalog song against the whole catalog and keeps its top_n neighbours.
+
+    Each song is used as a query exactly like an uploaded MIDI file (per
+    query segment the best ATB/RTB/FTB match within each song, weighted and
+    averaged as in compare_segments_to_dataset and
+    calculate_highest_similarity). Songs are processed in blocks, so memory
+    stays bounded by block_songs x n_songs scores plus one similarity block.
+
+    Args:
+        index: Audio index returned by load_audio_index
+        top_n: Neighbours kept per song
+        block_songs: Songs scored together
+        progress: Optional callback(done, total)
+
+    Returns:
+        Tuple of (ids, scores): int32 and float32 arrays of shape
+        (n_songs, top_n), best first, padded with -1 / NaN
+    """
+    n_songs = len(index["songs"])
+    ids = np.full((n_songs, top_n), -1, dtype=np.int32)
+    scores = np.full((n_songs, top_n), np.nan, dtype=np.float32)
+    for start in range(0, n_songs, block_songs):
+        song_ids = range(start, min(start + block_songs, n_songs))
+        block = score_queries(index, [song_features_from_index(index, song_id) for song_id in song_ids])
+        ids[start:start + len(song_ids)], scores[start:start + len(song_ids)] = _best_neighbours(block, song_ids, top_n)
+        if progress:
+            progress(start + len(song_ids), n_songs)
+    return ids, scores
+
+
+def _save_table(out_dir, ids, scores):
+    for name, table in ((NEIGHBOUR_IDS_FILE, ids), (NEIGHBOUR_SCORES_FILE, scores)):
+        # Replace linked files of an earlier table instead of writing through the link
+        if os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+        np.save(os.path.join(out_dir, name), table)
+
+
+def neighbour_table_size(directory):
+    """
+    Returns the neighbours kept per song by the table of an index directory, or None if it has none.
+    """
+    path = os.path.join(directory, NEIGHBOUR_IDS_FILE)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r').shape[1]
+
+
+def write_song_neighbours(out_dir, top_n=DEFAULT_TOP_N, block_songs=BLOCK_SONGS, progress=None):
+    """
+    Computes the neighbour table of a staged audio index and stores it with it.
+
+    Used by buildindex, so a rebuilt index is published with its table.
+    """
+    ids, scores = compute_neighbours(open_audio_index(out_dir), top_n, block_songs, progress)
+    _save_table(out_dir, ids, scores)
+
+
+def build_song_neighbours(audio_folder=AUDIO_FOLDER, top_n=DEFAULT_TOP_N, block_songs=BLOCK_SONGS, progress=None):
+    """
+    Computes the neighbour table of the live audio index and publishes it.
+
+    The table is computed without holding update_lock, so uploads are not
+    blocked meanwhile. Under the lock the live generation is cloned (hard
+    links) with the table added, so the table always belongs to the exact
+    index it was computed from; if an upload published a generation in the
+    meantime, the table is computed again for it.
+
+    Returns:
+        Path of the published generation, or None if there is no audio index
+
+    Raises:
+        IndexChangedError: if the live index changed during every attempt
+    """
+    for _ in range(PUBLISH_ATTEMPTS):
+        directory = live_index_dir(audio_folder)
+        index = open_audio_index(directory) if directory else None
+        if index is None:
+            return None
+        ids, scores = compute_neighbours(index, top_n, block_songs, progress)
+
+        with update_lock(audio_folder):
+            if live_index_dir(audio_folder) == directory:
+                out_dir = clone_generation(audio_folder, directory)
+                _save_table(out_dir, ids, scores)
+                return swap_index(audio_folder, out_dir)
+        print("DEBUG: The audio index changed while song neighbours were computed; computing them again")
+    raise IndexChangedError(f"The audio index changed during each of {PUBLISH_ATTEMPTS} neighbour computations")
+
+
+def carry_song_neighbours(old_dir, out_dir, changed, block_songs=BLOCK_SONGS):
+    """
+    Writes the neighbour table of a staged generation derived from one that had a table.
+
+    Called when songs are added to the live index (see
+    audio_index.add_songs_to_index), so similar-songs lookups keep working
+    without another buildneighbours run. Only scores involving the changed
+    songs are computed: they are scored against the whole catalog, every
+    other song only against them, and merged with its stored neighbours.
+    Songs that lose a stored neighbour (a replaced song) are scored again
+    completely, so the result equals compute_neighbours on the new index.
+
+    Args:
+        old_dir: Generation the staged one was derived from
+        out_dir: Staged generation, not published yet
+        changed: Names of the added and replaced songs
+        block_songs: Songs scored together
+
+    Returns:
+        True if a table was written, False if old_dir has none
+    """
+    if not os.path.exists(os.path.join(old_dir, NEIGHBOUR_IDS_FILE)):
+        return False
+    with open(os.path.join(old_dir, META_FILE), 'r') as f:
+        old_songs = json.load(f)["songs"]
+    old_ids = np.load(os.path.join(old_dir, NEIGHBOUR_IDS_FILE))
+    old_scores = np.load(os.path.join(old_dir, NEIGHBOUR_SCORES_FILE))
+    top_n = old_ids.shape[1]
+
+    index = open_audio_index(out_dir)
+    n_songs = len(index["songs"])
+    song_ids = {name: song_id for song_id, name in enumerate(index["songs"])}
+    # Old id -> new id; -1 for removed and changed songs, and (last entry) for padding
+    remap = np.array(
+        [-1 if name in changed else song_ids.get(name, -1) for name in old_songs] + [-1], dtype=np.int32
+    )
+    kept = {song_id for song_id in remap if song_id >= 0}
+    fresh = np.array([song_id for song_id in range(n_songs) if song_id not in kept], dtype=np.int32)
+
+    ids = np.full((n_songs, top_n), -1, dtype=np.int32)
+    scores = np.full((n_songs, top_n), np.nan, dtype=np.float32)
+    rescore, merge = list(fresh), []
+    for old_id, song_id in enumerate(remap[:-1]):
+        if song_id < 0:
+            continue
+        if np.any((old_ids[old_id] >= 0) & (remap[old_ids[old_id]] < 0)):
+            rescore.append(song_id)
+        else:
+            merge.append((song_id, old_id))
+
+    for start in range(0, len(rescore), block_songs):
+        rows = sorted(rescore[start:start + block_songs])
+        block = score_queries(index, [song_features_from_index(index, song_id) for song_id in rows])
+        ids[rows], scores[rows] = _best_neighbours(block, rows, top_n)
+
+    # Aliases have no rows of their own, so the changed songs are scored through their representatives
+    changed_index = select_audio_index(index, np.unique(index["alias_of"][fresh])) if len(fresh) else None
+    for start in range(0, len(merge), block_songs):
+        rows = merge[start:start + block_songs]
+        block = np.full((len(rows), n_songs), -np.inf)
+        for row, (_, old_id) in enumerate(rows):
+            valid = old_ids[old_id] >= 0
+            block[row, remap[old_ids[old_id][valid]]] = old_scores[old_id][valid]
+        if changed_index is not None:
+            changed_scores = score_queries(changed_index, [song_features_from_index(index, song_id) for song_id, _ in rows])
+            block[:, fresh] = np.nan_to_num(changed_scores[:, fresh], nan=-np.inf)
+        new_ids = [song_id for song_id, _ in rows]
+        ids[new_ids], scores[new_ids] = _best_neighbours(block, new_ids, top_n)
+
+    np.save(os.path.join(out_dir, NEIGHBOUR_IDS_FILE), ids)
+    np.save(os.path.join(out_dir, NEIGHBOUR_SCORES_FILE), scores)
+    print(f"DEBUG: Carried song neighbours forward: {len(rescore)} songs scored in full, "
+          f"{len(merge)} merged with {len(fresh)} changed songs")
+    return True
+
+
+def load_song_neighbours(audio_folder=AUDIO_FOLDER):
+    """
+    Returns the neighbour table of the live audio index, or None if it has none.
+
+    Returns:
+        Dictionary with songs, song_ids (name -> row), ids and scores
+    """
+    token = file_token(pointer_path(audio_folder))
+    cached = _loaded_tables.get(audio_folder)
+    if cached is not None and cached[0] == token:
+        return cached[1]
+
+    table = None
+    directory = live_index_dir(audio_folder)
+    if directory and os.path.exists(os.path.join(directory, NEIGHBOUR_IDS_FILE)):
+        with open(os.path.join(directory, META_FILE), 'r') as f:
+            songs = json.load(f)["songs"]
+        table = {
+            "songs": songs,
+            "song_ids": {name: song_id for song_id, name in enumerate(songs)},
+            "ids": np.load(os.path.join(directory, NEIGHBOUR_IDS_FILE), mmap_mode='r'),
+            "scores": np.load(os.path.join(directory, NEIGHBOUR_SCORES_FILE), mmap_mode='r'),
+        }
+        if len(table["ids"]) != len(songs):
+            table = None
+    _loaded_tables[audio_folder] = (token, table)
+    return table
+
+
+def similar_songs(table, song_name, limit=DEFAULT_TOP_N):
+    """
+    Looks up the stored neighbours of one song: a dictionary lookup and one row read.
+
+    Returns:
+        List of (song_name, similarity), best first, or None for an unknown song
+    """
+    song_id = table["song_ids"].get(song_name)
+    if song_id is None:
+        return None
+    return [
+        (table["songs"][neighbour], float(score))
+        for neighbour, score in zip(table["ids"][song_id][:limit], table["scores"][song_id][:limit])
+        if neighbour >= 0
+    ]
@@ -0,0 +1,415 @@
+import os
+import json
+import numpy as np
+import mido
+from PIL import Image, ImageDraw, ImageEnhance
+from concurrent.futures import ProcessPoolExecutor
+
+from .audio_index import CHANNELS
+
+GROUND_TRUTH_FILE = 'ground_truth.json'
+
+# Items generated per worker task
+CHUNK_SIZE = 256
+
+TICKS_PER_BEAT = 480
+MAJOR = [0, 2, 4, 5, 7, 9, 11]
+MINOR = [0, 2, 3, 5, 7, 8, 10]
+
+# General MIDI percussion channel (0-based) is left alone when transposing
+PERCUSSION_CHANNEL = 9
+DRUM_CHANNEL = CHANNELS[-1]
+DRUM_NOTES = {'kick': 36, 'snare': 38, 'hihat': 42}
+
+COVER_SIZE = (256, 256)
+JPEG_QUALITY = 90
+
+# Stream ids, so the catalog and the query set of one seed never share random numbers
+AUDIO_CATALOG, AUDIO_QUERIES, COVER_CATALOG, COVER_QUERIES = range(4)
+
+
+def item_rng(seed, stream, item):
+    """
+    Returns the random generator of one item.
+
+    Every item has its own generator, so a corpus is identical whatever the
+    number of workers and items can be regenerated individually.
+    """
+    return np.random.default_rng([seed, stream, item])
+
+
+# --- MIDI -----------------------------------------------------------------
+
+def _events_to_track(events, name=None):
+    # events: list of (absolute_tick, order, message); note_off sorts before note_on at the same tick
+    track = mido.MidiTrack()
+    if name:
+        track.append(mido.MetaMessage('track_name', name=name, time=0))
+    last = 0
+    for tick, _, message in sorted(events, key=lambda event: (event[0], event[1])):
+        track.append(message.copy(time=tick - last))
+        last = tick
+    track.append(mido.MetaMessage('end_of_track', time=0))
+    return track
+
+
+def synthesize_song(rng):
+    """
+    Writes a multi-track song: melody, chords, bass and drums on the indexed channels.
+
+    Melodies are built from a few motifs over a random key, repeated with
+    variations in a verse/chorus structure, so songs have the repetition
+    that real catalog songs have.
+
+    Returns:
+        mido.MidiFile
+    """
+    melody_channel, chord_channel, bass_channel = CHANNELS[:3]
+    scale = MAJOR if rng.random() < 0.6 else MINOR
+    root = int(rng.integers(55, 67))
+    bar = 4 * TICKS_PER_BEAT
+
+    def pitch(degree, octave=0):
+        return int(np.clip(root + 12 * (octave + degree // 7) + scale[degree % 7], 0, 127))
+
+    motifs = [rng.integers(-3, 4, size=int(rng.integers(6, 12))).cumsum() for _ in range(3)]
+    sections = ['A', 'A', 'B', 'A', 'C', 'B', 'A'][:int(rng.integers(4, 8))]
+    progression = rng.choice(7, size=4)
+
+    melody, chords, bass, drums = [], [], [], []
+    tick = 0
+    for section in sections:
+        motif = motifs['ABC'.index(section)]
+        for repeat in range(int(rng.integers(2, 5))):
+            # Repeats vary slightly, like a melody sung over different lyrics
+            degrees = motif + (rng.integers(-1, 2, size=len(motif)) if repeat else 0)
+            start = tick
+            for degree in degrees:
+                length = int(rng.choice([TICKS_PER_BEAT // 2, TICKS_PER_BEAT, TICKS_PER_BEAT * 2], p=[0.4, 0.45, 0.15]))
+                note = pitch(int(degree), 1)
+                velocity = int(rng.integers(70, 110))
+                melody.append((tick, 1, mido.Message('note_on', channel=melody_channel, note=note, velocity=velocity)))
+                melody.append((tick + length, 0, mido.Message('note_off', channel=melody_channel, note=note, velocity=0)))
+                tick += length
+            tick = start + -(-(tick - start) // bar) * bar  # Phrases end on a bar line
+
+            for bar_start in range(start, tick, bar):
+                chord_root = int(progression[(bar_start // bar) % len(progression)])
+                for offset in (0, 2, 4):
+                    note = pitch(chord_root + offset)
+                    chords.append((bar_start, 1, mido.Message('note_on', channel=chord_channel, note=note, velocity=60)))
+                    chords.append((bar_start + bar, 0, mido.Message('note_off', channel=chord_channel, note=note, velocity=0)))
+                for beat in range(4):
+                    beat_tick = bar_start + beat * TICKS_PER_BEAT
+                    note = pitch(chord_root + (4 if beat == 2 else 0), -2)
+                    bass.append((beat_tick, 1, mido.Message('note_on', channel=bass_channel, note=note, velocity=80)))
+                    bass.append((beat_tick + TICKS_PER_BEAT, 0,
+                                 mido.Message('note_off', channel=bass_channel, note=note, velocity=0)))
+                    drum = DRUM_NOTES['kick'] if beat % 2 == 0 else DRUM_NOTES['snare']
+                    for note in (drum, DRUM_NOTES['hihat']):
+                        drums.append((beat_tick, 1, mido.Message('note_on', channel=DRUM_CHANNEL, note=note, velocity=90)))
+                        drums.append((beat_tick + TICKS_PER_BEAT // 2, 0,
+                                      mido.Message('note_off', channel=DRUM_CHANNEL, note=note, velocity=0)))
+
+    mid = mido.MidiFile(type=1, ticks_per_beat=TICKS_PER_BEAT)
+    conductor = mido.MidiTrack([
+        mido.MetaMessage('time_signature', numerator=4, denominator=4, time=0),
+        mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(int(rng.integers(70, 160))), time=0),
+        mido.MetaMessage('end_of_track', time=0),
+    ])
+    mid.tracks.append(conductor)
+    for name, channel, program, events in (
+        ('Melody', melody_channel, int(rng.integers(0, 80)), melody),
+        ('Chords', chord_channel, int(rng.integers(0, 24)), chords),
+        ('Bass', bass_channel, int(rng.integers(32, 40)), bass),
+        ('Drums', DRUM_CHANNEL, None, drums),
+    ):
+        if program is not None:
+            events = [(0, -1, mido.Message('program_change', channel=channel, program=program))] + events
+        mid.tracks.append(_events_to_track(events, name))
+    return mid
+
+
+def transpose(mid, semitones):
+    """
+    Shifts every pitched note by semitones, clipped to the MIDI range.
+    """
+    out = mido.MidiFile(type=mid.type, ticks_per_beat=mid.ticks_per_beat)
+    for track in mid.tracks:
+        new_track = mido.MidiTrack()
+        for message in track:
+            if message.type in ('note_on', 'note_off') and message.channel != PERCUSSION_CHANNEL:
+                message = message.copy(note=int(np.clip(message.note + semitones, 0, 127)))
+            new_track.append(message)
+        out.tracks.append(new_track)
+    return out
+
+
+def change_tempo(mid, factor):
+    """
+    Plays a song factor times slower (factor > 1) or faster (factor < 1).
+    """
+    out = mido.MidiFile(type=mid.type, ticks_per_beat=mid.ticks_per_beat)
+    for track in mid.tracks:
+        new_track = mido.MidiTrack()
+        for message in track:
+            if message.is_meta and message.type == 'set_tempo':
+                message = message.copy(tempo=int(np.clip(message.tempo * factor, 1, 16777215)))
+            new_track.append(message)
+        out.tracks.append(new_track)
+    return out
+
+
+def crop(mid, start_fraction, length_fraction):
+    """
+    Keeps the notes between two fractions of the song length, like a query
+    hummed from the middle of a song. Meta and setup messages are kept.
+    """
+    total = max((sum(message.time for message in track) for track in mid.tracks), default=0)
+    first, last = int(total * start_fraction), int(total * (start_fraction + length_fraction))
+    out = mido.MidiFile(type=mid.type, ticks_per_beat=mid.ticks_per_beat)
+    for track in mid.tracks:
+        events, tick = [], 0
+        for order, message in enumerate(track):
+            tick += message.time
+            if message.type == 'end_of_track':
+                continue
+            if message.type in ('note_on', 'note_off'):
+                if first <= tick < last:
+                    events.append((tick - first, order, message))
+            elif tick < last:
+                events.append((max(tick - first, 0), order, message))
+        out.tracks.append(_events_to_track(events))
+    return out
+
+
+def derive_song(mid, rng):
+    """
+    Applies a random transposition and tempo change.
+
+    Returns:
+        Tuple of (mido.MidiFile, description of the transform)
+    """
+    semitones = int(rng.integers(-6, 7))
+    factor = float(rng.uniform(0.8, 1.25))
+    return change_tempo(transpose(mid, semitones), factor), {"transpose": semitones, "tempo": round(factor, 3)}
+
+
+def _save_midi(mid, path):
+    with open(path, 'wb') as f:
+        mid.save(file=f)
+
+
+def _midi_catalog_chunk(args):
+    out_dir, seed, items, sources = args
+    names = []
+    for item in items:
+        rng = item_rng(seed, AUDIO_CATALOG, item)
+        if sources:
+            source = sources[item % len(sources)]
+            mid, _ = derive_song(mido.MidiFile(source), rng)
+            name = f'var_{item:07d}_{os.path.basename(source)}'
+        else:
+            mid = synthesize_song(rng)
+            name = f'syn_{item:07d}.mid'
+        _save_midi(mid, os.path.join(out_dir, name))
+        names.append(name)
+    return names
+
+
+def _midi_query_chunk(args):
+    catalog_dir, out_dir, seed, items, targets = args
+    truth = []
+    for item, target in zip(items, targets):
+        rng = item_rng(seed, AUDIO_QUERIES, item)
+        mid, transform = derive_song(mido.MidiFile(os.path.join(catalog_dir, target)), rng)
+        start, length = float(rng.uniform(0.0, 0.5)), float(rng.uniform(0.3, 0.5))
+        mid = crop(mid, start, length)
+        transform.update(crop_start=round(start, 3), crop_length=round(length, 3))
+        name = f'query_{item:07d}.mid'
+        _save_midi(mid, os.path.join(out_dir, name))
+        truth.append({"query": name, "expected": target, "transform": transform})
+    return truth
+
+
+# --- Covers ---------------------------------------------------------------
+
+def synthesize_cover(rng, size=COVER_SIZE):
+    """
+    Draws an album-cover-like image: a two-color gradient with random shapes.
+
+    Returns:
+        RGB PIL image
+    """
+    top, bottom = rng.integers(0, 256, size=(2, 3))
+    ramp = np.linspace(0.0, 1.0, size[1])[:, None, None]
+    pixels = (top * (1 - ramp) + bottom * ramp) * np.ones((1, size[0], 1))
+    image = Image.fromarray(pixels.astype(np.uint8), 'RGB')
+    draw = ImageDraw.Draw(image)
+    for _ in range(int(rng.integers(3, 9))):
+        x0, y0 = rng.integers(0, size[0] - 16), rng.integers(0, size[1] - 16)
+        x1, y1 = x0 + rng.integers(16, size[0] // 2), y0 + rng.integers(16, size[1] // 2)
+        color = tuple(int(c) for c in rng.integers(0, 256, size=3))
+        shape = rng.integers(0, 3)
+        if shape == 0:
+            draw.ellipse([int(x0), int(y0), int(x1), int(y1)], fill=color)
+        elif shape == 1:
+            draw.rectangle([int(x0), int(y0), int(x1), int(y1)], fill=color)
+        else:
+            points = [(int(x), int(y)) for x, y in rng.integers(0, min(size), size=(3, 2))]
+            draw.polygon(points, fill=color)
+    return image
+
+
+def derive_cover(image, rng):
+    """
+    Applies a random crop, brightness/contrast change and resize.
+
+    Returns:
+        Tuple of (RGB PIL image, description of the transform)
+    """
+    image = image.convert('RGB')
+    width, height = image.size
+    keep = float(rng.uniform(0.85, 1.0))
+    left = int(rng.integers(0, int(width * (1 - keep)) + 1))
+    top = int(rng.integers(0, int(height * (1 - keep)) + 1))
+    image = image.crop((left, top, left + int(width * keep), top + int(height * keep)))
+    brightness, contrast = float(rng.uniform(0.85, 1.15)), float(rng.uniform(0.85, 1.15))
+    image = ImageEnhance.Contrast(ImageEnhance.Brightness(image).enhance(brightness)).enhance(contrast)
+    image = image.resize(COVER_SIZE)
+    return image, {"crop": round(keep, 3), "brightness": round(brightness, 3), "contrast": round(contrast, 3)}
+
+
+def _save_cover(image, path):
+    if path.lower().endswith(('.jpg', '.jpeg')):
+        image.save(path, quality=JPEG_QUALITY)
+    else:
+        image.save(path)
+
+
+def _cover_catalog_chunk(args):
+    out_dir, seed, items, sources, extension = args
+    names = []
+    for item in items:
+        rng = item_rng(seed, COVER_CATALOG, item)
+        if sources:
+            source = sources[item % len(sources)]
+            image, _ = derive_cover(Image.open(source), rng)
+            name = f'var_{item:07d}_{os.path.splitext(os.path.basename(source))[0]}{extension}'
+        else:
+            image = synthesize_cover(rng)
+            name = f'cover_{item:07d}{extension}'
+        _save_cover(image, os.path.join(out_dir, name))
+        names.append(name)
+    return names
+
+
+def _cover_query_chunk(args):
+    catalog_dir, out_dir, seed, items, targets = args
+    truth = []
+    for item, target in zip(items, targets):
+        rng = item_rng(seed, COVER_QUERIES, item)
+        image, transform = derive_cover(Image.open(os.path.join(catalog_dir, target)), rng)
+        # Queries are re-encoded as JPEG, like photos of a cover uploaded by users
+        name = f'query_{item:07d}.jpg'
+        _save_cover(image, os.path.join(out_dir, name))
+        truth.append({"query": name, "expected": target, "transform": transform})
+    return truth
+
+
+# --- Driver ---------------------------------------------------------------
+
+def _run_chunks(worker, tasks, workers, progress, total):
+    results, done = [], 0
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(worker, tasks)
+            for chunk in chunks:
+                results.extend(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, total)
+    else:
+        for task in tasks:
+            chunk = worker(task)
+            results.extend(chunk)
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+    return results
+
+
+def _chunks(count):
+    return [range(start, min(start + CHUNK_SIZE, count)) for start in range(0, count, CHUNK_SIZE)]
+
+
+def generate_catalog(kind, out_dir, count, seed=0, sources=None, image_format='png', workers=1, progress=None):
+    """
+    Writes a seeded catalog of MIDI songs or cover images.
+
+    Args:
+        kind: 'audio' or 'cover'
+        out_dir: Folder the catalog is written to
+        count: Number of items (10k-1M for load tests)
+        seed: Random seed; the same seed always gives the same corpus
+        sources: Optional list of existing files to derive variants from
+            (transposition/tempo for MIDI, crop/brightness for covers)
+            instead of synthesizing new items
+        image_format: 'png' or 'jpg' for covers
+        workers: Number of processes
+        progress: Optional callback(done, total)
+
+    Returns:
+        List of written file names
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    sources = sorted(sources) if sources else None
+    if kind == 'audio':
+        tasks = [(out_dir, seed, items, sources) for items in _chunks(count)]
+        return _run_chunks(_midi_catalog_chunk, tasks, workers, progress, count)
+    extension = '.jpg' if image_format in ('jpg', 'jpeg') else '.png'
+    tasks = [(out_dir, seed, items, sources, extension) for items in _chunks(count)]
+    return _run_chunks(_cover_catalog_chunk, tasks, workers, progress, count)
+
+
+def generate_queries(kind, catalog_dir, out_dir, count, seed=0, workers=1, progress=None):
+    """
+    Writes queries derived from random catalog items and their ground truth.
+
+    MIDI queries are transposed, tempo-changed excerpts of a catalog song;
+    cover queries are cropped, re-lit JPEG copies of a catalog cover. The
+    expected match of every query is stored in ground_truth.json.
+
+    Returns:
+        List of {"query", "expected", "transform"} dictionaries
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    extensions = ('.mid',) if kind == 'audio' else ('.png', '.jpg', '.jpeg')
+    catalog = sorted(name for name in os.listdir(catalog_dir) if name.lower().endswith(extensions))
+    if not catalog:
+        raise ValueError(f"No catalog items in {catalog_dir}")
+    rng = np.random.default_rng([seed, AUDIO_QUERIES if kind == 'audio' else COVER_QUERIES])
+    targets = [catalog[i] for i in rng.integers(0, len(catalog), size=count)]
+
+    worker = _midi_query_chunk if kind == 'audio' else _cover_query_chunk
+    tasks = [(catalog_dir, out_dir, seed, items, targets[items.start:items.stop]) for items in _chunks(count)]
+    truth = _run_chunks(worker, tasks, workers, progress, count)
+    with open(os.path.join(out_dir, GROUND_TRUTH_FILE), 'w') as f:
+        json.dump({"kind": kind, "catalog": os.path.abspath(catalog_dir), "seed": seed, "queries": truth}, f, indent=4)
+    return truth
+
+
+def source_group(name):
+    """
+    Returns the source a catalog item was derived from (var_<item>_<source>),
+    so variants of the same source count as the same match.
+    """
+    return name.split('_', 2)[2] if name.startswith('var_') else name
+
+
+def load_ground_truth(queries_dir):
+    """
+    Reads the ground truth written by generate_queries.
+    """
+    with open(os.path.join(queries_dir, GROUND_TRUTH_FILE), 'r') as f:
+        return json.load(f)
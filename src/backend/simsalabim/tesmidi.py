@@ -4,6 +4,7 @@ import mido
 import numpy as np
 from scipy.spatial.distance import cosine
 
+
 def process_midi_file_timing(file_path, channel, use_delta=True):
     mid = mido.MidiFile(file_path)
     notes_and_timing = extract_notes_and_timing_by_channel(mid, channel, use_delta)
@@ -44,29 +45,51 @@ def process_all_midi_files_timing(folder_path, channel, use_delta=True):
     return midi_data
 
 def process_and_save_timing_data(folder_path):
-    channels = [0, 1, 2, 10]
-    
-    # Process delta times
-    for channel in channels:
-        midi_data = process_all_midi_files_timing(folder_path, channel, use_delta=True)
-        if midi_data:
-            json_file_path = os.path.join(folder_path, f'midi_delta_time_channel_{channel}.json')
-            with open(json_file_path, 'w') as json_file:
-                json.dump(midi_data, json_file, indent=4)
-            print(f"Delta time data for channel {channel} has been saved to {json_file_path}")
-        else:
-            print(f"No delta time data found for channel {channel}")
-    
-    # Process absolute times
-    for channel in channels:
-        midi_data = process_all_midi_files_timing(folder_path, channel, use_delta=False)
-        if midi_data:
-            json_file_path = os.path.join(folder_path, f'midi_absolute_time_channel_{channel}.json')
-            with open(json_file_path, 'w') as json_file:
-                json.dump(midi_data, json_file, indent=4)
-            print(f"Absolute time data for channel {channel} has been saved to {json_file_path}")
-        else:
-            print(f"No absolute time data found for channel {channel}")
+    """
+    Writes the delta and absolute time segments of every channel as JSON.
+
+    Produces the same files as running process_all_midi_files_timing for
+    every channel and both time modes, but every file is parsed once, the
+    delta and absolute times come from the same pass over the messages and
+    all windows of a channel are normalized together. Unreadable files are
+    skipped.
+    """
+    # Imported here so this file still runs as a script (see __main__ below)
+    from .audio_index import (
+        CHANNELS, SEGMENT_LENGTH, extract_timed_notes_by_channel, segment_notes, normalize_segments,
+        normalize_timing_segments, delta_ticks, sliding_windows
+    )
+    timing_data = {(use_delta, channel): {} for use_delta in (True, False) for channel in CHANNELS}
+    for file_name in os.listdir(folder_path):
+        if not file_name.endswith('.mid'):
+            continue
+        try:
+            mid = mido.MidiFile(os.path.join(folder_path, file_name))
+        except Exception as e:
+            print(f"Skipping corrupted file: {file_name}. Error: {e}")
+            continue
+        for channel, (notes, ticks) in extract_timed_notes_by_channel(mid, CHANNELS).items():
+            if len(notes) < SEGMENT_LENGTH:
+                continue
+            normalized_notes = normalize_segments(segment_notes(notes)).tolist()
+            for use_delta in (True, False):
+                times = sliding_windows(delta_ticks(ticks) if use_delta else ticks)
+                timing_data[use_delta, channel][file_name] = [
+                    [{'note': note, 'time': time} for note, time in zip(segment_notes_row, segment_times)]
+                    for segment_notes_row, segment_times in zip(normalized_notes, normalize_timing_segments(times).tolist())
+                ]
+
+    for use_delta, label, prefix in ((True, 'Delta', 'delta'), (False, 'Absolute', 'absolute')):
+        for channel in CHANNELS:
+            midi_data = timing_data[use_delta, channel]
+            if midi_data:
+                json_file_path = os.path.join(folder_path, f'midi_{prefix}_time_channel_{channel}.json')
+                with open(json_file_path, 'w') as json_file:
+                    json.dump(midi_data, json_file, indent=4)
+                print(f"{label} time data for channel {channel} has been saved to {json_file_path}")
+            else:
+                print(f"No {prefix} time data found for channel {channel}")
+
 def normalize_segment2(segment, key='note'):
     values = [item[key] for item in segment]
     values_array = np.array(values, dtype=float)
@@ -600,28 +623,27 @@ def calculate_highest_similarity(base_folder):
 # Path to the folder containing MIDI files
 AUDIO_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '../datasets/audio'))
 
-# List of channels to process
-channels = [0, 1, 2, 10]
-
+if __name__ == '__main__':
+    # List of channels to process
+    channels = [0, 1, 2, 10]
 
-# Process each channel separately
-for channel in channels:
-    # Process all MIDI files in the folder for this channel
-    midi_data = process_all_midi_files(AUDIO_FOLDER, channel)
-    
-    # Only create a JSON file if there's data for this channel
-    if midi_data:
-        # Save the extracted data to a JSON file inside the same folder
-        json_file_path = os.path.join(AUDIO_FOLDER, f'midi_data_channel_{channel}.json')
-        with open(json_file_path, 'w') as json_file:
-            json.dump(midi_data, json_file, indent=4)
-        print(f"Data for channel {channel} has been successfully extracted and saved to {json_file_path}.")
-    else:
-        print(f"No data found for channel {channel}.")
+    # Process each channel separately
+    for channel in channels:
+        # Process all MIDI files in the folder for this channel
+        midi_data = process_all_midi_files(AUDIO_FOLDER, channel)
 
+        # Only create a JSON file if there's data for this channel
+        if midi_data:
+            # Save the extracted data to a JSON file inside the same folder
+            json_file_path = os.path.join(AUDIO_FOLDER, f'midi_data_channel_{channel}.json')
+            with open(json_file_path, 'w') as json_file:
+                json.dump(midi_data, json_file, indent=4)
+            print(f"Data for channel {channel} has been successfully extracted and saved to {json_file_path}.")
+        else:
+            print(f"No data found for channel {channel}.")
 
-process_all_channels_atb(AUDIO_FOLDER)
-#process_and_save_timing_data(AUDIO_FOLDER)
-process_all_channels_rtb_ftb(AUDIO_FOLDER)
-process_all_channels(AUDIO_FOLDER)
-calculate_highest_similarity(AUDIO_FOLDER)
\ No newline at end of file
+    process_all_channels_atb(AUDIO_FOLDER)
+    #process_and_save_timing_data(AUDIO_FOLDER)
+    process_all_channels_rtb_ftb(AUDIO_FOLDER)
+    process_all_channels(AUDIO_FOLDER)
+    calculate_highest_similarity(AUDIO_FOLDER)
@@ -1,3 +1,1269 @@
-from django.test import TestCase
+import io
+import os
+import json
+import time
+import shutil
+import socket
+import struct
+import zipfile
+import multiprocessing
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import mido
+
+from django.core.management import call_command, CommandError
+from django.test import SimpleTestCase, Client, override_settings
+
+from . import views, workspaces
+from .audio_index import (
+    AUDIO_FOLDER, build_audio_index, load_audio_index, add_songs_to_index, featurize_midi_file, rank_queries,
+    segment_notes, featurize_midi, featurize_midi_timed, parse_midi_bytes, score_query, overall_similarities,
+    verify_audio_index, open_audio_index
+)
+from .cover_index import (
+    COVER_FOLDER, build_cover_index, list_cover_images, load_cover_index, find_near_duplicates, image_to_pixels,
+    find_similar_covers_batch
+)
+from . import audio_index, cover_index
+from .perceptual_hash import BKTree, HASH_SIZE, NEAR_DUPLICATE_BITS, dhash, hamming_distance
+from .result_cache import ResultCache
+from .index_files import staging_dir, swap_index, rollback_index, list_generations, current_generation, index_dir
+from .zip_ingest import ingest_zip, ZipIngestError
+from .memory_stats import index_memory, track_memory
+from .search_shards import ShardCoordinator, check_shard_config, search_shard, start_local_shards
+from .song_neighbours import build_song_neighbours, compute_neighbours, load_song_neighbours
+from .benchmarks import audio as audio_benchmark, cover as cover_benchmark
+from .benchmarks.precision import compare_precisions
+from . import synthetic_corpus
+from .metrics import Registry, stage_timer, STAGE_SECONDS, request_stages
+from .profiling import load_profile_summary, server_timing, stage_totals
+from .note_store import build_note_store, build_audio_index_from_notes, featurize_store, note_store_path, segment_store
+from . import tesmidi
+
+# Catalog songs used as queries; each one must find itself
+QUERY_SONGS = ['Angeleyes.mid', 'Chiquitita.1.mid', 'A_Campfire_Song.mid', 'All_Mixed_Up.mid']
+
+
+def publish_audio_index(folder, **options):
+    """Builds an audio index over folder and makes it the live generation; returns its directory."""
+    out_dir = staging_dir(folder)
+    build_audio_index(folder, out_dir, **options)
+    return swap_index(folder, out_dir)
+
+
+def make_catalog(folder, songs=QUERY_SONGS, indexed=True):
+    """Copies catalog songs into folder, publishing an audio index over them if indexed is set."""
+    os.makedirs(folder, exist_ok=True)
+    for name in songs:
+        shutil.copy(os.path.join(AUDIO_FOLDER, name), folder)
+    if indexed:
+        publish_audio_index(folder)
+    return folder
+
+
+class CatalogTestCase(SimpleTestCase):
+    """
+    Gives every test a fresh temporary folder (self.tmp) with copies of the given songs.
+    """
+
+    songs = QUERY_SONGS
+    indexed = True
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        make_catalog(self.tmp, self.songs, self.indexed)
+
+
+class ConcurrentSearchTests(SimpleTestCase):
+    """
+    Concurrent searches must not see each other's results: every upload gets
+    its own workspace and the result endpoint is addressed by query_id.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        cls.audio_folder = make_catalog(os.path.join(cls.tmp, 'audio'))
+
+        cls.patches = [
+            mock.patch.object(views, 'AUDIO_FOLDER', cls.audio_folder),
+            mock.patch.object(workspaces, 'WORKSPACE_ROOT', os.path.join(cls.tmp, 'queries')),
+        ]
+        for patch in cls.patches:
+            patch.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in cls.patches:
+            patch.stop()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def search(self, song):
+        client = Client()
+        with open(os.path.join(self.audio_folder, song), 'rb') as f:
+            response = client.post('/simsalabim/upload-mid/', {'folder': 'audio', 'file': f})
+        self.assertEqual(response.status_code, 200, response.content)
+        query_id = response.json()['query_id']
+
+        response = client.get('/simsalabim/audio-search-result/', {'query_id': query_id})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['best_song']
+
+    def run_searches(self, threads, rounds=2):
+        songs = QUERY_SONGS * rounds
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            found = list(pool.map(self.search, songs))
+        return songs, found, len(songs) / (time.perf_counter() - start)
+
+    def test_concurrent_searches_get_their_own_results(self):
+        songs, found, _ = self.run_searches(threads=len(QUERY_SONGS))
+        self.assertEqual(found, songs)
+
+    def test_throughput_scaling(self):
+        # How much faster depends on the cores available, so more workers only
+        # have to stay close to one (on a single core they share it and pay
+        # for the switching); the best of a few runs evens out noise
+        self.run_searches(1, rounds=1)
+        throughput = {}
+        for threads in (1, 2, 4):
+            rates = []
+            for _ in range(3):
+                songs, found, rate = self.run_searches(threads)
+                self.assertEqual(found, songs)
+                rates.append(rate)
+            throughput[threads] = max(rates)
+            print(f"DEBUG: {threads} thread(s): {throughput[threads]:.1f} searches/sec")
+        for threads in (2, 4):
+            self.assertGreaterEqual(throughput[threads], 0.6 * throughput[1], throughput)
+
+    def test_batch_search_matches_single_searches(self):
+        files = [open(os.path.join(self.audio_folder, song), 'rb') for song in QUERY_SONGS]
+        try:
+            response = Client().post('/simsalabim/batch-audio-search/', {'files': files, 'top_k': 2})
+        finally:
+            for f in files:
+                f.close()
+        self.assertEqual(response.status_code, 200, response.content)
+        batch = response.json()
+        self.assertEqual(batch["count"], len(QUERY_SONGS))
+        self.assertEqual([query["results"][0]["song"] for query in batch["queries"]], QUERY_SONGS)
+        self.assertEqual([query["results"][0]["song"] for query in batch["queries"]],
+                         [self.search(song) for song in QUERY_SONGS])
+
+    def test_batch_search_validates_top_k(self):
+        for top_k, status, results in (('two', 400, None), ('0', 400, None), ('-3', 400, None), ('1', 200, 1)):
+            with open(os.path.join(self.audio_folder, QUERY_SONGS[0]), 'rb') as f:
+                response = Client().post('/simsalabim/batch-audio-search/', {'files': [f], 'top_k': top_k})
+            self.assertEqual(response.status_code, status, top_k)
+            if results is not None:
+                self.assertEqual(len(response.json()["queries"][0]["results"]), results)
+
+    def test_similar_songs_match_a_full_search(self):
+        build_song_neighbours(self.audio_folder, top_n=2)
+        song = QUERY_SONGS[0]
+        response = Client().get(f'/simsalabim/similar-songs/{song}/')
+        self.assertEqual(response.status_code, 200, response.content)
+
+        _, features, _ = featurize_midi_file(os.path.join(self.audio_folder, song))
+        ranking = [name for name, _ in rank_queries(load_audio_index(self.audio_folder), [features], 3)[0]]
+        expected = [name for name in ranking if name != song][:2]
+        self.assertEqual([neighbour["song"] for neighbour in response.json()["neighbours"]], expected)
+
+    def test_similar_songs_validates_limit(self):
+        build_song_neighbours(self.audio_folder, top_n=2)
+        song = QUERY_SONGS[0]
+        for limit in ('all', '0', '-1'):
+            self.assertEqual(Client().get(f'/simsalabim/similar-songs/{song}/', {'limit': limit}).status_code, 400)
+        response = Client().get(f'/simsalabim/similar-songs/{song}/', {'limit': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["neighbours"]), 1)
+
+    def test_search_with_budget(self):
+        client = Client()
+        with open(os.path.join(self.audio_folder, QUERY_SONGS[2]), 'rb') as f:
+            response = client.post('/simsalabim/upload-mid/', {'folder': 'audio', 'file': f, 'budget': '30'})
+        query_id = response.json()['query_id']
+        result = client.get('/simsalabim/audio-search-result/', {'query_id': query_id}).json()
+        self.assertEqual(result['best_song'], QUERY_SONGS[2])
+        self.assertFalse(result['partial'])
+
+    def test_invalid_budget_is_rejected(self):
+        for budget in ('-1', 'nan', 'inf', 'soon', '0'):
+            with open(os.path.join(self.audio_folder, QUERY_SONGS[2]), 'rb') as f:
+                response = Client().post('/simsalabim/upload-mid/', {'folder': 'audio', 'file': f, 'budget': budget})
+            self.assertEqual(response.status_code, 400, budget)
+
+    def test_query_id_is_required(self):
+        # Without it the views used to answer with the newest upload of any client
+        self.search(QUERY_SONGS[0])
+        self.assertEqual(Client().get('/simsalabim/audio-search-result/').status_code, 400)
+        self.assertEqual(Client().get('/simsalabim/cover-search-result/').status_code, 400)
+
+    def test_unknown_query_id(self):
+        response = Client().get('/simsalabim/audio-search-result/', {'query_id': '0' * 32})
+        self.assertEqual(response.status_code, 404)
+
+
+def _add_song_after(barrier, folder, name):
+    # Runs in a separate process, as an upload in another server worker would
+    features = featurize_midi_file(os.path.join(AUDIO_FOLDER, name))[1]
+    barrier.wait()
+    add_songs_to_index(folder, [(name, features)])
+
+
+class BaselineEquivalenceTests(CatalogTestCase):
+    """
+    score_query must give the scores of the original tesmidi JSON pipeline,
+    which every search since the vectorized index builds on.
+    """
+
+    def baseline_scores(self, query):
+        # The original upload flow: input.mid next to the catalog, segments and histograms as JSON files
+        work = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work, ignore_errors=True)
+        for name in self.songs:
+            shutil.copy(os.path.join(self.tmp, name), work)
+        shutil.copy(os.path.join(self.tmp, query), os.path.join(work, 'input.mid'))
+        for channel in audio_index.CHANNELS:
+            midi_data = tesmidi.process_all_midi_files(work, channel)
+            if midi_data:
+                with open(os.path.join(work, f'midi_data_channel_{channel}.json'), 'w') as f:
+                    json.dump(midi_data, f)
+        tesmidi.process_all_channels_atb(work)
+        tesmidi.process_all_channels_rtb_ftb(work)
+
+        results = {}
+        for channel in audio_index.CHANNELS:
+            paths = [os.path.join(work, f'{feature}_histogram_channel_{channel}.json') for feature in ('atb', 'rtb', 'ftb')]
+            if all(os.path.exists(path) for path in paths):
+                results[channel] = tesmidi.calculate_weighted_similarity(
+                    *(tesmidi.compare_segments_to_dataset(path) for path in paths)
+                )
+            else:
+                results[channel] = {}
+        return results
+
+    def test_score_query_matches_tesmidi(self):
+        index = load_audio_index(self.tmp)
+        for query in QUERY_SONGS[:2]:
+            expected = self.baseline_scores(query)
+            actual = score_query(index, featurize_midi_file(os.path.join(self.tmp, query))[1])
+            self.assertEqual(sorted(actual), sorted(expected))
+            for channel, songs in expected.items():
+                self.assertEqual(sorted(actual[channel]), sorted(songs), channel)
+                for song, similarities in songs.items():
+                    np.testing.assert_allclose(actual[channel][song], similarities, rtol=1e-6, atol=1e-9)
+
+            expected_overall, actual_overall = overall_similarities(expected), overall_similarities(actual)
+            self.assertEqual(sorted(actual_overall, key=actual_overall.get, reverse=True),
+                             sorted(expected_overall, key=expected_overall.get, reverse=True))
+            self.assertEqual(max(actual_overall, key=actual_overall.get), query)
+
+
+class IndexGenerationTests(CatalogTestCase):
+    """
+    Published index generations are immutable; readers switch to a new one on
+    their next load without a restart.
+    """
+
+    songs = QUERY_SONGS[:2]
+
+    def test_new_generation_is_picked_up(self):
+        old_index = load_audio_index(self.tmp)
+        old_segments = {c: data['segments'].copy() for c, data in old_index["channels"].items()}
+
+        name, features, _ = featurize_midi_file(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]))
+        add_songs_to_index(self.tmp, [(name, features)])
+
+        new_index = load_audio_index(self.tmp)
+        self.assertEqual(new_index["songs"], QUERY_SONGS[:2] + [QUERY_SONGS[2]])
+        # A reader still holding the previous generation sees it unchanged
+        self.assertEqual(old_index["songs"], QUERY_SONGS[:2])
+        for channel, segments in old_segments.items():
+            self.assertTrue((old_index["channels"][channel]['segments'] == segments).all())
+
+    def test_matrices_are_memory_mapped(self):
+        # Mapped read-only, so every worker process shares one copy through the page cache
+        usage = index_memory(load_audio_index(self.tmp))
+        self.assertGreater(usage["mapped_bytes"], 0)
+        self.assertEqual(usage["heap_bytes"], 0)
+
+    def test_additions_from_separate_processes_are_all_kept(self):
+        barrier = multiprocessing.Barrier(2)
+        processes = [
+            multiprocessing.Process(target=_add_song_after, args=(barrier, self.tmp, name)) for name in QUERY_SONGS[2:]
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(sorted(load_audio_index(self.tmp)["songs"]), sorted(QUERY_SONGS))
+        self.assertEqual(len(list_generations(self.tmp)), 3)
+
+    def test_song_neighbours_are_carried_forward(self):
+        build_song_neighbours(self.tmp, top_n=2)
+        additions = [
+            featurize_midi_file(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]))[:2],
+            # Replaces an indexed song with different notes
+            (QUERY_SONGS[0], featurize_midi_file(os.path.join(AUDIO_FOLDER, QUERY_SONGS[3]))[1]),
+        ]
+        for addition in additions:
+            add_songs_to_index(self.tmp, [addition])
+            table = load_song_neighbours(self.tmp)
+            self.assertIsNotNone(table)
+            ids, scores = compute_neighbours(load_audio_index(self.tmp), top_n=2)
+            np.testing.assert_array_equal(table["ids"], ids)
+            np.testing.assert_allclose(table["scores"], scores, rtol=1e-6)
+
+    def test_upload_during_neighbour_computation(self):
+        name, features, _ = featurize_midi_file(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]))
+        calls = []
+
+        def compute_while_uploading(index, *args):
+            if not calls:
+                # The upload must not wait for the computation to finish
+                upload = threading.Thread(target=add_songs_to_index, args=(self.tmp, [(name, features)]))
+                upload.start()
+                upload.join(30)
+                self.assertFalse(upload.is_alive())
+            calls.append(len(index["songs"]))
+            return compute_neighbours(index, *args)
+
+        with mock.patch('simsalabim.song_neighbours.compute_neighbours', compute_while_uploading):
+            build_song_neighbours(self.tmp, top_n=2)
+        # The first table was computed for the replaced generation, so it was computed again
+        self.assertEqual(calls, [2, 3])
+        table = load_song_neighbours(self.tmp)
+        self.assertEqual(table["songs"], QUERY_SONGS[:2] + [name])
+        ids, _ = compute_neighbours(load_audio_index(self.tmp), top_n=2)
+        np.testing.assert_array_equal(table["ids"], ids)
+
+    def test_rollback(self):
+        name, features, _ = featurize_midi_file(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]))
+        add_songs_to_index(self.tmp, [(name, features)])
+        self.assertEqual(len(list_generations(self.tmp)), 2)
+
+        rollback_index(self.tmp)
+        self.assertEqual(load_audio_index(self.tmp)["songs"], QUERY_SONGS[:2])
+
+
+class CoverSearchTests(SimpleTestCase):
+    """
+    Cover search over a small index built from the first dataset covers.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        for name in list_cover_images(COVER_FOLDER)[:12]:
+            shutil.copy(os.path.join(COVER_FOLDER, name), cls.tmp)
+        out_dir = staging_dir(cls.tmp)
+        build_cover_index(cls.tmp, out_dir)
+        swap_index(cls.tmp, out_dir)
+        cls.index = load_cover_index(cls.tmp)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def test_pixel_matrix_is_memory_mapped(self):
+        self.assertIsInstance(self.index["pixels"], np.memmap)
+        self.assertEqual(self.index["pixels"].dtype, np.uint8)
+        for row, name in enumerate(self.index["names"]):
+            np.testing.assert_array_equal(self.index["pixels"][row], image_to_pixels(os.path.join(self.tmp, name)))
+
+    def test_ranking_matches_exact_pca(self):
+        # Same steps as the original view: centering, full SVD, k = 2, Euclidean distance to every cover
+        vectors = np.asarray(self.index["pixels"], dtype=np.float64)
+        pixel_means = vectors.mean(axis=0)
+        _, _, Vt = np.linalg.svd(vectors - pixel_means, full_matrices=False)
+        Uk = Vt[:2].T
+        query = image_to_pixels(os.path.join(COVER_FOLDER, list_cover_images(COVER_FOLDER)[12]))
+        projections, projected = (vectors - pixel_means) @ Uk, (query - pixel_means) @ Uk
+        distances = np.linalg.norm(projections - projected, axis=1)
+        order = np.argsort(distances)
+        # Percentages are relative to the farthest corner of the bounding box of all covers
+        corner = np.maximum(np.abs(projected - projections.min(axis=0)), np.abs(projected - projections.max(axis=0)))
+
+        ranking = find_similar_covers_batch(self.index, query[None, :], top_k=len(order), max_hamming=None)[0]
+        self.assertEqual([name for name, _, _, _ in ranking], [self.index["names"][i] for i in order])
+        np.testing.assert_allclose([distance for _, distance, _, _ in ranking], distances[order], rtol=1e-3)
+        np.testing.assert_allclose([percentage for _, _, percentage, _ in ranking],
+                                   (1 - distances[order] / np.linalg.norm(corner)) * 100, atol=1e-2)
+
+    def test_kd_tree_matches_brute_force_with_more_components(self):
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir, ignore_errors=True)
+        build_cover_index(self.tmp, out_dir, n_components=4)
+        index = cover_index.open_cover_index(out_dir)
+        self.assertEqual(index["Uk"].shape, (cover_index.PIXELS_PER_IMAGE, 4))
+
+        query = image_to_pixels(os.path.join(COVER_FOLDER, list_cover_images(COVER_FOLDER)[12]))
+        projected = (query.astype(np.float32) - index["pixel_means"]) @ index["Uk"]
+        distances = np.linalg.norm(index["projections"] - projected, axis=1)
+        order = np.argsort(distances)[:5]
+
+        ranking = find_similar_covers_batch(index, query[None, :], top_k=5, max_hamming=None)[0]
+        self.assertEqual([name for name, _, _, _ in ranking], [index["names"][i] for i in order])
+        # The box corner is at least as far as the farthest cover, so no percentage is below the exact one
+        percentages = [percentage for _, _, percentage, _ in ranking]
+        self.assertTrue(np.all(np.array(percentages) >= (1 - distances[order] / distances.max()) * 100 - 1e-3))
+        self.assertTrue(all(0 <= percentage <= 100 for percentage in percentages))
+
+    def test_added_covers_stay_within_the_bounds(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        names = self.index["names"]
+        for name in names[:4]:
+            shutil.copy(os.path.join(self.tmp, name), folder)
+        load_cover_index(folder, rebuild=True)
+        new_covers = [(f"new_{name}", np.asarray(self.index["pixels"][row]), int(self.index["hashes"][row]))
+                      for row, name in enumerate(names[4:], start=4)]
+        cover_index.add_covers_to_index(folder, new_covers)
+        index = load_cover_index(folder)
+        self.assertEqual(len(index["names"]), len(names))
+        self.assertTrue(np.all(index["bounds"][0] <= index["projections"].min(axis=0)))
+        self.assertTrue(np.all(index["bounds"][1] >= index["projections"].max(axis=0)))
+
+    def test_changing_the_components_rebuilds_the_index(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        for name in self.index["names"][:4]:
+            shutil.copy(os.path.join(self.tmp, name), folder)
+        self.assertEqual(load_cover_index(folder, n_components=2, rebuild=True)["n_components"], 2)
+        self.assertEqual(load_cover_index(folder, n_components=2, rebuild=True)["n_components"], 2)
+        self.assertEqual(len(list_generations(folder)), 1)
+        self.assertEqual(load_cover_index(folder, n_components=3, rebuild=True)["n_components"], 3)
+        self.assertEqual(len(list_generations(folder)), 2)
+
+    def test_near_duplicates_are_answered_without_projection(self):
+        queries = np.asarray(self.index["pixels"][[3, 7]])
+        with mock.patch.object(cover_index, 'project_matrix', wraps=cover_index.project_matrix) as project:
+            results = find_similar_covers_batch(self.index, queries, top_k=5)
+        project.assert_not_called()
+        self.assertEqual([ranking[0][0] for ranking in results], [self.index["names"][3], self.index["names"][7]])
+        self.assertEqual(results[0][0][1:], (0.0, 100.0, 'near_duplicate'))
+        self.assertTrue(all(len(ranking) == 5 for ranking in results))
+
+    def test_near_duplicates_are_padded_from_the_kd_tree(self):
+        query = np.asarray(self.index["pixels"][5])
+        self.assertEqual([row for _, row in find_near_duplicates(self.index, query)], [5])
+        ranking = find_similar_covers_batch(self.index, query[None, :], top_k=4)[0]
+        pca_ranking = find_similar_covers_batch(self.index, query[None, :], top_k=4, max_hamming=None)[0]
+        self.assertEqual([match for _, _, _, match in ranking], ['near_duplicate'] + ['pca'] * 3)
+        # An exact duplicate projects onto its stored projection, so both paths give the same PCA scale
+        self.assertEqual([name for name, _, _, _ in ranking], [name for name, _, _, _ in pca_ranking])
+        np.testing.assert_allclose([result[1:3] for result in ranking], [result[1:3] for result in pca_ranking],
+                                   rtol=1e-4, atol=0.05)
+
+    def test_batch_search_validates_top_k(self):
+        with mock.patch.object(views, 'COVER_FOLDER', self.tmp):
+            for top_k, status in (('many', 400), ('0', 400), ('1', 200)):
+                with open(os.path.join(self.tmp, self.index["names"][0]), 'rb') as f:
+                    response = Client().post('/simsalabim/batch-cover-search/', {'files': [f], 'top_k': top_k})
+                self.assertEqual(response.status_code, status, top_k)
+        self.assertEqual([result["cover"] for result in response.json()["queries"][0]["results"]],
+                         [self.index["names"][0]])
+        self.assertEqual(response.json()["queries"][0]["results"][0]["match_type"], 'near_duplicate')
+
+
+class PerceptualHashTests(SimpleTestCase):
+    """
+    dHash values and BK-tree radius searches used for near-duplicate covers.
+    """
+
+    def test_dhash_of_gradients(self):
+        gradient = np.tile(np.arange(128, dtype=np.uint8), (128, 1))
+        self.assertEqual(dhash(gradient), 2 ** (HASH_SIZE ** 2) - 1)
+        self.assertEqual(dhash(gradient[:, ::-1]), 0)
+
+    def test_small_edits_keep_the_hash_close(self):
+        pixels = image_to_pixels(os.path.join(COVER_FOLDER, list_cover_images(COVER_FOLDER)[0]))
+        brighter = np.clip(pixels.astype(np.int16) + 6, 0, 255).astype(np.uint8)
+        original = cover_index.hash_pixels(pixels)
+        self.assertLessEqual(hamming_distance(original, cover_index.hash_pixels(brighter)), NEAR_DUPLICATE_BITS)
+        self.assertGreater(hamming_distance(original, cover_index.hash_pixels(pixels[::-1])), NEAR_DUPLICATE_BITS)
+
+    def test_radius_search_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        base = [int(value) for value in rng.integers(0, 2 ** 63, size=20, dtype=np.int64)]
+        # Variants a few flipped bits away, plus exact duplicates
+        hashes = base + [value ^ (1 << int(bit)) ^ (1 << int(bit + 7)) for value, bit in
+                         zip(base, rng.integers(0, 50, size=20))] + base[:3]
+        tree = BKTree(hashes)
+        self.assertEqual(len(tree), len(hashes))
+        for query in base[:5] + [base[5] ^ 0b111]:
+            for radius in (0, 2, 4, 16, 32):
+                expected = sorted((hamming_distance(query, value), row) for row, value in enumerate(hashes)
+                                  if hamming_distance(query, value) <= radius)
+                found = tree.search(query, radius)
+                self.assertEqual(sorted(found), expected)
+                self.assertEqual([distance for distance, _ in found], [distance for distance, _ in expected])
+
+
+class ResultCacheTests(SimpleTestCase):
+    """
+    LRU eviction, expiry and version invalidation of the cover result cache.
+    """
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ResultCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = ResultCache(ttl=10)
+        with mock.patch('simsalabim.result_cache.time.monotonic', return_value=100.0):
+            cache.set('a', 1)
+        with mock.patch('simsalabim.result_cache.time.monotonic', return_value=109.0):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('simsalabim.result_cache.time.monotonic', return_value=110.0):
+            self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["expired"], stats["size"]), (1, 1, 1, 0))
+
+    def test_version_change_drops_every_entry(self):
+        cache = ResultCache()
+        cache.sync_version('v1')
+        cache.set('a', 1)
+        cache.sync_version('v1')
+        self.assertEqual(cache.get('a'), 1)
+        cache.sync_version('v2')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()["invalidations"], 1)
+
+
+class BuildIndexCommandTests(CatalogTestCase):
+    """
+    The buildindex command builds and verifies a generation before pointing CURRENT at it.
+    """
+
+    songs = QUERY_SONGS[:2]
+    indexed = False
+
+    def build(self, *args):
+        call_command('buildindex', 'audio', '--folder', self.tmp, '--workers', '1', *args, stdout=io.StringIO())
+
+    def test_build_is_published(self):
+        self.assertIsNone(current_generation(self.tmp))
+        self.build()
+        first = current_generation(self.tmp)
+        self.assertEqual(load_audio_index(self.tmp)["songs"], QUERY_SONGS[:2])
+
+        old_index = load_audio_index(self.tmp)
+        shutil.copy(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]), self.tmp)
+        self.build()
+        self.assertNotEqual(current_generation(self.tmp), first)
+        self.assertEqual(sorted(load_audio_index(self.tmp)["songs"]), sorted(QUERY_SONGS[:3]))
+        self.assertEqual(old_index["songs"], QUERY_SONGS[:2])
+
+    def test_no_swap_keeps_the_live_index(self):
+        self.build()
+        live = current_generation(self.tmp)
+        shutil.copy(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]), self.tmp)
+        self.build('--no-swap')
+        self.assertEqual(current_generation(self.tmp), live)
+        self.assertEqual(load_audio_index(self.tmp)["songs"], QUERY_SONGS[:2])
+
+        self.build('--swap-only')
+        self.assertNotEqual(current_generation(self.tmp), live)
+        self.assertEqual(sorted(load_audio_index(self.tmp)["songs"]), sorted(QUERY_SONGS[:3]))
+
+    def test_failed_verification_is_not_published(self):
+        self.build()
+        live = current_generation(self.tmp)
+        with mock.patch('simsalabim.management.commands.buildindex.verify_audio_index', return_value=['broken']):
+            with self.assertRaises(CommandError):
+                call_command('buildindex', 'audio', '--folder', self.tmp, '--workers', '1',
+                             stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(current_generation(self.tmp), live)
+
+    def test_rebuild_keeps_song_neighbours(self):
+        self.build()
+        build_song_neighbours(self.tmp, top_n=2)
+        shutil.copy(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]), self.tmp)
+        self.build()
+        table = load_song_neighbours(self.tmp)
+        self.assertIsNotNone(table)
+        self.assertEqual(sorted(table["songs"]), sorted(QUERY_SONGS[:3]))
+        ids, scores = compute_neighbours(load_audio_index(self.tmp), top_n=2)
+        np.testing.assert_array_equal(table["ids"], ids)
+        np.testing.assert_allclose(table["scores"], scores, rtol=1e-6)
+
+    def test_upload_during_build_is_not_dropped(self):
+        self.build()
+        name, features, _ = featurize_midi_file(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]))
+
+        def build_while_uploading(*args, **kwargs):
+            add_songs_to_index(self.tmp, [(name, features)])
+            return build_audio_index(*args, **kwargs)
+
+        with mock.patch('simsalabim.management.commands.buildindex.build_audio_index', build_while_uploading):
+            with self.assertRaises(CommandError):
+                call_command('buildindex', 'audio', '--folder', self.tmp, '--workers', '1',
+                             stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(load_audio_index(self.tmp)["songs"], QUERY_SONGS[:2] + [name])
+
+    def test_swap_only_refuses_a_build_older_than_an_upload(self):
+        self.build()
+        self.build('--no-swap')
+        name, features, _ = featurize_midi_file(os.path.join(AUDIO_FOLDER, QUERY_SONGS[2]))
+        add_songs_to_index(self.tmp, [(name, features)])
+        live = current_generation(self.tmp)
+        with self.assertRaises(CommandError):
+            call_command('buildindex', 'audio', '--folder', self.tmp, '--swap-only',
+                         stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(current_generation(self.tmp), live)
+
+    def test_rollback(self):
+        self.build()
+        first = current_generation(self.tmp)
+        self.build()
+        self.build('--rollback')
+        self.assertEqual(current_generation(self.tmp), first)
+
+    def test_cover_components(self):
+        for name in list_cover_images(COVER_FOLDER)[:4]:
+            shutil.copy(os.path.join(COVER_FOLDER, name), self.tmp)
+        call_command('buildindex', 'cover', '--folder', self.tmp, '--workers', '1', '--components', '3',
+                     stdout=io.StringIO())
+        index = load_cover_index(self.tmp)
+        self.assertEqual(index["n_components"], 3)
+        self.assertEqual(index["names"], list_cover_images(COVER_FOLDER)[:4])
+
+
+def _zip_bytes(members, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as zip_file:
+        for name, data in members:
+            zip_file.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _patch_zip_headers(data, offset_local, offset_central, value, fmt='<H'):
+    # Rewrites one field of the (only) member in both its local header and the central directory
+    data = bytearray(data)
+    struct.pack_into(fmt, data, offset_local, value)
+    struct.pack_into(fmt, data, data.index(b'PK\x01\x02') + offset_central, value)
+    return bytes(data)
+
+
+class ZipIngestTests(SimpleTestCase):
+    """
+    Rejected archives raise ZipIngestError and leave the target folder untouched.
+    """
+
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.target, ignore_errors=True)
+
+    def ingest(self, data, **limits):
+        return ingest_zip(io.BytesIO(data), self.target, {'.mid'}, **limits)
+
+    def assert_rejected(self, data, **limits):
+        with self.assertRaises(ZipIngestError):
+            self.ingest(data, **limits)
+        self.assertEqual(os.listdir(self.target), [])
+
+    def test_members_are_extracted(self):
+        result = self.ingest(_zip_bytes([('songs/a.mid', b'a' * 10), ('b.mid', b'b' * 10), ('README.md', b'x')]))
+        self.assertEqual(result["files"], ['a.mid', 'b.mid'])
+        self.assertEqual(sorted(os.listdir(self.target)), ['a.mid', 'b.mid'])
+
+    def test_oversized_member_is_rejected(self):
+        self.assert_rejected(_zip_bytes([('a.mid', os.urandom(200))]), max_member_bytes=100)
+
+    def test_high_compression_ratio_is_rejected(self):
+        self.assert_rejected(_zip_bytes([('a.mid', bytes(100000))]), max_ratio=200)
+
+    def test_total_size_limit_is_rejected(self):
+        members = [(f'{i}.mid', os.urandom(60)) for i in range(3)]
+        self.assert_rejected(_zip_bytes(members), max_member_bytes=100, max_total_bytes=100)
+
+    def test_corrupt_deflate_stream_is_rejected(self):
+        data = bytearray(_zip_bytes([('a.mid', b'note ' * 100)]))
+        # Compressed data follows the 30-byte local header and the file name; 0xff is an invalid block type
+        data[35:45] = b'\xff' * 10
+        self.assert_rejected(bytes(data))
+
+    def test_unsupported_compression_method_is_rejected(self):
+        self.assert_rejected(_patch_zip_headers(_zip_bytes([('a.mid', b'note')], zipfile.ZIP_STORED), 8, 10, 99))
+
+    def test_encrypted_member_is_rejected(self):
+        self.assert_rejected(_patch_zip_headers(_zip_bytes([('a.mid', b'note')], zipfile.ZIP_STORED), 6, 8, 1))
+
+    def test_duplicate_file_names_are_rejected(self):
+        # Both would be extracted as a.mid, so the indexed features could belong to the other file
+        self.assert_rejected(_zip_bytes([('one/a.mid', b'first'), ('two/a.mid', b'second')]))
+
+    def test_not_a_zip_is_rejected(self):
+        self.assert_rejected(b'not a zip file')
+
+    def test_wrong_declared_size_is_rejected(self):
+        # The headers claim 50 bytes, so the size checks pass and only the copy can notice
+        data = _patch_zip_headers(_zip_bytes([('a.mid', os.urandom(200))], zipfile.ZIP_STORED), 22, 24, 50, '<I')
+        self.assert_rejected(data, max_member_bytes=100)
+
+    def test_valid_members_are_not_kept_when_a_later_one_is_rejected(self):
+        members = [('a.mid', os.urandom(50)), ('b.mid', os.urandom(50)), ('c.txt', b'x')]
+        self.assert_rejected(_zip_bytes(members))
+
+        def fail():
+            raise ZipIngestError('Indexing failed.')
+        with self.assertRaises(ZipIngestError):
+            ingest_zip(io.BytesIO(_zip_bytes(members[:2])), self.target, {'.mid'}, before_commit=fail)
+        self.assertEqual(os.listdir(self.target), [])
+
+
+class ZipUploadTests(SimpleTestCase):
+    """
+    Songs and covers in an uploaded ZIP are featurized during extraction and added to the live index.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        patch = mock.patch.object(views, 'DATASET_DIR', self.tmp)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def upload(self, folder, members):
+        upload = io.BytesIO(_zip_bytes(members))
+        upload.name = 'dataset.zip'
+        response = Client().post('/simsalabim/upload-zip/', {'folder': folder, 'file': upload})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def read(self, folder, names):
+        members = []
+        for name in names:
+            with open(os.path.join(folder, name), 'rb') as f:
+                members.append((name, f.read()))
+        return members
+
+    def test_uploaded_songs_are_indexed(self):
+        audio_folder = make_catalog(os.path.join(self.tmp, 'audio'), QUERY_SONGS[:2])
+
+        result = self.upload('audio', self.read(AUDIO_FOLDER, QUERY_SONGS[2:]))
+        self.assertEqual((result["files"], result["indexed"]), (2, 2))
+        index = load_audio_index(audio_folder)
+        self.assertEqual(sorted(index["songs"]), sorted(QUERY_SONGS))
+        queries = [featurize_midi_file(os.path.join(AUDIO_FOLDER, name))[1] for name in QUERY_SONGS]
+        self.assertEqual([ranking[0][0] for ranking in rank_queries(index, queries, 1)], QUERY_SONGS)
+        self.assertEqual(verify_audio_index(audio_folder, index_dir(audio_folder)), [])
+
+    def test_uploaded_covers_are_indexed(self):
+        cover_folder = os.path.join(self.tmp, 'cover')
+        os.makedirs(cover_folder)
+        names = list_cover_images(COVER_FOLDER)[:6]
+        for name in names[:4]:
+            shutil.copy(os.path.join(COVER_FOLDER, name), cover_folder)
+        load_cover_index(cover_folder, rebuild=True)
+
+        result = self.upload('cover', self.read(COVER_FOLDER, names[4:]))
+        self.assertEqual((result["files"], result["indexed"]), (2, 2))
+        index = load_cover_index(cover_folder)
+        self.assertEqual(sorted(index["names"]), names)
+        query = image_to_pixels(os.path.join(COVER_FOLDER, names[5]))
+        self.assertEqual(find_similar_covers_batch(index, query[None, :], top_k=1)[0][0][0], names[5])
+
+    def test_songs_without_an_index_wait_for_the_next_build(self):
+        result = self.upload('audio', self.read(AUDIO_FOLDER, QUERY_SONGS[:1]))
+        self.assertEqual((result["files"], result["indexed"]), (1, 0))
+        self.assertIn('next index build', result["message"])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'audio', QUERY_SONGS[0])))
+
+
+class MidiUploadTests(SimpleTestCase):
+    """
+    Uploaded queries are parsed from memory and only stored when they are added to the catalog.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.audio_folder = make_catalog(os.path.join(self.tmp, 'audio'), QUERY_SONGS[:2])
+        for patch in (
+            mock.patch.object(views, 'AUDIO_FOLDER', self.audio_folder),
+            mock.patch.object(views, 'DATASET_DIR', self.tmp),
+            mock.patch.object(workspaces, 'WORKSPACE_ROOT', os.path.join(self.tmp, 'queries')),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_bytes_give_the_same_features_as_the_file(self):
+        for name in QUERY_SONGS:
+            path = os.path.join(AUDIO_FOLDER, name)
+            with open(path, 'rb') as f:
+                from_bytes = featurize_midi(parse_midi_bytes(f.read()))
+            from_file = featurize_midi_file(path)[1]
+            self.assertEqual(sorted(from_bytes), sorted(from_file), name)
+            for channel, segments in from_file.items():
+                np.testing.assert_array_equal(from_bytes[channel], segments)
+
+    def upload(self, song, **data):
+        with open(os.path.join(AUDIO_FOLDER, song), 'rb') as f:
+            response = Client().post('/simsalabim/upload-mid/', {'folder': 'audio', 'file': f, **data})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def test_query_is_not_written_to_the_dataset(self):
+        before = sorted(os.listdir(self.audio_folder))
+        query_id = self.upload(QUERY_SONGS[1]).json()['query_id']
+        self.assertEqual(sorted(os.listdir(self.audio_folder)), before)
+        result = Client().get('/simsalabim/audio-search-result/', {'query_id': query_id}).json()
+        self.assertEqual(result['best_song'], QUERY_SONGS[1])
+
+    def test_add_to_catalog_stores_and_indexes_the_song(self):
+        # The song is saved through default_storage, which only writes below MEDIA_ROOT
+        with override_settings(MEDIA_ROOT=self.tmp):
+            self.upload(QUERY_SONGS[2], add_to_catalog='1')
+        self.assertTrue(os.path.exists(os.path.join(self.audio_folder, QUERY_SONGS[2])))
+        self.assertEqual(sorted(load_audio_index(self.audio_folder)["songs"]), sorted(QUERY_SONGS[:3]))
+
+
+class ShardedSearchTests(SimpleTestCase):
+    """
+    Scatter-gather over local shard processes returns the same ranking as
+    searching the whole index in one process.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = make_catalog(tempfile.mkdtemp())
+        cls.addresses, cls.processes, cls.authkey = start_local_shards(2, cls.tmp)
+
+    @classmethod
+    def tearDownClass(cls):
+        for process in cls.processes:
+            process.terminate()
+            process.join()
+        if isinstance(cls.addresses[0], str):
+            shutil.rmtree(os.path.dirname(cls.addresses[0]), ignore_errors=True)
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def query(self, song):
+        _, features, _ = featurize_midi_file(os.path.join(self.tmp, song))
+        return features
+
+    def test_merged_top_k_matches_single_process(self):
+        coordinator = ShardCoordinator(self.addresses, self.authkey, deadline=30)
+        index = load_audio_index(self.tmp)
+        for song in QUERY_SONGS:
+            search = coordinator.search(self.query(song), top_k=3)
+            self.assertFalse(search["partial"])
+            self.assertEqual(search["results"][0][0], song)
+            self.assertEqual(search["results"], search_shard(index, 0, 1, self.query(song), 3))
+
+    def test_unreachable_shard_gives_partial_result(self):
+        coordinator = ShardCoordinator(
+            self.addresses + [os.path.join(self.tmp, 'missing.sock')], self.authkey, deadline=30
+        )
+        search = coordinator.search(self.query(QUERY_SONGS[0]), top_k=3)
+        self.assertTrue(search["partial"])
+        self.assertEqual(search["answered"], 2)
+        self.assertEqual(search["results"][0][0], QUERY_SONGS[0])
+
+    def test_wrong_secret_is_rejected(self):
+        coordinator = ShardCoordinator(self.addresses, b'not-the-secret', deadline=30)
+        search = coordinator.search(self.query(QUERY_SONGS[0]), top_k=3)
+        self.assertEqual(search["answered"], 0)
+        self.assertEqual(search["results"], [])
+
+    def test_hanging_shard_does_not_outlast_the_deadline(self):
+        # Accepts connections but never answers the authentication handshake
+        with socket.create_server(('127.0.0.1', 0)) as silent:
+            coordinator = ShardCoordinator(self.addresses + [silent.getsockname()], self.authkey, deadline=1.0)
+            start = time.monotonic()
+            search = coordinator.search(self.query(QUERY_SONGS[0]), top_k=3)
+            self.assertLess(time.monotonic() - start, 3.0)
+            self.assertTrue(search["partial"])
+        self.assertIn(2, search["errors"])
+
+    def test_concurrent_searches_do_not_queue_behind_each_other(self):
+        # Every shard request of every search must be in flight at once to pass the barrier
+        coordinator = ShardCoordinator(self.addresses, self.authkey, deadline=30)
+        searches = 4
+        barrier = threading.Barrier(searches * len(self.addresses), timeout=10)
+        ask = coordinator._ask
+
+        def ask_together(*args):
+            barrier.wait()
+            return ask(*args)
+
+        with mock.patch.object(coordinator, '_ask', ask_together), ThreadPoolExecutor(max_workers=searches) as pool:
+            results = list(pool.map(lambda song: coordinator.search(self.query(song), top_k=1), QUERY_SONGS))
+        self.assertFalse(any(search["partial"] for search in results), [search["errors"] for search in results])
+        self.assertEqual([search["results"][0][0] for search in results], QUERY_SONGS)
+
+    def test_shards_need_a_secret_and_a_local_address(self):
+        with self.assertRaises(ValueError):
+            ShardCoordinator(self.addresses, None)
+        with self.assertRaises(ValueError):
+            check_shard_config(os.path.join(self.tmp, 'shard.sock'), b'')
+        with self.assertRaises(ValueError):
+            check_shard_config(('192.0.2.1', 9000), self.authkey)
+        check_shard_config(('127.0.0.1', 9000), self.authkey)
+        check_shard_config(('192.0.2.1', 9000), self.authkey, allow_remote=True)
+
+    def test_search_through_views(self):
+        with override_settings(AUDIO_SEARCH_SHARDS=self.addresses, AUDIO_SHARD_AUTHKEY=self.authkey,
+                               AUDIO_SEARCH_DEADLINE=30), \
+                mock.patch.object(views, '_shard_coordinator', None), \
+                mock.patch.object(workspaces, 'WORKSPACE_ROOT', os.path.join(self.tmp, 'queries')):
+            client = Client()
+            with open(os.path.join(self.tmp, QUERY_SONGS[1]), 'rb') as f:
+                response = client.post('/simsalabim/upload-mid/', {'folder': 'audio', 'file': f})
+            query_id = response.json()['query_id']
+            result = client.get('/simsalabim/audio-search-result/', {'query_id': query_id}).json()
+        self.assertEqual(result['best_song'], QUERY_SONGS[1])
+        self.assertFalse(result['partial'])
+
+
+class AudioBenchmarkTests(SimpleTestCase):
+    """
+    Smoke test keeping the benchmark suite runnable; timings are not checked.
+    """
+
+    def test_every_stage_is_measured_at_every_scale(self):
+        results = audio_benchmark.run(scales=(1, 2), n_songs=1, reference_limit=1)
+        stages = {entry["stage"] for entry in results}
+        self.assertIn('compare_segments_to_dataset', stages)
+        self.assertIn('vectorized score_query', stages)
+        for scale in (1, 2):
+            self.assertEqual(len([entry for entry in results if entry["scale"] == scale]), len(stages))
+        skipped = [entry for entry in results if entry.get("skipped")]
+        self.assertEqual([(entry["scale"], entry["stage"]) for entry in skipped], [(2, 'compare_segments_to_dataset')])
+
+    def test_cover_stages_are_measured_per_format_with_memory(self):
+        results = cover_benchmark.run(scales=(1,), n_covers=4, n_queries=2)
+        self.assertEqual({entry["format"] for entry in results}, {'png', 'jpg'})
+        self.assertIn('top-k search (batch)', {entry["stage"] for entry in results})
+        self.assertTrue(all(entry["peak_bytes"] >= 0 and entry["seconds"] >= 0 for entry in results))
+
+
+class SyntheticCorpusTests(SimpleTestCase):
+    """
+    Generated corpora must be reproducible and their queries must find their source.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def read_folder(self, folder):
+        return {
+            name: open(os.path.join(folder, name), 'rb').read()
+            for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name))
+        }
+
+    def test_same_seed_gives_same_corpus_for_any_worker_count(self):
+        for kind in ('audio', 'cover'):
+            serial, parallel = os.path.join(self.tmp, kind, '1'), os.path.join(self.tmp, kind, '2')
+            synthetic_corpus.generate_catalog(kind, serial, 6, seed=7)
+            synthetic_corpus.generate_catalog(kind, parallel, 6, seed=7, workers=2)
+            self.assertEqual(self.read_folder(serial), self.read_folder(parallel))
+
+    def test_audio_queries_find_their_source(self):
+        catalog, queries = os.path.join(self.tmp, 'catalog'), os.path.join(self.tmp, 'queries')
+        synthetic_corpus.generate_catalog('audio', catalog, 8, seed=1)
+        truth = synthetic_corpus.generate_queries('audio', catalog, queries, 4, seed=1)
+        self.assertEqual(synthetic_corpus.load_ground_truth(queries)["queries"], truth)
+
+        publish_audio_index(catalog)
+        features = [featurize_midi_file(os.path.join(queries, entry["query"]))[1] for entry in truth]
+        rankings = rank_queries(load_audio_index(catalog), features, top_k=1)
+        self.assertEqual([ranking[0][0] for ranking in rankings], [entry["expected"] for entry in truth])
+
+
+class MetricsTests(SimpleTestCase):
+    """
+    The metrics endpoint must speak the Prometheus text format and see every stage that ran.
+    """
+
+    def test_histogram_is_rendered_with_cumulative_buckets(self):
+        registry = Registry()
+        latency = registry.histogram('test_seconds', 'Test latency.', ('stage',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            latency.observe(value, stage='parse')
+        registry.counter('test_total', 'Test counter.').inc(3)
+        text = registry.render()
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{stage="parse",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="parse",le="1.0"} 3', text)
+        self.assertIn('test_seconds_bucket{stage="parse",le="+Inf"} 4', text)
+        self.assertIn('test_seconds_count{stage="parse"} 4', text)
+        self.assertIn('test_total 3', text)
+
+    def test_failed_stage_is_counted(self):
+        before = STAGE_SECONDS.count(stage='test_failure')
+        with self.assertRaises(ValueError), stage_timer('test_failure'):
+            raise ValueError
+        self.assertEqual(STAGE_SECONDS.count(stage='test_failure'), before + 1)
+        self.assertIn('simsalabim_stage_errors_total{stage="test_failure"}', Client().get('/simsalabim/metrics/').content.decode())
+
+    def test_search_stages_are_exported(self):
+        with open(os.path.join(AUDIO_FOLDER, QUERY_SONGS[0]), 'rb') as f:
+            views.parse_midi_bytes(f.read())
+        response = Client().get('/simsalabim/metrics/')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode()
+        self.assertIn('simsalabim_stage_seconds_count{stage="midi_parse"}', text)
+        self.assertIn('simsalabim_corpus_size{kind="audio"}', text)
+
+
+class ProfilingTests(SimpleTestCase):
+    """
+    Requests are only profiled when asked for with a valid token, and then carry a Server-Timing header.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def get(self, **headers):
+        with override_settings(PROFILING_TOKEN='secret', PROFILE_DIR=self.tmp):
+            return Client().get('/simsalabim/test/', **headers)
+
+    def test_requests_are_not_profiled_by_default(self):
+        for headers in ({}, {'HTTP_X_SIMSALABIM_PROFILE': '1'},
+                        {'HTTP_X_SIMSALABIM_PROFILE': '1', 'HTTP_X_SIMSALABIM_PROFILE_TOKEN': 'wrong'}):
+            response = self.get(**headers)
+            self.assertNotIn('Server-Timing', response)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_profiled_request_is_stored(self):
+        response = self.get(HTTP_X_SIMSALABIM_PROFILE='1', HTTP_X_SIMSALABIM_PROFILE_TOKEN='secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('total;dur=', response['Server-Timing'])
+        request_id = response['X-Simsalabim-Profile-Id']
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, request_id + '.prof')))
+        self.assertEqual(load_profile_summary(request_id, self.tmp)['path'], '/simsalabim/test/')
+
+    def test_stages_are_summed_per_request(self):
+        stages = []
+        token = request_stages.set(stages)
+        try:
+            for _ in range(2):
+                with stage_timer('histogram'):
+                    pass
+        finally:
+            request_stages.reset(token)
+        totals = stage_totals(stages)
+        self.assertEqual(list(totals), ['histogram'])
+        self.assertEqual(totals['histogram'][1], 2)
+        self.assertRegex(server_timing(totals, 0.5), r'^histogram;dur=[0-9.]+;desc="2x", total;dur=500\.000$')
+
+
+class MemoryBudgetTests(CatalogTestCase):
+    """
+    A build over its memory budget must switch to blocked writing without changing the index.
+    """
+
+    indexed = False
+
+    def build(self, budget):
+        out_dir, memory = tempfile.mkdtemp(dir=self.tmp), []
+        build_audio_index(self.tmp, out_dir, memory=memory, budget=budget)
+        return out_dir, {entry["stage"]: entry for entry in memory}
+
+    def test_blocked_build_matches_in_memory_build(self):
+        in_memory, in_memory_report = self.build(None)
+        blocked, blocked_report = self.build(64 * 1024)
+        self.assertEqual(in_memory_report['histogram+write']['mode'], 'in-memory')
+        self.assertEqual(blocked_report['histogram+write']['mode'], 'blocked')
+        for name in os.listdir(in_memory):
+            if name.endswith('.npy'):
+                expected, actual = np.load(os.path.join(in_memory, name)), np.load(os.path.join(blocked, name))
+                self.assertEqual(expected.shape, actual.shape, name)
+                self.assertTrue(np.allclose(expected, actual), name)
+
+    def test_stage_memory_is_recorded(self):
+        report = []
+        with track_memory('allocate', report, rows=1):
+            data = np.ones(4 * 2**20)
+        del data
+        self.assertEqual(report[0]["stage"], 'allocate')
+        self.assertEqual(report[0]["rows"], 1)
+        if report[0]["exact_peak"]:
+            self.assertGreaterEqual(report[0]["rss_peak"] - report[0]["rss_before"], 16 * 2**20)
+
+
+class NoteStoreTests(CatalogTestCase):
+    """
+    Segments derived from the note store must equal those of parsing every file.
+    """
+
+    indexed = False
+
+    def test_store_features_match_featurize_midi(self):
+        store, parsed, skipped = build_note_store(self.tmp)
+        self.assertEqual((parsed, skipped), (len(QUERY_SONGS), []))
+        songs, song_features = featurize_store(store)
+        self.assertEqual(songs, sorted(QUERY_SONGS))
+        for name, features in zip(songs, song_features):
+            expected = featurize_midi_file(os.path.join(self.tmp, name))[1]
+            self.assertEqual(sorted(features), sorted(expected))
+            for channel in expected:
+                np.testing.assert_array_equal(features[channel], expected[channel])
+
+    def test_other_segmentations_without_parsing(self):
+        build_note_store(self.tmp)
+        with mock.patch('simsalabim.note_store.extract_note_events_file') as parse:
+            store, parsed, _ = build_note_store(self.tmp)
+        parse.assert_not_called()
+        self.assertEqual(parsed, 0)
+        self.assertTrue(os.path.exists(note_store_path(self.tmp)))
+
+        song_id = store['song_ids'][sorted(QUERY_SONGS)[0]]
+        segments, offsets = segment_store(store, 1, segment_length=12, sliding_window=4)
+        start, end = store['offsets'][song_id * 16 + 1:song_id * 16 + 3]
+        np.testing.assert_array_equal(
+            segments[offsets[song_id]:offsets[song_id + 1]], segment_notes(store['pitch'][start:end], 12, 4)
+        )
+
+
+class TimingFeatureTests(CatalogTestCase):
+    """
+    Timing features must match tesmidi and be scored from the index only when enabled.
+    """
+
+    indexed = False
+
+    def test_timing_json_matches_per_channel_processing(self):
+        tesmidi.process_and_save_timing_data(self.tmp)
+        for prefix, use_delta in (('delta', True), ('absolute', False)):
+            expected = tesmidi.process_all_midi_files_timing(self.tmp, 1, use_delta)
+            with open(os.path.join(self.tmp, f'midi_{prefix}_time_channel_1.json')) as f:
+                self.assertEqual(json.load(f), json.loads(json.dumps(expected)))
+
+    def test_timed_index(self):
+        out_dir = staging_dir(self.tmp)
+        build_audio_index_from_notes(self.tmp, out_dir, timing=True)
+        self.assertEqual(verify_audio_index(self.tmp, out_dir), [])
+        swap_index(self.tmp, out_dir)
+        index = load_audio_index(self.tmp)
+        self.assertTrue(index["timing"])
+
+        name = sorted(QUERY_SONGS)[0]
+        features, timing = featurize_midi_timed(mido.MidiFile(os.path.join(self.tmp, name)))
+        pitch_only = overall_similarities(score_query(index, features))
+        self.assertEqual(overall_similarities(score_query(index, features, timing, 0.0)), pitch_only)
+        with_timing = overall_similarities(score_query(index, features, timing, 0.5))
+        self.assertEqual(max(with_timing, key=with_timing.get), name)
+        self.assertAlmostEqual(with_timing[name], 1.0)
+
+        add_songs_to_index(self.tmp, [(name, features)])
+        self.assertTrue(load_audio_index(self.tmp)["timing"])
+
+    def test_song_without_timing_is_left_out(self):
+        out_dir = staging_dir(self.tmp)
+        build_audio_index_from_notes(self.tmp, out_dir, timing=True)
+        swap_index(self.tmp, out_dir)
+        features = featurize_midi_file(os.path.join(self.tmp, QUERY_SONGS[0]))[1]
+        for name in ('good.mid', 'broken.mid'):
+            shutil.copy(os.path.join(self.tmp, QUERY_SONGS[0]), os.path.join(self.tmp, name))
+
+        timing_from_file = audio_index.timing_from_file
+        with mock.patch.object(audio_index, 'timing_from_file',
+                               lambda path: None if path.endswith('broken.mid') else timing_from_file(path)):
+            add_songs_to_index(self.tmp, [('good.mid', features), ('broken.mid', features)])
+        index = load_audio_index(self.tmp)
+        self.assertTrue(index["timing"])
+        self.assertEqual(index["songs"], sorted(QUERY_SONGS) + ['good.mid'])
+
+
+class PrecisionTests(CatalogTestCase):
+    """
+    Compact histogram storage must score like float64 and keep its precision across updates.
+    """
+
+    indexed = False
+
+    def test_compact_scores_match_float64(self):
+        publish_audio_index(self.tmp)
+        results = {result["precision"]: result for result in compare_precisions(load_audio_index(self.tmp), top_k=2)}
+        for precision, tolerance in (('float32', 1e-5), ('float16', 1e-3), ('uint8', 1e-5)):
+            self.assertLess(results[precision]["max_error"], tolerance, precision)
+            self.assertEqual(results[precision]["overlap"], 1.0, precision)
+        self.assertGreater(results['uint8']["ratio"], 7)
+
+    def test_uint8_index_is_kept_on_update(self):
+        out_dir = staging_dir(self.tmp)
+        build_audio_index(self.tmp, out_dir, precision='uint8')
+        self.assertEqual(verify_audio_index(self.tmp, out_dir), [])
+        swap_index(self.tmp, out_dir)
+        name = sorted(QUERY_SONGS)[0]
+        features = featurize_midi_file(os.path.join(self.tmp, name))[1]
+        add_songs_to_index(self.tmp, [(name, features)])
+        index = load_audio_index(self.tmp)
+        self.assertEqual(index["precision"], 'uint8')
+        self.assertEqual(index["channels"][1]['atb'].dtype, np.uint8)
+        scores = overall_similarities(score_query(index, features))
+        self.assertAlmostEqual(scores[name], 1.0, places=5)
+
+
+class DedupTests(CatalogTestCase):
+    """
+    Duplicate songs are stored once but still listed, with the scores of the song they duplicate.
+    """
+
+    indexed = False
+
+    def setUp(self):
+        super().setUp()
+        shutil.copy(os.path.join(AUDIO_FOLDER, 'Angeleyes.mid'), os.path.join(self.tmp, 'Angeleyes.copy.mid'))
+
+    def test_duplicates_score_like_separate_songs(self):
+        plain_dir = tempfile.mkdtemp(dir=self.tmp)
+        build_audio_index(self.tmp, plain_dir, dedup=False)
+        out_dir = staging_dir(self.tmp)
+        build_audio_index(self.tmp, out_dir)
+        self.assertEqual(verify_audio_index(self.tmp, out_dir), [])
+        plain, index = open_audio_index(plain_dir), open_audio_index(out_dir)
+
+        # The song listed first stays the representative, the other one becomes its alias
+        first_id, copy_id = sorted(index["songs"].index(name) for name in ('Angeleyes.mid', 'Angeleyes.copy.mid'))
+        self.assertEqual(index["alias_of"][copy_id], first_id)
+        self.assertEqual(index["aliases"], {first_id: [copy_id]})
+        for channel, data in index["channels"].items():
+            self.assertNotIn(copy_id, data['songs'])
+            self.assertLessEqual(len(data['atb']), len(plain["channels"][channel]['atb']))
+        self.assertLess(len(index["channels"][1]['atb']), len(plain["channels"][1]['atb']))
+
+        features = featurize_midi_file(os.path.join(self.tmp, 'Angeleyes.mid'))[1]
+        self.assertEqual(
+            overall_similarities(score_query(index, features)), overall_similarities(score_query(plain, features))
+        )
+        ranking = dict(rank_queries(index, [features], top_k=2)[0])
+        self.assertEqual(set(ranking), {'Angeleyes.mid', 'Angeleyes.copy.mid'})
+        self.assertAlmostEqual(ranking['Angeleyes.copy.mid'], 1.0)
+
+    def test_aliases_are_rebuilt_on_update(self):
+        publish_audio_index(self.tmp)
+        shutil.copy(os.path.join(AUDIO_FOLDER, 'All_Mixed_Up.mid'), os.path.join(self.tmp, 'All_Mixed_Up.copy.mid'))
+        features = featurize_midi_file(os.path.join(self.tmp, 'All_Mixed_Up.copy.mid'))[1]
+        add_songs_to_index(self.tmp, [('All_Mixed_Up.copy.mid', features)])
+        index = load_audio_index(self.tmp)
+        self.assertEqual(sum(len(aliases) for aliases in index["aliases"].values()), 2)
+        scores = overall_similarities(score_query(index, features))
+        self.assertAlmostEqual(scores['All_Mixed_Up.copy.mid'], 1.0)
+        self.assertEqual(scores['All_Mixed_Up.copy.mid'], scores['All_Mixed_Up.mid'])
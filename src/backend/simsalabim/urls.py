@@ -11,5 +11,11 @@ urlpatterns = [
     path('audio-search-result/', views.audio_search_result, name='audio_search_result'),
     path('download-audio-file/<str:filename>/', views.download_audio_file, name='download_audio_file'),
     path('cover-search-result/', views.cover_search_result, name='cover_search_result'),
+    path('batch-audio-search/', views.batch_audio_search, name='batch_audio_search'),
+    path('batch-cover-search/', views.batch_cover_search, name='batch_cover_search'),
+    path('similar-songs/<str:song>/', views.similar_songs_lookup, name='similar_songs'),
+    path('cover-cache-stats/', views.cover_cache_stats, name='cover_cache_stats'),
+    path('worker-stats/', views.worker_stats, name='worker_stats'),
+    path('metrics/', views.prometheus_metrics, name='metrics'),
     path('download-cover-file/<str:filename>/', views.download_cover_file, name='download_cover_file')
 ]
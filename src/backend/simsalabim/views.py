@@ -1,34 +1,115 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from django.http import JsonResponse, FileResponse, HttpResponseNotFound
+from django.http import JsonResponse, FileResponse, HttpResponse, HttpResponseNotFound
 from django.core.files.storage import default_storage
 from django.utils.encoding import smart_str
+from django.conf import settings
 import glob  # For matching file patterns
 import os
-import zipfile
+import io
+import math
+import time
 import json
 from imageprocessing import *
 import numpy as np
 from PIL import Image
 
-from .tesmidi import (
-    process_all_channels_atb,
-    process_all_channels_rtb_ftb,
-    process_all_channels,
-    process_all_midi_files,
-    process_midi_file,
-    extract_melody_track_by_channel,
-    normalize_segment,
-    calculate_highest_similarity
+from .tesmidi import calculate_highest_similarity
+from .audio_index import (
+    parse_midi_bytes,
+    featurize_midi,
+    featurize_midi_timed,
+    featurize_midi_file,
+    add_songs_to_index,
+    load_audio_index,
+    score_query,
+    rank_queries,
+    cells_for_budget,
+    anytime_search
 )
+from .cover_index import (
+    image_to_pixels,
+    hash_pixels,
+    featurize_cover_file,
+    add_covers_to_index,
+    load_cover_index,
+    find_similar_covers,
+    find_similar_covers_batch
+)
+from .ingest_pipeline import FeaturizePipeline
+from .perceptual_hash import BKTree, NEAR_DUPLICATE_BITS
+from .result_cache import ResultCache, content_hash
+from .zip_ingest import ingest_zip, ZipIngestError
+from .workspaces import create_workspace, workspace_path, write_json_atomic
+from .memory_stats import process_memory, index_memory
+from .search_shards import ShardCoordinator
+from .song_neighbours import load_song_neighbours, similar_songs
+from .index_files import current_generation
+from .metrics import REGISTRY, CONTENT_TYPE, stage_timer
 
 AUDIO_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '../datasets/audio'))
+COVER_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '../datasets/cover'))
 
 # Base directory and datasets folder
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATASET_DIR = os.path.join(BASE_DIR, 'datasets')
 JSON_DIR = os.path.join(BASE_DIR, 'datasets/mapper')
 
+# Cover search results keyed by (SHA-256 of the query image, index version, top_k)
+cover_result_cache = ResultCache(maxsize=settings.COVER_RESULT_CACHE_SIZE, ttl=settings.COVER_RESULT_CACHE_TTL)
+
+# Top-k of a sharded or time-budgeted audio search, written into the query workspace
+RANKING_FILE = 'ranking.json'
+
+_shard_coordinator = None
+
+SEARCHES = REGISTRY.counter('simsalabim_searches_total', 'Searches answered, by catalog and search mode.', ('kind', 'mode'))
+FILES_SERVED = REGISTRY.counter('simsalabim_served_files_total', 'Catalog files served for download.', ('kind',))
+SERVED_BYTES = REGISTRY.counter('simsalabim_served_bytes_total', 'Bytes of catalog files served for download.', ('kind',))
+CORPUS_SIZE = REGISTRY.gauge('simsalabim_corpus_size', 'Items in the live index.', ('kind',))
+INDEX_INFO = REGISTRY.gauge('simsalabim_index_info', 'Version and generation of the live index (always 1).',
+                            ('kind', 'version', 'generation'))
+CACHE_LOOKUPS = REGISTRY.counter('simsalabim_cache_lookups_total', 'Result cache lookups, by outcome.',
+                                 ('cache', 'result'))
+CACHE_HIT_RATIO = REGISTRY.gauge('simsalabim_cache_hit_ratio', 'Share of result cache lookups that were hits.', ('cache',))
+CACHE_SIZE = REGISTRY.gauge('simsalabim_cache_entries', 'Entries held by a result cache.', ('cache',))
+
+
+def collect_search_metrics():
+    """
+    Reads corpus sizes, index versions and cache statistics when the metrics endpoint is scraped.
+    """
+    INDEX_INFO.clear()
+    indexes = {
+        'audio': (AUDIO_FOLDER, load_audio_index(AUDIO_FOLDER), 'songs'),
+        'cover': (COVER_FOLDER, load_cover_index(COVER_FOLDER, n_components=settings.COVER_PCA_COMPONENTS), 'names'),
+    }
+    for kind, (folder, index, items) in indexes.items():
+        CORPUS_SIZE.set(len(index[items]) if index else 0, kind=kind)
+        if index:
+            INDEX_INFO.set(1, kind=kind, version=index["version"], generation=current_generation(folder) or '')
+
+    stats = cover_result_cache.stats()
+    CACHE_LOOKUPS.set(stats["hits"], cache='cover_results', result='hit')
+    CACHE_LOOKUPS.set(stats["misses"], cache='cover_results', result='miss')
+    CACHE_HIT_RATIO.set(stats["hit_rate"], cache='cover_results')
+    CACHE_SIZE.set(stats["size"], cache='cover_results')
+
+
+REGISTRY.register_collector(collect_search_metrics)
+
+
+def get_shard_coordinator():
+    """
+    Returns the coordinator for the shard processes listed in AUDIO_SEARCH_SHARDS.
+    """
+    global _shard_coordinator
+    if _shard_coordinator is None:
+        _shard_coordinator = ShardCoordinator(
+            settings.AUDIO_SEARCH_SHARDS, settings.AUDIO_SHARD_AUTHKEY, settings.AUDIO_SEARCH_DEADLINE
+        )
+    return _shard_coordinator
+
 # Ensure the datasets folder exists
 if not os.path.exists(DATASET_DIR):
     os.makedirs(DATASET_DIR)
@@ -68,81 +149,83 @@ def handle_zip_upload(request):
 
     if request.method == 'POST' and request.FILES.get('file'):
         uploaded_file = request.FILES['file']
-        file_path = os.path.join(target_dir, uploaded_file.name)
-
-        # Save the uploaded ZIP file temporarily
-        with open(file_path, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
 
         # Tentukan ekstensi yang diizinkan
         allowed_extensions = {'.mid'} if folder == 'audio' else {'.png', '.jpeg', '.jpg'}
 
+        # Featurize every extracted member in worker processes while the rest of the ZIP is extracted
+        featurize = featurize_midi_file if folder == 'audio' else featurize_cover_file
+        pipeline = FeaturizePipeline(featurize, workers=settings.INGEST_WORKERS)
+
+        # Optionally skip covers that are near-duplicates of indexed or already extracted ones
+        dedupe = folder == 'cover' and request.POST.get('dedupe') in ('1', 'true')
+        if dedupe:
+            index = load_cover_index(target_dir, n_components=settings.COVER_PCA_COMPONENTS)
+            indexed_hashes = index["hash_tree"] if index else BKTree()
+            extracted_hashes = BKTree()
+
+        def accept(filename, staged_path):
+            if dedupe:
+                try:
+                    cover_hash = hash_pixels(image_to_pixels(staged_path))
+                except (OSError, ValueError):
+                    cover_hash = None
+                if cover_hash is not None:
+                    if (indexed_hashes.search(cover_hash, NEAR_DUPLICATE_BITS)
+                            or extracted_hashes.search(cover_hash, NEAR_DUPLICATE_BITS)):
+                        print(f"DEBUG: Skipped near-duplicate cover: {filename}")
+                        return False
+                    extracted_hashes.add(cover_hash, filename)
+            pipeline.submit(filename, staged_path)
+            return True
+
         try:
-            # Validasi isi ZIP dan batasi 251 file pertama
-            is_valid, invalid_file = validate_zip_contents(file_path, allowed_extensions, limit=251)
-            if not is_valid:
-                os.remove(file_path)
-                allowed_types = " or ".join(allowed_extensions)
-                return JsonResponse({'message': f'Invalid file in ZIP: {invalid_file}. Only {allowed_types} files are allowed.'}, status=400)
-
-            # Ekstraksi file valid ke dalam folder, hanya file saja
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                count = 0
-                for member in zip_ref.namelist():
-                    if count >= 251:  # Batasan maksimal 251 file
-                        break
-
-                    # Abaikan direktori atau file sistem
-                    if member.endswith('/') or member.startswith('__MACOSX/'):
-                        continue
-
-                    # Ekstraksi hanya file dengan ekstensi yang diizinkan
-                    filename = os.path.basename(member)
-                    _, ext = os.path.splitext(filename)
-                    if ext.lower() in allowed_extensions:
-                        with zip_ref.open(member) as source_file:
-                            target_path = os.path.join(target_dir, filename)
-                            with open(target_path, 'wb') as output_file:
-                                output_file.write(source_file.read())
-                        count += 1
-
-            os.remove(file_path)  # Hapus file ZIP setelah diekstraksi
-            return JsonResponse({'message': f'File uploaded and extracted to {folder} successfully!'})
-        except zipfile.BadZipFile:
-            os.remove(file_path)
-            return JsonResponse({'message': 'Invalid ZIP file!'}, status=400)
+            with pipeline, stage_timer('zip_ingest'):
+                # Validasi dan ekstraksi langsung dari file upload, batasi 251 file pertama
+                stats = ingest_zip(
+                    uploaded_file, target_dir, allowed_extensions, limit=251,
+                    max_member_bytes=settings.ZIP_MAX_MEMBER_BYTES,
+                    max_total_bytes=settings.ZIP_MAX_TOTAL_BYTES,
+                    max_ratio=settings.ZIP_MAX_COMPRESSION_RATIO,
+                    accept=accept,
+                    before_commit=pipeline.drain
+                )
+        except ZipIngestError as e:
+            return JsonResponse({'message': str(e)}, status=400)
+
+        print(f"DEBUG: Extracted {len(stats['files'])} files ({stats['bytes']} bytes) "
+              f"in {stats['seconds']:.2f}s, {stats['bytes_per_sec'] / 1e6:.1f} MB/s")
+
+        # Add the featurized members to the live index so they are searchable right away. Member
+        # names are unique (ingest_zip rejects duplicates), so each result belongs to the committed file
+        extracted = set(stats['files'])
+        results = [(name, result, seconds) for name, result, seconds in pipeline.results if name in extracted]
+        if folder == 'audio':
+            new_entries = [(name, result[1]) for name, result, _ in results if result[1]]
+            indexed = add_songs_to_index(target_dir, new_entries, settings.INDEX_MEMORY_BUDGET) if new_entries else None
+        elif folder == 'cover':
+            new_entries = [(name,) + result for name, result, _ in results if result is not None]
+            indexed = add_covers_to_index(target_dir, new_entries) if new_entries else None
+        else:
+            new_entries, indexed = [], None
+
+        message = f'File uploaded and extracted to {folder} successfully!'
+        if stats['skipped']:
+            message += f' Skipped {stats["skipped"]} near-duplicate covers.'
+        if new_entries and indexed is None:
+            message += ' Files will be searchable after the next index build.'
+        return JsonResponse({
+            'message': message,
+            'files': len(stats['files']),
+            'indexed': len(new_entries) if indexed is not None else 0,
+            'bytes': stats['bytes'],
+            'seconds': round(stats['seconds'], 3),
+            'bytes_per_sec': round(stats['bytes_per_sec']),
+            'file_seconds': {name: round(seconds, 4) for name, _, seconds in results}
+        })
 
     return JsonResponse({'message': 'No file uploaded!'}, status=400)
 
-def validate_zip_contents(zip_file_path, allowed_extensions, limit=251):
-    """
-    Validates all files inside the ZIP recursively. Only the first `limit` files will be checked.
-    """
-    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-        count = 0
-        for member in zip_ref.namelist():
-            if count >= limit:
-                break
-
-            # Abaikan folder
-            if member.endswith('/'):
-                continue
-
-            # Abaikan file sistem
-            filename = os.path.basename(member)
-            if filename in {'README.md', 'LICENSE', '.gitattributes', '.DS_Store', 'Thumbs.db'}:
-                continue
-
-            # Periksa apakah file memiliki ekstensi yang valid
-            _, ext = os.path.splitext(filename)
-            if ext.lower() not in allowed_extensions:
-                return False, filename
-
-            count += 1
-
-    return True, None
-
 @api_view(['POST'])
 def handle_json_upload(request):
     folder = request.POST.get('folder')
@@ -161,7 +244,7 @@ def handle_json_upload(request):
         file_path = os.path.join(target_dir, uploaded_file.name)
 
         # Save the uploaded file
-        with open(file_path, 'wb+') as destination:
+        with stage_timer('upload_write'), open(file_path, 'wb+') as destination:
             for chunk in uploaded_file.chunks():
                 destination.write(chunk)
 
@@ -177,6 +260,19 @@ def handle_json_upload(request):
 
 
 
+def _featurize_audio_query(index, midi_bytes):
+    """
+    Featurizes an uploaded MIDI query, with its timing when AUDIO_TIMING_WEIGHT is set and the index stores timing.
+
+    Returns:
+        Tuple of (channel -> segments, channel -> timing segments or None)
+    """
+    mid = parse_midi_bytes(midi_bytes)
+    if settings.AUDIO_TIMING_WEIGHT and index is not None and index["timing"]:
+        return featurize_midi_timed(mid)
+    return featurize_midi(mid), None
+
+
 @api_view(['POST'])
 def handle_mid_upload(request):
     folder = request.POST.get('folder')  # Retrieve the folder name from the request
@@ -186,15 +282,6 @@ def handle_mid_upload(request):
     target_dir = os.path.join(DATASET_DIR, folder)
     os.makedirs(target_dir, exist_ok=True)  # Ensure the target directory exists
 
-    # Delete existing input.mid if it exists
-    existing_file_path = os.path.join(target_dir, 'input.mid')
-    if os.path.exists(existing_file_path):
-        try:
-            os.remove(existing_file_path)
-            print(f"DEBUG: Deleted existing file: {existing_file_path}")
-        except OSError as e:
-            return JsonResponse({'message': f'Error deleting existing input.mid: {e}'}, status=500)
-
     if request.method == 'POST' and request.FILES.get('file'):
         uploaded_file = request.FILES['file']
 
@@ -202,47 +289,74 @@ def handle_mid_upload(request):
         if not uploaded_file.name.lower().endswith('.mid'):
             return JsonResponse({'message': 'Invalid file type! Only .mid files are allowed.'}, status=400)
 
-        # Rename the file to "input.mid"
-        renamed_file_path = os.path.join(target_dir, 'input.mid')
-
-        # Save the uploaded file with the new name
-        with default_storage.open(renamed_file_path, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
-        print(f"DEBUG: Uploaded and renamed file to: {renamed_file_path}")
+        # Score the query against the prebuilt audio index (see `manage.py buildindex audio`)
+        index = None if settings.AUDIO_SEARCH_SHARDS else load_audio_index(AUDIO_FOLDER)
+        if index is None and not settings.AUDIO_SEARCH_SHARDS:
+            return JsonResponse({'message': 'Audio index has not been built yet. Run "manage.py buildindex audio".'}, status=503)
+        if settings.AUDIO_SEARCH_SHARDS and not settings.AUDIO_SHARD_AUTHKEY:
+            return JsonResponse({'message': 'Shard search needs SIMSALABIM_SHARD_AUTHKEY to be set.'}, status=503)
 
+        budget = settings.AUDIO_SEARCH_BUDGET or 0
+        if request.POST.get('budget'):
+            try:
+                budget = float(request.POST['budget'])
+            except ValueError:
+                budget = math.nan
+            # Also rejects nan, inf and negative values, which would never or immediately end the search
+            if not (math.isfinite(budget) and budget > 0):
+                return JsonResponse({'message': 'budget must be a positive number of seconds.'}, status=400)
+
+        # The query is parsed straight from the uploaded bytes; nothing is written to the dataset
+        with stage_timer('upload_read'):
+            midi_bytes = uploaded_file.read()
         try:
-            channels = [0, 1, 2, 10]
-            for channel in channels:
-                # Process all MIDI files in the folder for this channel
-                midi_data = process_all_midi_files(AUDIO_FOLDER, channel)
-                
-                # Only create a JSON file if there's data for this channel
-                if midi_data:
-                    # Save the extracted data to a JSON file inside the same folder
-                    json_file_path = os.path.join(AUDIO_FOLDER, f'midi_data_channel_{channel}.json')
-                    with open(json_file_path, 'w') as json_file:
-                        json.dump(midi_data, json_file, indent=4)
-                    print(f"Data for channel {channel} has been successfully extracted and saved to {json_file_path}.")
-                else:
-                    print(f"No data found for channel {channel}.")
-            print(f"DEBUG: Successfully processed all MIDI files in {AUDIO_FOLDER} for channels {channels}.")
+            query_features, query_timing = _featurize_audio_query(index, midi_bytes)
         except Exception as e:
             return JsonResponse({'message': f'Error during processing MIDI files: {str(e)}'}, status=500)
 
         try:
-            process_all_channels_atb(target_dir)
-            process_all_channels_rtb_ftb(target_dir)
-        except Exception as e:
-            return JsonResponse({'message': f'Error during histogram processing: {str(e)}'}, status=500)
-
-        try:
-            process_all_channels(target_dir)
+            # Results go to a private workspace so concurrent searches never share files
+            query_id, workspace = create_workspace()
+            if settings.AUDIO_SEARCH_SHARDS:
+                # Scatter-gather over the shard processes (see `manage.py runshard`)
+                with stage_timer('audio_search'):
+                    ranking = get_shard_coordinator().search(query_features, top_k=5)
+                write_json_atomic(os.path.join(workspace, RANKING_FILE), ranking)
+                SEARCHES.inc(kind='audio', mode='sharded')
+            elif budget:
+                # Best-so-far ranking within the time budget (seconds)
+                with stage_timer('audio_search'):
+                    ranking = anytime_search(index, query_features, budget, top_k=5, query_timing=query_timing,
+                                             timing_weight=settings.AUDIO_TIMING_WEIGHT)
+                write_json_atomic(os.path.join(workspace, RANKING_FILE), ranking)
+                SEARCHES.inc(kind='audio', mode='anytime')
+            else:
+                with stage_timer('audio_search'):
+                    channel_results = score_query(index, query_features, query_timing, settings.AUDIO_TIMING_WEIGHT)
+                with stage_timer('result_write'):
+                    for channel, weighted_results in channel_results.items():
+                        output_path = os.path.join(workspace, f'weighted_similarities_channel_{channel}.json')
+                        write_json_atomic(output_path, weighted_results)
+                SEARCHES.inc(kind='audio', mode='exact')
         except Exception as e:
             return JsonResponse({'message': f'Error during channel similarity processing: {str(e)}'}, status=500)
 
+        # Only store the song when the user asks to add it to the catalog
+        if request.POST.get('add_to_catalog') in ('1', 'true'):
+            song_name = os.path.basename(uploaded_file.name)
+            if song_name == 'input.mid':
+                return JsonResponse({'message': 'input.mid is reserved and cannot be added to the catalog.'}, status=400)
+            with stage_timer('upload_write'), default_storage.open(os.path.join(AUDIO_FOLDER, song_name), 'wb+') as destination:
+                destination.write(midi_bytes)
+            if query_features:
+                add_songs_to_index(AUDIO_FOLDER, [(song_name, query_features)], settings.INDEX_MEMORY_BUDGET)
+            print(f"DEBUG: Added {song_name} to the catalog")
+            return JsonResponse({
+                'message': f'MIDI file processed and added to the catalog as {song_name}!',
+                'query_id': query_id
+            })
 
-        return JsonResponse({'message': f'MIDI file uploaded and processed successfully to {folder} as input.mid!'})
+        return JsonResponse({'message': 'MIDI file uploaded and processed successfully!', 'query_id': query_id})
 
     return JsonResponse({'message': 'No file uploaded!'}, status=400)
 
@@ -254,11 +368,29 @@ def audio_search_result(request):
     """
     base_folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '../datasets/audio'))
 
+    # Results of the upload identified by query_id; there is no fallback to other uploads
+    query_id = request.GET.get('query_id')
+    if not query_id:
+        return JsonResponse({"error": "query_id is required."}, status=400)
+    workspace = workspace_path(query_id)
+    if not workspace:
+        return JsonResponse({"error": "Query not found. Upload a MIDI file first."}, status=404)
+
     try:
-        # Calculate highest similarity
-        result = calculate_highest_similarity(base_folder)
-        best_song = result.get("song")
-        similarity_percentage = result.get("similarity_percentage")
+        ranking_path = os.path.join(workspace, RANKING_FILE)
+        partial = False
+        if os.path.exists(ranking_path):
+            # Top-k of a sharded or time-budgeted search
+            with open(ranking_path, 'r') as f:
+                ranking = json.load(f)
+            best_song, best_value = ranking["results"][0] if ranking["results"] else (None, 0)
+            similarity_percentage = round(best_value * 100, 2)
+            partial = ranking["partial"]
+        else:
+            # Calculate highest similarity
+            result = calculate_highest_similarity(workspace)
+            best_song = result.get("song")
+            similarity_percentage = result.get("similarity_percentage")
 
         if not best_song:
             return JsonResponse({
@@ -276,6 +408,7 @@ def audio_search_result(request):
         response_data = {
             "best_song": best_song,
             "similarity_percentage": similarity_percentage,
+            "partial": partial,
             "file_path": request.build_absolute_uri(f'/api/download/{best_song}')
         }
         return JsonResponse(response_data)
@@ -299,8 +432,11 @@ def download_audio_file(request, filename):
             return HttpResponseNotFound(f"File '{filename}' not found on the server.")
 
         # Serve the file as a downloadable stream
-        response = FileResponse(open(file_path, 'rb'), content_type='audio/midi')
-        response['Content-Disposition'] = f'attachment; filename="{smart_str(filename)}"'
+        with stage_timer('file_serving'):
+            response = FileResponse(open(file_path, 'rb'), content_type='audio/midi')
+            response['Content-Disposition'] = f'attachment; filename="{smart_str(filename)}"'
+        FILES_SERVED.inc(kind='audio')
+        SERVED_BYTES.inc(os.path.getsize(file_path), kind='audio')
         return response
     except Exception as e:
         return JsonResponse({
@@ -337,24 +473,6 @@ def handle_cover_upload(request):
     target_dir = os.path.join(DATASET_DIR, folder)
     os.makedirs(target_dir, exist_ok=True)  # Ensure the target directory exists
 
-    input_image_name = 'input_image'
-
-    # Look for existing input_image files in the target directory
-    existing_file_path = None
-    for filename in os.listdir(target_dir):
-        if filename.startswith(input_image_name):
-            existing_file_path = os.path.join(target_dir, filename)
-            print(f"Found file: {existing_file_path}")
-            break
-
-    # If an existing file is found, delete it
-    if existing_file_path and os.path.exists(existing_file_path):
-        try:
-            os.remove(existing_file_path)
-            print(f"DEBUG: Deleted existing file: {existing_file_path}")
-        except OSError as e:
-            return JsonResponse({'message': f'Error deleting existing file: {e}'}, status=500)
-
     # Handle file upload
     if request.method == 'POST' and request.FILES.get('file'):
         uploaded_file = request.FILES['file']
@@ -365,64 +483,25 @@ def handle_cover_upload(request):
 
         # Retain the original file extension
         _, file_extension = os.path.splitext(uploaded_file.name)
-        renamed_file_path = os.path.join(target_dir, f'input_image{file_extension}')
+
+        # Each upload gets its own workspace so concurrent searches never overwrite each other
+        query_id, workspace = create_workspace()
+        renamed_file_path = os.path.join(workspace, f'input_image{file_extension.lower()}')
 
         # Save the uploaded file with the new name
-        with default_storage.open(renamed_file_path, 'wb+') as destination:
+        with stage_timer('upload_write'), default_storage.open(renamed_file_path, 'wb+') as destination:
             for chunk in uploaded_file.chunks():
                 destination.write(chunk)
         print(f"DEBUG: Uploaded and renamed file to: {renamed_file_path}")
 
-        return JsonResponse({'message': f'Cover file uploaded and processed successfully to {folder} as input_image!'}, status=200)
+        return JsonResponse({
+            'message': 'Cover file uploaded and processed successfully as input_image!',
+            'query_id': query_id
+        }, status=200)
 
     return JsonResponse({'message': 'No file uploaded!'}, status=400)
 
 
-def process_image(image_path):
-    output_size = (128, 128)
-    img = Image.open(image_path)
-    img_resized = img.resize(output_size)
-
-    img_array = np.array(img_resized)
-    if len(img_array.shape) == 3:  # RGB
-        R, G, B = img_array[:, :, 0], img_array[:, :, 1], img_array[:, :, 2]
-        grayscale = 0.2989 * R + 0.5870 * G + 0.1140 * B  # Convert to grayscale
-    else:
-        grayscale = img_array  # Already grayscale
-
-    return grayscale.flatten().tolist()  # Flatten as 1D list to store in JSON
-
-def calculate_similarity_percentage(distance, max_distance):
-    """
-    Menghitung persentase kemiripan berdasarkan jarak Euclidean.
-    """
-    similarity = max(0, (1 - (distance / max_distance)) * 100)
-    return similarity
-
-def find_similar_images(input_image_path, Uk_numpy, pixel_means, image_vectors, image_names, top_k=5):
-    input_vector = process_image(input_image_path)
-    input_vector_centered = input_vector - pixel_means
-    projected_input = np.dot(input_vector_centered, Uk_numpy)
-
-    distances = []
-    for idx, image_vector in enumerate(image_vectors):
-        projected_vector = np.dot(image_vector - pixel_means, Uk_numpy)
-        distance = np.linalg.norm(projected_input - projected_vector)
-        distances.append((image_names[idx], distance))
-
-    # Tentukan jarak maksimum
-    max_distance = max([d[1] for d in distances]) if distances else 1.0
-
-    # Hitung persentase kemiripan
-    results = [
-        (name, distance, calculate_similarity_percentage(distance, max_distance))
-        for name, distance in distances
-    ]
-
-    # Urutkan berdasarkan jarak
-    results = sorted(results, key=lambda x: x[1])
-    return results[:top_k]
-
 @api_view(['GET'])
 def cover_search_result(request):
     try:
@@ -431,53 +510,52 @@ def cover_search_result(request):
         if not os.path.exists(base_folder):
             return JsonResponse({"error": "Base folder does not exist."}, status=404)
 
-        image_files = [
-            f for f in os.listdir(base_folder)
-            if f.lower().endswith(('.png', '.jpg', '.jpeg'))
-        ]
+        def is_input_image(filename):
+            return filename.startswith('input_image') and filename.endswith(('.png', '.jpg', '.jpeg'))
 
-        if not image_files:
-            return JsonResponse({"error": "No images found in the folder."}, status=404)
+        # Query image of the upload identified by query_id; there is no fallback to other uploads
+        query_id = request.GET.get('query_id')
+        if not query_id:
+            return JsonResponse({"error": "query_id is required."}, status=400)
+        workspace = workspace_path(query_id)
 
         input_image_path = None
-        for filename in image_files:
-            if filename.lower().startswith('input_image'):
-                input_image_path = os.path.join(base_folder, filename)
+        for filename in (os.listdir(workspace) if workspace else []):
+            if is_input_image(filename):
+                input_image_path = os.path.join(workspace, filename)
                 break
 
         if not input_image_path:
             return JsonResponse({"error": "Input image not found."}, status=404)
 
-        image_vectors = []
-        image_names = []
-
-        for image_file in image_files:
-            img_path = os.path.join(base_folder, image_file)
-            vector = process_image(img_path)
-            image_vectors.append(vector)
-            image_names.append(image_file)
-
-        image_vectors = np.array(image_vectors)
-
-        if image_vectors.ndim == 1:
-            image_vectors = image_vectors.reshape(1, -1)
-
-        pixel_means = np.mean(image_vectors, axis=0)
-        centered_image_vectors = image_vectors - pixel_means
-
-        # SVD PCA
-        U_numpy, Sigma_numpy, Vt_numpy = np.linalg.svd(centered_image_vectors, full_matrices=False)
-
-        k = 2
-        Uk_numpy = Vt_numpy[:k].T
+        # Memory-mapped uint8 pixel matrix + PCA model (see `manage.py buildindex cover`)
+        index = load_cover_index(base_folder, n_components=settings.COVER_PCA_COMPONENTS)
+        if index is None:
+            return JsonResponse({"error": 'Cover index has not been built yet. Run "manage.py buildindex cover".'}, status=503)
+        if not index["names"]:
+            return JsonResponse({"error": "No images found in the folder."}, status=404)
 
-        similar_images = find_similar_images(input_image_path, Uk_numpy, pixel_means, image_vectors, image_names, top_k=5)
-        best_cover, distance, similarity_percentage = similar_images[1]
+        top_k = 5
+        with open(input_image_path, 'rb') as f:
+            image_bytes = f.read()
+
+        # Results from an older index version are dropped as soon as the index is rebuilt
+        cover_result_cache.sync_version(index["version"])
+        cache_key = (content_hash(image_bytes), index["version"], top_k)
+        similar_images = cover_result_cache.get(cache_key)
+        if similar_images is None:
+            query_pixels = image_to_pixels(Image.open(io.BytesIO(image_bytes)))
+            with stage_timer('cover_search'):
+                similar_images = find_similar_covers(index, query_pixels, top_k=top_k)
+            cover_result_cache.set(cache_key, similar_images)
+        SEARCHES.inc(kind='cover', mode='exact')
+        best_cover, distance, similarity_percentage, match_type = similar_images[0]
 
         response_data = {
             "best_cover": best_cover,
             "similarity_distance": distance,
             "similarity_percentage": similarity_percentage,
+            "match_type": match_type,
             "file_path": request.build_absolute_uri(f'/api/download/{best_cover}')
         }
         return JsonResponse(response_data)
@@ -485,6 +563,181 @@ def cover_search_result(request):
     except Exception as e:
         return JsonResponse({"error": f"An error occurred: {str(e)}"}, status=500)
 
+@api_view(['GET'])
+def similar_songs_lookup(request, song):
+    """
+    API endpoint to return the precomputed most similar catalog songs of one song.
+    """
+    table = load_song_neighbours(AUDIO_FOLDER)
+    if table is None:
+        return JsonResponse({"error": 'Song neighbours have not been computed yet. Run "manage.py buildneighbours".'}, status=503)
+    limit = _count_param(request.GET.get('limit'), 10)
+    if limit is None:
+        return JsonResponse({"error": 'limit must be a positive whole number.'}, status=400)
+    neighbours = similar_songs(table, song, limit=limit)
+    if neighbours is None:
+        return JsonResponse({"error": f"Song '{song}' is not in the catalog."}, status=404)
+    return JsonResponse({
+        "song": song,
+        "neighbours": [
+            {"song": name, "similarity_percentage": round(similarity * 100, 2)}
+            for name, similarity in neighbours
+        ]
+    })
+
+def _count_param(value, default):
+    """
+    Parses a count sent with a request (top_k, limit).
+
+    Returns:
+        The count; default when it is missing; None when it is not a positive integer
+    """
+    if value is None or value == '':
+        return default
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        return None
+    return count if count >= 1 else None
+
+def _batch_response(queries, featurize_seconds, score_seconds):
+    seconds = featurize_seconds + score_seconds
+    return JsonResponse({
+        "queries": queries,
+        "count": len(queries),
+        "featurize_seconds": featurize_seconds,
+        "score_seconds": score_seconds,
+        "queries_per_sec": len(queries) / seconds if seconds > 0 else 0.0,
+    })
+
+@api_view(['POST'])
+def batch_audio_search(request):
+    """
+    API endpoint to rank the catalog for many MIDI files in one request.
+
+    Files are sent as repeated "files" fields; all of them are scored
+    against the audio index together (see audio_index.score_queries).
+    """
+    uploaded_files = request.FILES.getlist('files')
+    if not uploaded_files:
+        return JsonResponse({'message': 'No files uploaded!'}, status=400)
+    if len(uploaded_files) > settings.BATCH_SEARCH_MAX_FILES:
+        return JsonResponse({'message': f'At most {settings.BATCH_SEARCH_MAX_FILES} files per batch.'}, status=400)
+
+    index = load_audio_index(AUDIO_FOLDER)
+    if index is None:
+        return JsonResponse({'message': 'Audio index has not been built yet. Run "manage.py buildindex audio".'}, status=503)
+    top_k = _count_param(request.POST.get('top_k'), 5)
+    if top_k is None:
+        return JsonResponse({'message': 'top_k must be a positive whole number.'}, status=400)
+    top_k = min(top_k, len(index["songs"]))
+
+    start = time.perf_counter()
+    queries, features, timing = [], [], []
+    for uploaded_file in uploaded_files:
+        try:
+            query_features, query_timing = _featurize_audio_query(index, uploaded_file.read())
+            features.append(query_features)
+            timing.append(query_timing)
+            queries.append({"file": uploaded_file.name})
+        except Exception as e:
+            queries.append({"file": uploaded_file.name, "error": f'Error during processing MIDI file: {str(e)}'})
+    featurize_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rankings = iter(rank_queries(
+        index, features, top_k, cells_for_budget(settings.QUERY_MEMORY_BUDGET),
+        timing if features and timing[0] is not None else None, settings.AUDIO_TIMING_WEIGHT
+    ))
+    score_seconds = time.perf_counter() - start
+    SEARCHES.inc(len(features), kind='audio', mode='batch')
+
+    for query in queries:
+        if "error" not in query:
+            query["results"] = [
+                {"song": song, "similarity_percentage": round(similarity * 100, 2)}
+                for song, similarity in next(rankings)
+            ]
+    return _batch_response(queries, featurize_seconds, score_seconds)
+
+@api_view(['POST'])
+def batch_cover_search(request):
+    """
+    API endpoint to rank the cover catalog for many images in one request.
+
+    Images are sent as repeated "files" fields; all of them are projected
+    with one matrix product and looked up in the KD-tree together.
+    """
+    uploaded_files = request.FILES.getlist('files')
+    if not uploaded_files:
+        return JsonResponse({'message': 'No files uploaded!'}, status=400)
+    if len(uploaded_files) > settings.BATCH_SEARCH_MAX_FILES:
+        return JsonResponse({'message': f'At most {settings.BATCH_SEARCH_MAX_FILES} files per batch.'}, status=400)
+
+    index = load_cover_index(COVER_FOLDER, n_components=settings.COVER_PCA_COMPONENTS)
+    if index is None:
+        return JsonResponse({'message': 'Cover index has not been built yet. Run "manage.py buildindex cover".'}, status=503)
+    top_k = _count_param(request.POST.get('top_k'), 5)
+    if top_k is None:
+        return JsonResponse({'message': 'top_k must be a positive whole number.'}, status=400)
+
+    start = time.perf_counter()
+    queries, rows = [], []
+    for uploaded_file in uploaded_files:
+        try:
+            rows.append(image_to_pixels(Image.open(uploaded_file)))
+            queries.append({"file": uploaded_file.name})
+        except Exception as e:
+            queries.append({"file": uploaded_file.name, "error": f'Error during processing image: {str(e)}'})
+    featurize_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    query_matrix = np.array(rows, dtype=np.uint8).reshape(len(rows), -1)
+    rankings = iter(find_similar_covers_batch(index, query_matrix, top_k) if rows else [])
+    score_seconds = time.perf_counter() - start
+    SEARCHES.inc(len(rows), kind='cover', mode='batch')
+
+    for query in queries:
+        if "error" not in query:
+            query["results"] = [
+                {"cover": name, "similarity_distance": distance, "similarity_percentage": percentage,
+                 "match_type": match_type}
+                for name, distance, percentage, match_type in next(rankings)
+            ]
+    return _batch_response(queries, featurize_seconds, score_seconds)
+
+@api_view(['GET'])
+def cover_cache_stats(request):
+    """
+    API endpoint to report hit/miss statistics of the cover search result cache.
+    """
+    return JsonResponse(cover_result_cache.stats())
+
+@api_view(['GET'])
+def worker_stats(request):
+    """
+    API endpoint to report the memory use of the worker process serving the request.
+
+    Index matrices are memory-mapped, so they show up as shared pages and
+    are counted once across all workers in the summed pss.
+    """
+    return JsonResponse({
+        "memory": process_memory(),
+        "audio_index": index_memory(load_audio_index(AUDIO_FOLDER)),
+        "cover_index": index_memory(load_cover_index(COVER_FOLDER, n_components=settings.COVER_PCA_COMPONENTS)),
+    })
+
+@api_view(['GET'])
+def prometheus_metrics(request):
+    """
+    API endpoint exposing the stage latencies, counters, corpus sizes and
+    cache statistics of this worker in the Prometheus text format.
+
+    Recording a measurement only updates a few counters; the text is
+    rendered here, when the endpoint is scraped.
+    """
+    return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 @api_view(['GET'])
 def download_cover_file(request, filename):
     """
@@ -498,8 +751,11 @@ def download_cover_file(request, filename):
             return HttpResponseNotFound(f"File '{filename}' not found on the server.")
 
         # Serve the file as a downloadable stream
-        response = FileResponse(open(file_path, 'rb'), content_type='audio/midi')
-        response['Content-Disposition'] = f'attachment; filename="{smart_str(filename)}"'
+        with stage_timer('file_serving'):
+            response = FileResponse(open(file_path, 'rb'), content_type='audio/midi')
+            response['Content-Disposition'] = f'attachment; filename="{smart_str(filename)}"'
+        FILES_SERVED.inc(kind='cover')
+        SERVED_BYTES.inc(os.path.getsize(file_path), kind='cover')
         return response
     except Exception as e:
         return JsonResponse({
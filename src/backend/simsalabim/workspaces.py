@@ -0,0 +1,73 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import tempfile
+
+# Per-request query state lives in datasets/queries/<query_id>/
+WORKSPACE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../datasets/queries'))
+
+# Workspaces older than this are removed when new ones are created
+WORKSPACE_TTL = 60 * 60
+
+_QUERY_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def create_workspace(root=None, ttl=WORKSPACE_TTL):
+    """
+    Creates a private directory for one search query.
+
+    Returns:
+        Tuple of (query_id, workspace directory)
+    """
+    root = root or WORKSPACE_ROOT
+    purge_expired(root, ttl)
+    query_id = uuid.uuid4().hex
+    path = os.path.join(root, query_id)
+    os.makedirs(path)
+    return query_id, path
+
+
+def workspace_path(query_id, root=None):
+    """
+    Returns the directory of an existing workspace.
+
+    Returns:
+        Path, or None if the id is malformed or the workspace does not exist
+    """
+    if not query_id or not _QUERY_ID.match(query_id):
+        return None
+    path = os.path.join(root or WORKSPACE_ROOT, query_id)
+    return path if os.path.isdir(path) else None
+
+
+def write_json_atomic(path, data):
+    """
+    Writes JSON through a temporary file and a rename, so readers never see
+    a partially written file.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def purge_expired(root=None, ttl=WORKSPACE_TTL):
+    """
+    Removes workspaces that were last modified more than ttl seconds ago.
+    """
+    root = root or WORKSPACE_ROOT
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - ttl
+    for entry in os.scandir(root):
+        if entry.is_dir() and _QUERY_ID.match(entry.name) and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
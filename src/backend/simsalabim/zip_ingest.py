@@ -0,0 +1,169 @@
+import os
+import time
+import uuid
+import zlib
+import shutil
+import zipfile
+
+# Files that may be inside a dataset ZIP but are never extracted
+IGNORED_FILES = {'README.md', 'LICENSE', '.gitattributes', '.DS_Store', 'Thumbs.db'}
+
+CHUNK_SIZE = 64 * 1024
+
+# What zipfile raises for archives it cannot read: a broken structure or
+# deflate stream (BadZipFile, zlib.error, EOFError), an unsupported
+# compression method (NotImplementedError) or an encrypted member (RuntimeError)
+UNREADABLE_ZIP_ERRORS = (zipfile.BadZipFile, zipfile.LargeZipFile, zlib.error, EOFError, NotImplementedError,
+                         RuntimeError)
+
+
+class ZipIngestError(ValueError):
+    """Raised when a ZIP upload is rejected; the message is safe to show to the user."""
+
+
+def select_members(zip_ref, allowed_extensions, limit, max_member_bytes, max_total_bytes, max_ratio):
+    """
+    Picks the members to extract from the central directory alone.
+
+    Args:
+        zip_ref: Open zipfile.ZipFile
+        allowed_extensions: Set of lower-case extensions that may be extracted
+        limit: Maximum number of files taken from the archive
+        max_member_bytes: Maximum uncompressed size of one member
+        max_total_bytes: Maximum uncompressed size of all extracted members
+        max_ratio: Maximum uncompressed/compressed size ratio of one member
+
+    Returns:
+        List of (ZipInfo, file_name) to extract
+
+    Raises:
+        ZipIngestError: if a member has a disallowed type, breaks a size limit
+            or has the same file name as another member (members are
+            extracted without their folders)
+    """
+    selected, names = [], set()
+    total = 0
+    for info in zip_ref.infolist():
+        if len(selected) >= limit:
+            break
+
+        # Abaikan folder dan file sistem
+        if info.is_dir() or info.filename.startswith('__MACOSX/'):
+            continue
+        filename = os.path.basename(info.filename)
+        if filename in IGNORED_FILES:
+            continue
+
+        _, ext = os.path.splitext(filename)
+        if ext.lower() not in allowed_extensions:
+            allowed_types = " or ".join(sorted(allowed_extensions))
+            raise ZipIngestError(f'Invalid file in ZIP: {filename}. Only {allowed_types} files are allowed.')
+        if info.file_size > max_member_bytes:
+            raise ZipIngestError(f'File in ZIP is too large: {filename} ({info.file_size} bytes).')
+        if info.compress_size and info.file_size / info.compress_size > max_ratio:
+            raise ZipIngestError(f'Suspicious compression ratio for {filename}.')
+
+        if filename in names:
+            raise ZipIngestError(f'Duplicate file name in ZIP: {filename}. File names must be unique.')
+        names.add(filename)
+
+        total += info.file_size
+        if total > max_total_bytes:
+            raise ZipIngestError(f'ZIP contents exceed {max_total_bytes} bytes.')
+        selected.append((info, filename))
+    return selected
+
+
+def copy_member(zip_ref, info, target_path, max_bytes):
+    """
+    Streams one member to disk in fixed-size chunks.
+
+    The declared size in the central directory is not trusted: copying stops
+    with an error as soon as more than max_bytes have been decompressed.
+
+    Returns:
+        Number of bytes written
+    """
+    written = 0
+    with zip_ref.open(info) as source_file, open(target_path, 'wb') as output_file:
+        while True:
+            chunk = source_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > max_bytes:
+                raise ZipIngestError(f'File in ZIP is larger than declared: {os.path.basename(info.filename)}.')
+            output_file.write(chunk)
+    return written
+
+
+def ingest_zip(fileobj, target_dir, allowed_extensions, limit=251, max_member_bytes=50 * 1024 * 1024,
+               max_total_bytes=1024 * 1024 * 1024, max_ratio=200, accept=None, before_commit=None):
+    """
+    Validates and extracts a dataset ZIP in one pass over its central directory.
+
+    Members are streamed into a private staging directory and only moved into
+    target_dir once the whole archive was extracted, so a rejected archive
+    leaves the dataset untouched. Memory use is bounded by CHUNK_SIZE.
+
+    Args:
+        fileobj: Seekable file object holding the ZIP (e.g. the uploaded file)
+        target_dir: Dataset folder to extract into
+        allowed_extensions: Set of lower-case extensions that may be extracted
+        limit: Maximum number of files taken from the archive
+        max_member_bytes: Maximum uncompressed size of one member
+        max_total_bytes: Maximum uncompressed size of all extracted members
+        max_ratio: Maximum uncompressed/compressed size ratio of one member
+        accept: Optional callback(file_name, staged_path) -> bool; members for
+            which it returns False are dropped
+        before_commit: Optional callback() run after the last member was
+            staged and before the files are moved into target_dir
+
+    Returns:
+        Dictionary with extracted file names, skipped count, bytes, seconds
+        and bytes_per_sec
+
+    Raises:
+        ZipIngestError: if the archive is invalid or breaks a limit
+    """
+    start = time.perf_counter()
+    staging = os.path.join(target_dir, f'.zip-{uuid.uuid4().hex}')
+    os.makedirs(staging)
+    try:
+        try:
+            zip_ref = zipfile.ZipFile(fileobj, 'r')
+        except UNREADABLE_ZIP_ERRORS:
+            raise ZipIngestError('Invalid ZIP file!')
+
+        with zip_ref:
+            members = select_members(zip_ref, allowed_extensions, limit, max_member_bytes, max_total_bytes, max_ratio)
+            extracted, skipped, total_bytes = [], 0, 0
+            for info, filename in members:
+                staged_path = os.path.join(staging, filename)
+                try:
+                    total_bytes += copy_member(zip_ref, info, staged_path, max_member_bytes)
+                except UNREADABLE_ZIP_ERRORS:
+                    raise ZipIngestError(f'Corrupted, encrypted or unsupported file in ZIP: {filename}.')
+                if total_bytes > max_total_bytes:
+                    raise ZipIngestError(f'ZIP contents exceed {max_total_bytes} bytes.')
+                if accept is not None and not accept(filename, staged_path):
+                    os.remove(staged_path)
+                    skipped += 1
+                    continue
+                extracted.append(filename)
+
+        if before_commit is not None:
+            before_commit()
+        for filename in extracted:
+            os.replace(os.path.join(staging, filename), os.path.join(target_dir, filename))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    seconds = time.perf_counter() - start
+    return {
+        "files": extracted,
+        "skipped": skipped,
+        "bytes": total_bytes,
+        "seconds": seconds,
+        "bytes_per_sec": total_bytes / seconds if seconds > 0 else 0.0,
+    }
@@ -47,6 +47,8 @@ const App: React.FC = () => {
   
         if (response.ok) {
           console.log(`File uploaded successfully to ${folder}!`);
+          const data = await response.json();
+          sessionStorage.setItem('coverQueryId', data.query_id); // Result pages ask for this query's results
           setStatusMessage('');
           return true; // Success
         } else {
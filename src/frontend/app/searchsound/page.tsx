@@ -48,6 +48,8 @@ export default function Home() {
 
       if (response.ok) {
         console.log(`File uploaded successfully to ${folder}!`);
+        const data = await response.json();
+        sessionStorage.setItem('audioQueryId', data.query_id); // Result pages ask for this query's results
         setStatusMessage('');
         return true; // Success
       } else {
@@ -68,7 +68,7 @@ const page = () => {
       const startTime = performance.now(); // Start measuring time
       try {
         // Use the full backend URL to avoid fetch failure
-        const response = await fetch("http://127.0.0.1:8000/simsalabim/audio-search-result/");
+        const response = await fetch(`http://127.0.0.1:8000/simsalabim/audio-search-result/?query_id=${sessionStorage.getItem("audioQueryId") ?? ""}`);
         if (!response.ok) {
           throw new Error("Failed to fetch data from the server.");
         }
@@ -93,7 +93,7 @@ const page = () => {
     const fetchSearchResult = async () => {
       const startTime = performance.now();
       try {
-        const response = await fetch("http://127.0.0.1:8000/simsalabim/audio-search-result/");
+        const response = await fetch(`http://127.0.0.1:8000/simsalabim/audio-search-result/?query_id=${sessionStorage.getItem("audioQueryId") ?? ""}`);
         if (!response.ok) throw new Error("Failed to fetch data");
   
         const data = await response.json();